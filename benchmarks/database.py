@@ -0,0 +1,188 @@
+"""
+Benchmark of concurrent access to the database by several worker processes, with mixed
+cache hit and cache miss traffic, with the default rollback journal or with the tuned
+sqlite settings
+
+Usage: python -m benchmarks.database [--processes N] [--duration S] [--hit-ratio R]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.measures import latency_stats
+
+CONFIGURATIONS = {
+    "rollback journal": {
+        "SQLITE_JOURNAL_MODE": "delete",
+        "SQLITE_SYNCHRONOUS": "full",
+        "SQLITE_MMAP_SIZE": "0",
+    },
+    "tuned": {},
+}
+HOT_IMAGES = 1000
+
+
+def _lookup(url: str):
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.repository import crud
+
+    return crud.ResizedImageLookup(
+        url=url,
+        width=100,
+        height=100,
+        image_format=crud.ImageFormat.PNG,
+        scale_type=crud.ScaleType.FIT_XY,
+    )
+
+
+def _populate():
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.repository import crud, models
+    from imageresizer.repository.database import SessionLocal
+
+    models.create_db()
+    with SessionLocal() as session:
+        for index in range(HOT_IMAGES):
+            crud.create_resized_image(
+                session,
+                _lookup(f"https://example.com/hot/{index}"),
+                file=f"hot-{index}",
+                mime_type="image/png",
+                commit=False,
+            )
+        session.commit()
+
+
+def _request(session, process_index: int, request_index: int, hit_ratio: float):
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.repository import crud
+
+    if random.random() < hit_ratio:
+        db_resized_image = crud.get_resized_image(
+            session, _lookup(f"https://example.com/hot/{random.randrange(HOT_IMAGES)}")
+        )
+        assert db_resized_image is not None
+        return
+    lookup = _lookup(f"https://example.com/miss/{process_index}/{request_index}")
+    if crud.get_resized_image(session, lookup) is None:
+        crud.create_resized_image(
+            session, lookup, file=lookup.url, mime_type="image/png"
+        )
+
+
+def _run(process_index: int, start_time: float, duration_s: float, hit_ratio: float):
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy.exc import OperationalError
+
+    from imageresizer.repository.database import SessionLocal
+
+    latencies = []
+    locked_errors = 0
+    time.sleep(max(0.0, start_time - time.time()))
+    end_time = start_time + duration_s
+    request_index = 0
+    while time.time() < end_time:
+        request_index += 1
+        start = time.perf_counter()
+        with SessionLocal() as session:
+            try:
+                _request(session, process_index, request_index, hit_ratio)
+            except OperationalError as error:
+                if "database is locked" not in str(error):
+                    raise
+                locked_errors += 1
+                session.rollback()
+        latencies.append(time.perf_counter() - start)
+    print(json.dumps({"latencies": latencies, "locked_errors": locked_errors}))
+
+
+def _measure(
+    directory: str, environment: dict, processes: int, duration_s: float, hit_ratio
+):
+    env = {**os.environ, "CACHE_DIR": directory, "LOG_DIR": directory, **environment}
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.database", "--populate"],
+        env=env,
+        check=True,
+    )
+    # All the processes start at the same time, once they have imported the app
+    start_time = time.time() + 2
+    # pylint: disable=consider-using-with
+    workers = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.database",
+                "--run",
+                str(process_index),
+                str(start_time),
+                "--duration",
+                str(duration_s),
+                "--hit-ratio",
+                str(hit_ratio),
+            ],
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for process_index in range(processes)
+    ]
+    latencies = []
+    locked_errors = 0
+    for worker in workers:
+        output, _ = worker.communicate()
+        result = json.loads(output.splitlines()[-1])
+        latencies.extend(result["latencies"])
+        locked_errors += result["locked_errors"]
+    return {**latency_stats(latencies, duration_s), "locked_errors": locked_errors}
+
+
+def main():
+    """
+    Run the benchmark and print a report
+    """
+    parser = argparse.ArgumentParser(description="Benchmark concurrent database access")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--hit-ratio", type=float, default=0.9)
+    parser.add_argument("--populate", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--run", nargs=2, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.populate:
+        _populate()
+        return
+    if options.run:
+        process_index, start_time = options.run
+        _run(int(process_index), float(start_time), options.duration, options.hit_ratio)
+        return
+
+    print(
+        f"{options.processes} processes, {options.duration}s, "
+        f"{options.hit_ratio:.0%} cache hits"
+    )
+    print(
+        f"{'configuration':18} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'locked errors':>14}"
+    )
+    for name, environment in CONFIGURATIONS.items():
+        with tempfile.TemporaryDirectory() as directory:
+            result = _measure(
+                directory,
+                environment,
+                options.processes,
+                options.duration,
+                options.hit_ratio,
+            )
+        print(
+            f"{name:18} {result['requests_per_s']:8.0f} {result['p50_ms']:8.2f} "
+            f"{result['p99_ms']:8.2f} {result['locked_errors']:14}"
+        )
+
+
+if __name__ == "__main__":
+    main()
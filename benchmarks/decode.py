@@ -0,0 +1,124 @@
+"""
+Benchmark of the decoding of large source images, at full scale or at a reduced scale
+
+Usage: python -m benchmarks.decode [--iterations N]
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from benchmarks.measures import max_rss_mb, run_module
+
+SOURCE_SIZE = (6000, 4000)
+TARGET_SIZES = [(1000, None), (300, 300)]
+
+
+def _create_source_images(directory: str) -> list[str]:
+    # A gradient with some noise, so that the images look like photos to the encoders
+    gradient = Image.linear_gradient("L").resize(SOURCE_SIZE)
+    noise = Image.effect_noise(SOURCE_SIZE, 32)
+    image = Image.merge(
+        "RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_180))
+    )
+    paths = []
+    for image_format in ["jpeg", "png"]:
+        path = str(Path(directory) / f"source.{image_format}")
+        image.save(path, image_format)
+        paths.append(path)
+    return paths
+
+
+def _run(
+    source_file: str, width: int, height: int | None, reduced: bool, iterations: int
+):
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.service import resizer
+    from imageresizer.service.types import ResizedImageLookup, ScaleType
+    from imageresizer.settings import settings
+
+    if not reduced:
+        settings.resize_reducing_gap = None
+    lookup = ResizedImageLookup(
+        url=source_file, width=width, height=height, scale_type=ScaleType.CROP
+    )
+    rss_before = max_rss_mb()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        resized_image = resizer.resize_image(source_file, lookup)
+        latencies.append(time.perf_counter() - start)
+        os.unlink(resized_image.file)
+    print(
+        json.dumps(
+            {
+                "median_ms": statistics.median(latencies) * 1000,
+                "peak_rss_increase_mb": max_rss_mb() - rss_before,
+            }
+        )
+    )
+
+
+def _measure(
+    source_file: str, width: int, height: int | None, reduced: bool, iterations: int
+):
+    return run_module(
+        "benchmarks.decode",
+        [
+            "--run",
+            source_file,
+            str(width),
+            str(height or 0),
+            "reduced" if reduced else "full",
+            "--iterations",
+            str(iterations),
+        ],
+    )
+
+
+def main():
+    """
+    Run the benchmark and print a report
+    """
+    parser = argparse.ArgumentParser(description="Benchmark reduced decoding")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--run", nargs=4, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.run:
+        source_file, width, height, mode = options.run
+        _run(
+            source_file,
+            int(width),
+            int(height) or None,
+            mode == "reduced",
+            options.iterations,
+        )
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["CACHE_DIR"] = directory
+        os.environ["LOG_DIR"] = directory
+        print(f"Source size: {SOURCE_SIZE[0]}x{SOURCE_SIZE[1]}")
+        print(
+            f"{'source':8} {'target':10} {'decoding':8} {'median ms':>10} {'peak rss MB':>12}"
+        )
+        for source_file in _create_source_images(directory):
+            for width, height in TARGET_SIZES:
+                for reduced in [False, True]:
+                    result = _measure(
+                        source_file, width, height, reduced, options.iterations
+                    )
+                    print(
+                        f"{Path(source_file).suffix[1:]:8} {f'{width}x{height or 0}':10} "
+                        f"{'reduced' if reduced else 'full':8} "
+                        f"{result['median_ms']:10.1f} {result['peak_rss_increase_mb']:12.1f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Benchmark of the download of source images from an HTTPS origin server, opening a new
+connection for each image, or reusing the pooled connections
+
+Usage: python -m benchmarks.fetch [--requests N] [--concurrency C] [--latency-ms L]
+"""
+import argparse
+import asyncio
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.request import urlopen
+
+from PIL import Image
+
+from benchmarks.measures import latency_stats
+
+
+def _create_certificate(directory: str) -> tuple[str, str]:
+    certificate = str(Path(directory) / "certificate.pem")
+    key = str(Path(directory) / "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost,IP:127.0.0.1",
+            "-keyout",
+            key,
+            "-out",
+            certificate,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certificate, key
+
+
+def _create_origin(directory: str, latency_s: float) -> ThreadingHTTPServer:
+    """
+    :return: an HTTPS server which serves the same image at any path. Each new connection
+    is delayed, like the round trips of a TCP and TLS handshake to a remote server.
+    """
+    image_file = Path(directory) / "image.jpg"
+    Image.effect_noise((800, 600), 64).convert("RGB").save(image_file)
+    content = image_file.read_bytes()
+
+    class OriginHandler(BaseHTTPRequestHandler):
+        """
+        Serve the image, keeping the connection alive
+        """
+
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            time.sleep(latency_s)
+            super().setup()
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            Respond with the image
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    certificate, key = _create_certificate(directory)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["SSL_CERT_FILE"] = certificate
+    return server
+
+
+def _new_connection(url: str):
+    with urlopen(url) as response:
+        response.read()
+
+
+def _pooled(url: str):
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.service import fetcher
+
+    # pylint: disable=protected-access
+    fetcher._fetch(url, {}, None).content.close()
+
+
+async def _measure(fetch, url: str, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def request(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await asyncio.to_thread(fetch, f"{url}/{index}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(index) for index in range(requests)))
+    return latency_stats(latencies, time.perf_counter() - start)
+
+
+def main():
+    """
+    Run the benchmark and print a report
+    """
+    parser = argparse.ArgumentParser(description="Benchmark source image downloads")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=20.0,
+        help="the delay of each new connection to the origin server",
+    )
+    options = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.setdefault("CACHE_DIR", directory)
+        os.environ.setdefault("LOG_DIR", directory)
+        server = _create_origin(directory, options.latency_ms / 1000)
+        url = f"https://localhost:{server.server_port}"
+        print(
+            f"{options.requests} requests, concurrency {options.concurrency}, "
+            f"{options.latency_ms}ms per new connection"
+        )
+        print(f"{'client':16} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, fetch in [("new connection", _new_connection), ("pooled", _pooled)]:
+            result = asyncio.run(
+                _measure(fetch, url, options.requests, options.concurrency)
+            )
+            print(
+                f"{name:16} {result['requests_per_s']:8.0f} {result['p50_ms']:8.2f} "
+                f"{result['p99_ms']:8.2f}"
+            )
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Measures shared by the benchmarks
+"""
+import json
+import resource
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+def max_rss_mb(pid: int | str = "self") -> float:
+    """
+    :return: the peak memory of a process, in MB
+    """
+    # ru_maxrss is inherited through fork and exec on Linux, so prefer the high water mark
+    # of the process' own memory
+    status = Path(f"/proc/{pid}/status")
+    if status.exists():
+        for line in status.read_text(encoding="utf-8").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_stats(latencies: list[float], duration_s: float) -> dict:
+    """
+    :param latencies: the latencies of the requests, in seconds
+    :param duration_s: the time taken by all the requests
+    :return: the throughput and the latency percentiles of the requests
+    """
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests_per_s": len(latencies) / duration_s,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+
+def run_module(module: str, args: list[str], env: dict | None = None) -> dict:
+    """
+    Run a benchmark module in its own process, so that its peak memory and its caches
+    aren't shared.
+
+    :return: the results, printed as json on the last line of the output of the module
+    """
+    output = subprocess.run(
+        [sys.executable, "-m", module, *args],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
@@ -0,0 +1,357 @@
+"""
+Benchmark of the resize service: latency, throughput, CPU and memory of cache hits, cache
+misses, each scale type, animated images, and concurrent requests, with a local origin server
+and a synthetic corpus of images.
+
+The results can be saved as a baseline, and compared to a baseline to find regressions.
+
+Usage:
+    python -m benchmarks.resize [--requests N] [--workers W] [--scenarios NAME ...]
+        [--save FILE] [--compare FILE] [--threshold PERCENT]
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from benchmarks.measures import latency_stats, max_rss_mb, run_module
+
+SMALL_SIZE = (640, 480)
+LARGE_SIZE = (3000, 2000)
+ANIMATED_SIZE = (320, 240)
+ANIMATED_FRAMES = 24
+CONCURRENCY = 8
+# The metrics compared to the baseline: an increase is a regression
+COMPARED_METRICS = ["p50_ms", "p99_ms", "cpu_ms_per_request"]
+# Smaller increases, in ms, are noise
+MIN_REGRESSION_MS = 0.5
+
+
+@dataclasses.dataclass
+class Scenario:
+    """
+    A kind of request to the resize service
+    """
+
+    name: str
+    source: str
+    # The same source url for all the requests, so that it is downloaded once
+    same_source: bool = True
+    # The same resized image for all the requests, so that it is resized once
+    same_rendition: bool = False
+    hot_cache: bool = True
+    scale_type: str = "fit_preserve_aspect_ratio"
+    concurrency: int = 1
+
+
+SCENARIOS = [
+    Scenario("hit-hot-cache", "large.jpeg", same_rendition=True),
+    Scenario("hit-database", "large.jpeg", same_rendition=True, hot_cache=False),
+    *(
+        Scenario(f"miss-{size}-{image_format}", f"{size}.{image_format}", False)
+        for image_format in ["jpeg", "png", "webp"]
+        for size in ["small", "large"]
+    ),
+    *(
+        Scenario(f"scale-{scale_type}", "large.jpeg", scale_type=scale_type)
+        for scale_type in ["fit_xy", "fit_preserve_aspect_ratio", "crop"]
+    ),
+    Scenario("miss-animated-gif", "animated.gif", False),
+    Scenario("concurrent-miss", "small.jpeg", False, concurrency=CONCURRENCY),
+]
+
+
+def _photo(size: tuple[int, int]) -> Image.Image:
+    # A gradient with some noise, so that the images look like photos to the encoders
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 32)
+    return Image.merge(
+        "RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_180))
+    )
+
+
+def _create_corpus(directory: Path):
+    for name, size in [("small", SMALL_SIZE), ("large", LARGE_SIZE)]:
+        image = _photo(size)
+        for image_format in ["jpeg", "png", "webp"]:
+            image.save(directory / f"{name}.{image_format}", image_format)
+    frames = [
+        _photo(ANIMATED_SIZE).rotate(index * 360 / ANIMATED_FRAMES)
+        for index in range(ANIMATED_FRAMES)
+    ]
+    frames[0].save(
+        directory / "animated.gif", save_all=True, append_images=frames[1:], loop=0
+    )
+
+
+def _get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_origin(directory: Path) -> tuple[subprocess.Popen, str]:
+    """
+    :return: a static file server, in its own process so that its CPU isn't measured,
+    and its url
+    """
+    port = _get_free_port()
+    # pylint: disable=consider-using-with
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "http.server",
+            str(port),
+            "--bind",
+            "127.0.0.1",
+            "--directory",
+            str(directory),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def _cpu_s(pid: int) -> float:
+    # utime and stime, after the command, which may contain spaces
+    fields = Path(f"/proc/{pid}/stat").read_text(encoding="utf-8").rsplit(")", 1)[1]
+    utime, stime = fields.split()[11:13]
+    return (int(utime) + int(stime)) / os.sysconf("SC_CLK_TCK")
+
+
+def _resizer_processes() -> list[int]:
+    # pylint: disable=import-outside-toplevel
+    import multiprocessing
+
+    return [process.pid for process in multiprocessing.active_children()]
+
+
+def _total_cpu_s() -> float:
+    """
+    :return: the CPU time of this process and of the resizer processes
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_s = usage.ru_utime + usage.ru_stime
+    if Path("/proc").exists():
+        cpu_s += sum(_cpu_s(pid) for pid in _resizer_processes())
+    return cpu_s
+
+
+def _lookup(scenario: Scenario, origin: str, index: int):
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.service.types import ResizedImageLookup, ScaleType
+
+    url = f"{origin}/{scenario.source}"
+    if not scenario.same_source:
+        url = f"{url}?v={index}"
+    width = 200 if scenario.same_rendition else 100 + index % 900
+    return ResizedImageLookup(
+        url=url,
+        width=width,
+        height=width * 3 // 4,
+        scale_type=ScaleType(scenario.scale_type),
+    )
+
+
+async def _measure_requests(resize, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def request(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await resize(index)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(index) for index in range(requests)))
+    return latency_stats(latencies, time.perf_counter() - start)
+
+
+async def _resize_all(scenario: Scenario, origin: str, requests: int) -> dict:
+    # pylint: disable=import-outside-toplevel
+    from imageresizer.repository import models
+    from imageresizer.repository.database import SessionLocal
+    from imageresizer.service import resizer, service
+
+    models.create_db()
+
+    async def resize(index: int):
+        if not scenario.hot_cache:
+            service.hot_cache.clear()
+        with SessionLocal() as session:
+            await service.resize(session, {}, _lookup(scenario, origin, index))
+
+    # Start the resizer processes, and download or resize what the requests share
+    await resize(-1)
+
+    cpu_before = _total_cpu_s()
+    stats = await _measure_requests(resize, requests, scenario.concurrency)
+    cpu_s = _total_cpu_s() - cpu_before
+    resizer_rss_mb = max(map(max_rss_mb, _resizer_processes()), default=0.0)
+    resizer.shutdown()
+    return {
+        **stats,
+        "cpu_ms_per_request": cpu_s / requests * 1000,
+        "server_rss_mb": max_rss_mb(),
+        "resizer_rss_mb": resizer_rss_mb,
+    }
+
+
+def _measure(
+    scenario: Scenario, origin: str, requests: int, workers: int, directory: str
+) -> dict:
+    # Each scenario has an empty cache
+    env = {
+        **os.environ,
+        "CACHE_DIR": directory,
+        "LOG_DIR": directory,
+        "RESIZE_MAX_WORKERS": str(workers),
+    }
+    return run_module(
+        "benchmarks.resize",
+        ["--run", scenario.name, origin, "--requests", str(requests)],
+        env=env,
+    )
+
+
+def _print_results(results: dict[str, dict]):
+    print(
+        f"{'scenario':36} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'cpu ms/req':>10} "
+        f"{'server MB':>10} {'resizer MB':>10}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:36} {result['requests_per_s']:8.1f} {result['p50_ms']:8.2f} "
+            f"{result['p99_ms']:8.2f} {result['cpu_ms_per_request']:10.2f} "
+            f"{result['server_rss_mb']:10.1f} {result['resizer_rss_mb']:10.1f}"
+        )
+
+
+def _compare(results: dict[str, dict], baseline: dict, threshold: float) -> bool:
+    """
+    Print the changes since the baseline.
+
+    :return: True if a metric of a scenario regressed by more than the threshold
+    """
+    print(
+        f"\nCompared to the baseline of {baseline['date']} ({baseline['pillow']}, "
+        f"{baseline['cpus']} CPUs):"
+    )
+    print(
+        f"{'scenario':36} " + " ".join(f"{metric:>20}" for metric in COMPARED_METRICS)
+    )
+    regressed = False
+    for name, result in results.items():
+        baseline_result = baseline["results"].get(name)
+        if baseline_result is None:
+            continue
+        changes = []
+        for metric in COMPARED_METRICS:
+            increase = result[metric] - baseline_result[metric]
+            change = increase / max(baseline_result[metric], 1e-9)
+            regression = change > threshold and increase > MIN_REGRESSION_MS
+            mark = "!" if regression else " "
+            regressed |= regression
+            changes.append(f"{baseline_result[metric]:8.2f} {change:+7.0%} {mark}")
+        print(f"{name:36} " + " ".join(f"{change:>20}" for change in changes))
+    return regressed
+
+
+def main():
+    """
+    Run the benchmark and print a report
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the resize service")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2, help="resizer processes")
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        help="run the scenarios whose name starts with one of these",
+    )
+    parser.add_argument("--save", help="save the results as a baseline in this file")
+    parser.add_argument("--compare", help="compare the results to this baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="the increase, in percent, reported as a regression",
+    )
+    parser.add_argument("--run", nargs=2, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.run:
+        name, origin = options.run
+        scenario = next(scenario for scenario in SCENARIOS if scenario.name == name)
+        result = asyncio.run(_resize_all(scenario, origin, options.requests))
+        print(json.dumps(result))
+        return
+
+    scenarios = [
+        scenario
+        for scenario in SCENARIOS
+        if not options.scenarios
+        or any(scenario.name.startswith(prefix) for prefix in options.scenarios)
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory() as corpus_directory:
+        _create_corpus(Path(corpus_directory))
+        origin_server, origin = _start_origin(Path(corpus_directory))
+        try:
+            for scenario in scenarios:
+                with tempfile.TemporaryDirectory() as directory:
+                    results[scenario.name] = _measure(
+                        scenario, origin, options.requests, options.workers, directory
+                    )
+        finally:
+            origin_server.terminate()
+            origin_server.wait()
+
+    print(
+        f"{options.requests} requests per scenario, {options.workers} resizer processes, "
+        f"{os.cpu_count()} CPUs"
+    )
+    _print_results(results)
+    if options.save:
+        Path(options.save).write_text(
+            json.dumps(
+                {
+                    "date": time.strftime("%Y-%m-%d %H:%M"),
+                    "python": platform.python_version(),
+                    "pillow": f"Pillow {Image.__version__}",
+                    "cpus": os.cpu_count(),
+                    "requests": options.requests,
+                    "workers": options.workers,
+                    "results": results,
+                },
+                indent=2,
+            ),
+            encoding="utf-8",
+        )
+    if options.compare:
+        baseline = json.loads(Path(options.compare).read_text(encoding="utf-8"))
+        if _compare(results, baseline, options.threshold / 100):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
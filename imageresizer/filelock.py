@@ -0,0 +1,38 @@
+"""
+Locks shared between the processes using the same cache dir
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+
+class LockUnavailableError(Exception):
+    """
+    Raised when a non-blocking lock is already held by another process
+    """
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True) -> Iterator[None]:
+    """
+    Hold an exclusive lock on the given file, creating it if needed.
+
+    :param path: the path to the lock file
+    :param blocking: if False, raise LockUnavailableError instead of waiting,
+    if the lock is held by another process
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    lock_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(
+                lock_fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError as error:
+            raise LockUnavailableError(path) from error
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(lock_fd)
@@ -7,10 +7,12 @@ import os
 import uvicorn
 from fastapi import FastAPI
 
-from imageresizer import purge
+from imageresizer import metrics, purge
 from imageresizer.repository import models
-from imageresizer.routers import resize
+from imageresizer.routers import resize, stats
+from imageresizer.service import resizer
 from imageresizer.settings import settings
+from imageresizer.storage.storage import get_storage
 
 logging.basicConfig(
     filename=settings.get_log_absolute_path("image-resizer.log"), level=logging.INFO
@@ -27,13 +29,25 @@ app = FastAPI(
 )
 
 app.include_router(resize.router)
+app.include_router(stats.router)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.on_event("shutdown")
+def shutdown():
+    """
+    Release the resources of the app
+    """
+    resizer.shutdown()
 
 
 def setup():
     """
-    Prepare for the app to run
+    Prepare for the app to run, and fail early if it's misconfigured
     """
     models.create_db()
+    get_storage()
+    metrics.reset()
     purge.schedule()
 
 
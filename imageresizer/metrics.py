@@ -0,0 +1,174 @@
+"""
+Prometheus metrics of the image resizer, shared by all the worker processes: each process
+writes its metrics in files of the metrics folder, and the /metrics endpoint aggregates them.
+"""
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from timeit import default_timer
+from typing import Iterator
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    values,
+)
+
+from imageresizer import profiling
+from imageresizer.routers.responses import ZEROCOPY_SEND
+from imageresizer.settings import settings
+
+
+def _use_multiprocess_mode():
+    """
+    Store the metrics of this process in the metrics dir, whichever module imported
+    prometheus_client first: prometheus_client only enables the multiprocess mode by itself
+    if PROMETHEUS_MULTIPROC_DIR was set before it was imported. The worker and resizer
+    processes inherit the variable, and run this too when they import the metrics.
+    """
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = settings.cache_metrics_dir
+    # pylint: disable=protected-access
+    if not values.ValueClass._multiprocess:
+        values.ValueClass = values.MultiProcessValue()
+
+
+# Before the metrics are created, since their values are created with them
+_use_multiprocess_mode()
+
+# The paths of the requests whose duration, and bytes sent, are measured
+_MEASURED_PATHS = {"/resize", "/resize/batch"}
+
+stage_duration = Histogram(
+    "imageresizer_stage_duration_seconds",
+    "Time spent in each stage of the resize pipeline",
+    ["stage"],
+    buckets=(
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+    ),
+)
+request_duration = Histogram(
+    "imageresizer_request_duration_seconds",
+    "Time to handle a request, including sending the response",
+    ["path"],
+)
+cache_requests = Counter(
+    "imageresizer_cache_requests",
+    "Requested resized images, by where they were found: hot cache, database, or neither",
+    ["result"],
+)
+stale_served = Counter(
+    "imageresizer_stale_served",
+    "Expired resized images served because their origin server was unavailable",
+)
+fetched_bytes = Counter(
+    "imageresizer_fetched_bytes",
+    "Bytes of source images downloaded from the origin servers",
+)
+served_bytes = Counter(
+    "imageresizer_served_bytes",
+    "Bytes of resized images sent to the clients",
+)
+purged_images = Counter(
+    "imageresizer_purged_images",
+    "Images deleted by the purges of the cache, by kind: resized or source",
+    ["kind"],
+)
+purged_bytes = Counter(
+    "imageresizer_purged_bytes",
+    "Bytes freed by the purges of the cache",
+)
+purge_duration = Histogram(
+    "imageresizer_purge_duration_seconds",
+    "Time to purge the cache",
+    buckets=(0.01, 0.1, 1, 10, 60, 300),
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Measure the time spent in a stage of the resize pipeline, in the context. It is also
+    recorded in the trace of the request, if it is profiled.
+    """
+    start = default_timer()
+    try:
+        yield
+    finally:
+        duration_s = default_timer() - start
+        stage_duration.labels(name).observe(duration_s)
+        profiling.record_stage(name, duration_s)
+
+
+def reset():
+    """
+    Delete the metrics of the processes of previous runs of the server.
+
+    The metrics of this process are kept: they may already be in use.
+    """
+    metrics_dir = Path(settings.cache_metrics_dir)
+    for metrics_file in metrics_dir.glob("*.db"):
+        if not metrics_file.stem.endswith(f"_{os.getpid()}"):
+            metrics_file.unlink(missing_ok=True)
+
+
+def generate() -> bytes:
+    """
+    :return: the metrics of all the processes, in the Prometheus text format
+    """
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=settings.cache_metrics_dir)
+    return generate_latest(registry)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware which measures the duration of the resize requests, the time spent
+    sending their response, and the bytes sent
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in _MEASURED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        start = default_timer()
+        serve_start = start
+
+        async def send_measured(message):
+            nonlocal serve_start
+            if message["type"] == "http.response.start":
+                serve_start = default_timer()
+            elif message["type"] == "http.response.body":
+                served_bytes.inc(len(message.get("body", b"")))
+            elif message["type"] == ZEROCOPY_SEND:
+                served_bytes.inc(message.get("count", 0))
+            if message["type"] in ("http.response.body", ZEROCOPY_SEND):
+                if not message.get("more_body"):
+                    stage_duration.labels("serve").observe(
+                        default_timer() - serve_start
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            request_duration.labels(scope["path"]).observe(default_timer() - start)
@@ -0,0 +1,187 @@
+"""
+Opt-in profiling of slow requests: the time spent in each stage of the resize pipeline, and
+a profile of the resizer process, are written to the log folder for the requests which take
+longer than a threshold.
+"""
+import cProfile
+import dataclasses
+import datetime
+import io
+import logging
+import marshal
+import pstats
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from timeit import default_timer
+from typing import AsyncIterator, Callable, TypeVar
+
+from starlette.concurrency import run_in_threadpool
+
+from imageresizer.settings import settings
+
+T = TypeVar("T")
+
+# The number of functions listed in the text version of the profiles
+_PROFILE_TEXT_LIMIT = 50
+
+
+@dataclasses.dataclass
+class Trace:
+    """
+    What is recorded about a profiled request
+    """
+
+    # The parameters of the request, and what was learned about its source image
+    details: dict = dataclasses.field(default_factory=dict)
+    # The total time spent in each stage
+    stages: dict[str, float] = dataclasses.field(default_factory=dict)
+    # The cProfile stats of the resizer process, as saved by cProfile
+    profile: dict | None = None
+
+    def merge(self, other: "Trace"):
+        """
+        Add what was recorded in another process for the same request
+        """
+        self.details.update(other.details)
+        for stage, duration_s in other.stages.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + duration_s
+        if other.profile is not None:
+            self.profile = {**(self.profile or {}), **other.profile}
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+def is_tracing() -> bool:
+    """
+    :return: True if the current request is profiled
+    """
+    return _current_trace.get() is not None
+
+
+def record_stage(stage: str, duration_s: float):
+    """
+    Record the time spent in a stage of the resize pipeline, if the current request is
+    profiled
+    """
+    if trace := _current_trace.get():
+        trace.stages[stage] = trace.stages.get(stage, 0.0) + duration_s
+
+
+def add_details(**details):
+    """
+    Record information about the current request, if it is profiled
+    """
+    if trace := _current_trace.get():
+        trace.details.update(details)
+
+
+def add_trace(trace: Trace):
+    """
+    Add what was recorded in another process to the trace of the current request
+    """
+    if current_trace := _current_trace.get():
+        current_trace.merge(trace)
+
+
+def run_profiled(func: Callable[..., T], *args) -> tuple[T, Trace]:
+    """
+    Run a function with cProfile, recording the stages of the resize pipeline it goes
+    through. This is used in the resizer processes.
+
+    :return: the result of the function, and what was recorded
+    """
+    trace = Trace()
+    token = _current_trace.set(trace)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            result = func(*args)
+        finally:
+            profiler.disable()
+    finally:
+        _current_trace.reset(token)
+    profiler.create_stats()
+    trace.profile = profiler.stats
+    return result, trace
+
+
+def _format_trace(trace: Trace, duration_s: float, error: BaseException | None) -> str:
+    lines = [f"Duration: {duration_s * 1000:.1f} ms"]
+    if error is not None:
+        lines.append(f"Error: {error!r}")
+    lines.extend(f"{key}: {value}" for key, value in trace.details.items())
+    lines.append("")
+    lines.append("Stages:")
+    lines.extend(
+        f"  {stage:12} {stage_duration_s * 1000:10.1f} ms"
+        for stage, stage_duration_s in sorted(
+            trace.stages.items(), key=lambda item: item[1], reverse=True
+        )
+    )
+    return "\n".join(lines) + "\n"
+
+
+def _delete_old_traces(profile_dir: Path):
+    traces = sorted(profile_dir.glob("*.txt"))
+    for old_trace in traces[: max(len(traces) - settings.profile_max_traces, 0)]:
+        old_trace.unlink(missing_ok=True)
+        old_trace.with_suffix(".prof").unlink(missing_ok=True)
+
+
+def _write_trace(trace: Trace, duration_s: float, error: BaseException | None):
+    profile_dir = Path(settings.get_log_absolute_path("profiles"))
+    profile_dir.mkdir(exist_ok=True)
+    name = f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{int(duration_s * 1000)}ms"
+    text = _format_trace(trace, duration_s, error)
+    if trace.profile is not None:
+        # The .prof file can be opened with pstats, or with viewers like snakeviz
+        profile_file = profile_dir / f"{name}.prof"
+        with open(profile_file, "wb") as profile_output:
+            marshal.dump(trace.profile, profile_output)
+        profile_text = io.StringIO()
+        pstats.Stats(str(profile_file), stream=profile_text).sort_stats(
+            pstats.SortKey.CUMULATIVE
+        ).print_stats(_PROFILE_TEXT_LIMIT)
+        text += "\nProfile of the resizer process:\n" + profile_text.getvalue()
+    (profile_dir / f"{name}.txt").write_text(text, encoding="utf-8")
+    _delete_old_traces(profile_dir)
+    logging.info("Slow request profiled in %s", profile_dir / f"{name}.txt")
+
+
+def _save_trace(trace: Trace, duration_s: float, error: BaseException | None):
+    try:
+        _write_trace(trace, duration_s, error)
+    except OSError:
+        logging.exception("Couldn't write the profile of a slow request")
+
+
+@asynccontextmanager
+async def trace_request(enabled: bool, **details) -> AsyncIterator[None]:
+    """
+    Profile the request handled in the context, if enabled, and write what was recorded to
+    the log folder if the request is slower than the threshold. The files are written in
+    the threadpool, so that the other requests aren't stalled.
+
+    :param enabled: True if the request must be profiled
+    :param details: the parameters of the request
+    """
+    if not enabled:
+        yield
+        return
+    trace = Trace(details=details)
+    token = _current_trace.set(trace)
+    start = default_timer()
+    error = None
+    try:
+        yield
+    except BaseException as exception:
+        error = exception
+        raise
+    finally:
+        _current_trace.reset(token)
+        duration_s = default_timer() - start
+        if duration_s >= settings.profile_slow_request_threshold_s:
+            await run_in_threadpool(_save_trace, trace, duration_s, error)
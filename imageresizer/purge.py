@@ -2,54 +2,416 @@
 Utility to delete old resized images
 """
 import argparse
+import dataclasses
 import datetime
+import json
 import logging
 import os
+import time
 from os.path import exists
+from pathlib import Path
 from threading import Timer
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from imageresizer.repository import models
+from imageresizer import metrics
+from imageresizer.filelock import LockUnavailableError, file_lock
+from imageresizer.repository import crud, models
 from imageresizer.repository.database import SessionLocal
 from imageresizer.settings import settings
+from imageresizer.storage.storage import get_storage
 
 
-def schedule():
+@dataclasses.dataclass
+class PurgeStats:
     """
-    Schedule a periodic purge of the image cache
+    What a purge of the cache deleted
     """
-    with SessionLocal() as session:
-        purge_old_images(session)
-    timer = Timer(settings.cache_clean_interval_s, schedule)
+
+    resized_images: int = 0
+    source_images: int = 0
+    bytes_freed: int = 0
+    # Set for a complete purge only
+    started: datetime.datetime | None = None
+    duration_s: float | None = None
+
+    def __add__(self, other: "PurgeStats") -> "PurgeStats":
+        return PurgeStats(
+            resized_images=self.resized_images + other.resized_images,
+            source_images=self.source_images + other.source_images,
+            bytes_freed=self.bytes_freed + other.bytes_freed,
+        )
+
+
+def _get_lock_path() -> str:
+    return str(Path(settings.cache_lock_dir) / "purge.lock")
+
+
+def _get_last_purge_path() -> Path:
+    return Path(settings.cache_dir) / "last-purge.json"
+
+
+def get_last_purge() -> PurgeStats | None:
+    """
+    :return: the stats of the last scheduled purge, by any worker, if there was one
+    """
+    try:
+        last_purge = json.loads(_get_last_purge_path().read_text())
+    except (OSError, ValueError):
+        return None
+    last_purge["started"] = datetime.datetime.fromisoformat(last_purge["started"])
+    return PurgeStats(**last_purge)
+
+
+def _save_last_purge(stats: PurgeStats):
+    last_purge_path = _get_last_purge_path()
+    temp_path = last_purge_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(dataclasses.asdict(stats), default=str))
+    temp_path.replace(last_purge_path)
+
+
+def _is_purge_due(now: datetime.datetime) -> bool:
+    last_purge = get_last_purge()
+    return last_purge is None or now - last_purge.started >= datetime.timedelta(
+        seconds=settings.cache_clean_interval_s
+    )
+
+
+def purge(
+    session: Session, max_age_seconds: int = None, max_bytes: int = None
+) -> PurgeStats:
+    """
+    Delete the expired resized images, then the least recently used ones if the cache is
+    too large, then the expired and oldest source images, and the temp files left by
+    incomplete resizes.
+
+    :return: what was deleted, and how long it took
+    """
+    started = datetime.datetime.now()
+    start_time = time.monotonic()
+    stats = (
+        purge_old_images(session, max_age_seconds)
+        + evict_least_recently_used_images(session, max_bytes)
+        + purge_source_images(session)
+        + purge_temp_files()
+    )
+    stats.started = started
+    stats.duration_s = time.monotonic() - start_time
+    metrics.purged_images.labels("resized").inc(stats.resized_images)
+    metrics.purged_images.labels("source").inc(stats.source_images)
+    metrics.purged_bytes.inc(stats.bytes_freed)
+    metrics.purge_duration.observe(stats.duration_s)
+    logging.info(
+        "Purge deleted %s resized images and %s source images, freeing %s bytes, in %.3fs",
+        stats.resized_images,
+        stats.source_images,
+        stats.bytes_freed,
+        stats.duration_s,
+    )
+    return stats
+
+
+def purge_if_due() -> PurgeStats | None:
+    """
+    Purge the cache, unless another process is already purging it, or it was purged less
+    than the cache clean interval ago.
+
+    :return: the stats of the purge, or None if it was skipped
+    """
+    try:
+        with file_lock(_get_lock_path(), blocking=False):
+            if not _is_purge_due(datetime.datetime.now()):
+                logging.debug("Skipping purge: the cache was purged recently")
+                return None
+            with SessionLocal() as session:
+                stats = purge(session)
+            _save_last_purge(stats)
+            return stats
+    except LockUnavailableError:
+        logging.debug("Skipping purge: another process is purging the cache")
+        return None
+
+
+def _run_scheduled_purge():
+    try:
+        purge_if_due()
+    # pylint: disable=broad-except
+    except Exception:
+        logging.exception("Error purging the cache")
+    finally:
+        schedule(settings.cache_clean_interval_s)
+
+
+def schedule(delay_s: float = 0):
+    """
+    Schedule a periodic purge of the image cache, in a background thread.
+
+    setup() schedules it once, in the main process of the server, not in each worker.
+    The purge holds a file lock in the cache dir, so that other servers sharing the cache
+    dir, or a purge run from the command line, don't purge it at the same time.
+
+    :param delay_s: the delay before the first purge
+    """
+    timer = Timer(delay_s, _run_scheduled_purge)
     timer.daemon = True
     timer.start()
 
 
-def purge_old_images(session: Session, max_age_seconds: int = None):
+def _delete_file(file: str, file_log: str) -> int:
     """
-    Delete resized image data from the db and the disk,
-    for resized images created or updated before max_age_seconds ago
+    :return: the number of bytes freed
     """
-    datetime_limit = datetime.datetime.now() - datetime.timedelta(
-        seconds=max_age_seconds if max_age_seconds else settings.cache_validity_s
-    )
-    logging.info("Deleting images created before %s", datetime_limit)
-    resized_images_to_delete = session.query(models.ResizedImage).filter(
-        models.ResizedImage.datetime <= datetime_limit
+    if exists(file):
+        file_size = os.path.getsize(file)
+        os.unlink(file)
+        logging.debug("Deleted %s", file_log)
+        return file_size
+    logging.debug("File %s was already deleted", file_log)
+    return 0
+
+
+def _delete_resized_images(session: Session, resized_images_to_delete: list) -> int:
+    """
+    Delete one batch of resized images from the db, in a short transaction, then delete
+    the files which no other resized image references
+
+    :return: the number of bytes freed
+    """
+    session.query(models.ResizedImage).filter(
+        models.ResizedImage.id.in_(
+            [resized_image.id for resized_image in resized_images_to_delete]
+        )
+    ).delete(synchronize_session=False)
+    session.commit()
+
+    referenced_files = crud.get_referenced_files(
+        session, {resized_image.file for resized_image in resized_images_to_delete}
     )
-    logging.info("Found %s images", resized_images_to_delete.count())
+    storage = get_storage()
+    bytes_freed = 0
     for resized_image in resized_images_to_delete:
         # pylint: disable=line-too-long
         file_log = f"{resized_image.url}({resized_image.width}x{resized_image.height}): {resized_image.file}"
-        if exists(resized_image.file):
-            os.unlink(resized_image.file)
+        if resized_image.file in referenced_files:
+            logging.debug("File %s is used by other resized images", file_log)
+        elif file_bytes_freed := storage.delete(resized_image.file):
+            bytes_freed += file_bytes_freed
             logging.debug("Deleted %s", file_log)
         else:
             logging.debug("File %s was already deleted", file_log)
+    return bytes_freed
 
-    resized_images_to_delete.delete()
+
+def purge_temp_files(max_age_seconds: int = 3600) -> PurgeStats:
+    """
+    Delete the files left in the cache temp dir by resizes which didn't complete,
+    like when a worker was killed
+
+    :return: the number of bytes freed
+    """
+    datetime_limit = time.time() - max_age_seconds
+    stats = PurgeStats()
+    for temp_file in Path(settings.cache_temp_dir).iterdir():
+        try:
+            file_stat = temp_file.stat()
+            if file_stat.st_mtime <= datetime_limit:
+                temp_file.unlink()
+                stats.bytes_freed += file_stat.st_size
+                logging.debug("Deleted temp file %s", temp_file)
+        except FileNotFoundError:
+            pass
+    return stats
+
+
+def _query_resized_images(session: Session, *columns):
+    # Only load the columns needed to delete the resized images, not the ORM objects
+    return session.query(
+        models.ResizedImage.id,
+        models.ResizedImage.url,
+        models.ResizedImage.width,
+        models.ResizedImage.height,
+        models.ResizedImage.file,
+        *columns,
+    )
+
+
+def purge_old_images(
+    session: Session, max_age_seconds: int = None, batch_size: int = None
+) -> PurgeStats:
+    """
+    Delete resized image data from the db and the disk,
+    for resized images created or updated before max_age_seconds ago.
+
+    The resized images are deleted in batches of batch_size, each in its own transaction,
+    so that the database is never locked for long.
+
+    :return: the number of deleted resized images and of bytes freed
+    """
+    datetime_limit = datetime.datetime.now() - datetime.timedelta(
+        seconds=max_age_seconds if max_age_seconds else settings.cache_validity_s
+    )
+    batch_size = batch_size or settings.cache_purge_batch_size
+    logging.info("Deleting images created before %s", datetime_limit)
+    stats = PurgeStats()
+    while resized_images_to_delete := (
+        _query_resized_images(session)
+        .filter(models.ResizedImage.datetime <= datetime_limit)
+        .order_by(models.ResizedImage.id)
+        .limit(batch_size)
+        .all()
+    ):
+        stats.bytes_freed += _delete_resized_images(session, resized_images_to_delete)
+        stats.resized_images += len(resized_images_to_delete)
+    logging.info("Deleted %s images", stats.resized_images)
+    return stats
+
+
+def _fill_missing_file_sizes(session: Session, batch_size: int):
+    """
+    Set the file size of the resized images created before it was stored
+    """
+    storage = get_storage()
+    while resized_images := (
+        session.query(models.ResizedImage.id, models.ResizedImage.file)
+        .filter(models.ResizedImage.file_size.is_(None))
+        .limit(batch_size)
+        .all()
+    ):
+        session.bulk_update_mappings(
+            models.ResizedImage,
+            [
+                {
+                    "id": resized_image.id,
+                    "file_size": storage.size(resized_image.file)
+                    if storage.exists(resized_image.file)
+                    else 0,
+                }
+                for resized_image in resized_images
+            ],
+        )
+        session.commit()
+
+
+def evict_least_recently_used_images(
+    session: Session, max_bytes: int = None, batch_size: int = None
+) -> PurgeStats:
+    """
+    Delete resized image data from the db and the disk, for the least recently
+    used resized images, until the remaining ones take up at most max_bytes.
+
+    Does nothing if there is no maximum cache size.
+    The resized images are deleted in batches of batch_size, each in its own transaction.
+
+    :return: the number of deleted resized images and of bytes freed
+    """
+    stats = PurgeStats()
+    max_bytes = max_bytes if max_bytes is not None else settings.cache_max_bytes
+    if max_bytes is None:
+        return stats
+    batch_size = batch_size or settings.cache_purge_batch_size
+    _fill_missing_file_sizes(session, batch_size)
+    total_bytes = session.query(func.sum(models.ResizedImage.file_size)).scalar() or 0
+    logging.info(
+        "Evicting images to reduce the cache from %s to %s bytes",
+        total_bytes,
+        max_bytes,
+    )
+    while total_bytes > max_bytes:
+        resized_images_to_evict = []
+        for resized_image in (
+            _query_resized_images(session, models.ResizedImage.file_size)
+            .order_by(
+                models.ResizedImage.last_accessed.asc().nullsfirst(),
+                models.ResizedImage.id,
+            )
+            .limit(batch_size)
+        ):
+            if total_bytes <= max_bytes:
+                break
+            resized_images_to_evict.append(resized_image)
+            total_bytes -= resized_image.file_size or 0
+        if not resized_images_to_evict:
+            break
+        stats.bytes_freed += _delete_resized_images(session, resized_images_to_evict)
+        stats.resized_images += len(resized_images_to_evict)
+    logging.info("Evicted %s images", stats.resized_images)
+    return stats
+
+
+def _delete_source_images(session: Session, source_images_to_delete: list) -> int:
+    """
+    :return: the number of bytes freed
+    """
+    bytes_freed = 0
+    for source_image in source_images_to_delete:
+        bytes_freed += _delete_file(
+            source_image.file, f"{source_image.url}: {source_image.file}"
+        )
+        session.delete(source_image)
     session.commit()
+    return bytes_freed
+
+
+def purge_source_images(
+    session: Session,
+    max_age_seconds: int = None,
+    max_bytes: int = None,
+    batch_size: int = None,
+) -> PurgeStats:
+    """
+    Delete source image data from the db and the disk,
+    for source images downloaded before max_age_seconds ago,
+    then for the oldest source images, until the remaining ones
+    take up at most max_bytes
+
+    The source images are deleted in batches of batch_size, each in its own transaction.
+
+    :return: the number of deleted source images and of bytes freed
+    """
+    datetime_limit = datetime.datetime.now() - datetime.timedelta(
+        seconds=max_age_seconds if max_age_seconds else settings.source_cache_validity_s
+    )
+    batch_size = batch_size or settings.cache_purge_batch_size
+    logging.info("Deleting source images downloaded before %s", datetime_limit)
+    stats = PurgeStats()
+    while expired_source_images := (
+        session.query(models.SourceImage)
+        .filter(models.SourceImage.datetime <= datetime_limit)
+        .order_by(models.SourceImage.id)
+        .limit(batch_size)
+        .all()
+    ):
+        stats.bytes_freed += _delete_source_images(session, expired_source_images)
+        stats.source_images += len(expired_source_images)
+    logging.info("Deleted %s source images", stats.source_images)
+
+    max_bytes = max_bytes if max_bytes is not None else settings.source_cache_max_bytes
+    total_bytes = session.query(func.sum(models.SourceImage.file_size)).scalar() or 0
+    logging.info(
+        "Evicting source images to reduce the cache from %s to %s bytes",
+        total_bytes,
+        max_bytes,
+    )
+    evicted_source_images = 0
+    while total_bytes > max_bytes:
+        source_images_to_evict = []
+        for source_image in (
+            session.query(models.SourceImage)
+            .order_by(models.SourceImage.datetime, models.SourceImage.id)
+            .limit(batch_size)
+        ):
+            if total_bytes <= max_bytes:
+                break
+            source_images_to_evict.append(source_image)
+            total_bytes -= source_image.file_size or 0
+        if not source_images_to_evict:
+            break
+        stats.bytes_freed += _delete_source_images(session, source_images_to_evict)
+        evicted_source_images += len(source_images_to_evict)
+    logging.info("Evicted %s source images", evicted_source_images)
+    stats.source_images += evicted_source_images
+    return stats
 
 
 if __name__ == "__main__":
@@ -64,7 +426,16 @@ if __name__ == "__main__":
         default=settings.cache_validity_s,
         help="max age in seconds to keep in the database. Default is %(default)s",
     )
+    parser.add_argument(
+        "--max-bytes",
+        dest="max_bytes",
+        type=int,
+        default=settings.cache_max_bytes,
+        help="max size in bytes of the resized images, the least recently used ones "
+        "being deleted first. Default is %(default)s",
+    )
     options = parser.parse_args()
     models.create_db()
-    with SessionLocal() as db:
-        purge_old_images(db, options.max_age)
+    # Wait for a scheduled purge by a running server to finish
+    with file_lock(_get_lock_path()), SessionLocal() as db:
+        purge(db, options.max_age, options.max_bytes)
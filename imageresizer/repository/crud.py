@@ -5,9 +5,10 @@ import dataclasses
 from datetime import datetime
 from enum import Enum
 
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 
-from imageresizer.repository import models
+from imageresizer.repository import lookupkey, models
 
 
 class ImageFormat(Enum):
@@ -47,6 +48,55 @@ class ResizedImageLookup:
     scale_type: ScaleType = None
 
 
+@dataclasses.dataclass
+class OriginValidators:
+    """
+    Origin server fields used to revalidate a cached image
+    """
+
+    etag: str | None = None
+    last_modified: str | None = None
+    max_age: int | None = None
+
+
+def _set_origin_validators(db_image, validators: OriginValidators | None):
+    validators = validators or OriginValidators()
+    db_image.origin_etag = validators.etag
+    db_image.origin_last_modified = validators.last_modified
+    db_image.origin_max_age = validators.max_age
+
+
+def get_origin_validators(db_image) -> OriginValidators:
+    """
+    :return: the origin validators stored for the given resized image or source image
+    """
+    return OriginValidators(
+        etag=db_image.origin_etag,
+        last_modified=db_image.origin_last_modified,
+        max_age=db_image.origin_max_age,
+    )
+
+
+def get_lookup_key(lookup: ResizedImageLookup) -> str:
+    """
+    :return: the key which uniquely identifies the resized image, in the database
+    and in the caches
+    """
+    return lookupkey.get_lookup_key(
+        lookup.url,
+        lookup.width,
+        lookup.height,
+        lookup.image_format.value if lookup.image_format else None,
+        lookup.scale_type.value if lookup.scale_type else None,
+    )
+
+
+def _query_resized_image(session: Session, lookup: ResizedImageLookup):
+    return session.query(models.ResizedImage).filter(
+        models.ResizedImage.lookup_key == get_lookup_key(lookup)
+    )
+
+
 def get_resized_image(
     session: Session, lookup: ResizedImageLookup
 ) -> models.ResizedImage:
@@ -54,54 +104,167 @@ def get_resized_image(
     Read the resized image with the matching url, width, height, and image format,
     from the database, if it exists
     """
-    return (
-        session.query(models.ResizedImage)
-        .filter(
-            models.ResizedImage.url == lookup.url,
-            models.ResizedImage.width == lookup.width,
-            models.ResizedImage.height == lookup.height,
-            models.ResizedImage.image_format == lookup.image_format.value
-            if lookup.image_format
-            else None,
-            models.ResizedImage.scale_type == lookup.scale_type.value,
-        )
-        .first()
-    )
+    return _query_resized_image(session, lookup).first()
+
+
+# The insert constructs of the supported databases, which support upserts
+_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
 
 
+def _get_insert(session: Session):
+    """
+    :return: the insert construct of the database's dialect, which supports upserts. The
+    other databases are rejected when the engine is created
+    """
+    return _INSERTS[session.get_bind().dialect.name]
+
+
+# pylint: disable=too-many-arguments
 def create_resized_image(
     session: Session,
     lookup: ResizedImageLookup,
     file: str,
     mime_type: str,
+    content_hash: str = None,
+    file_size: int = None,
+    validators: OriginValidators = None,
+    commit: bool = True,
 ) -> models.ResizedImage:
     """
-    Create the resized image in the database
+    Create the resized image in the database, or update it if another worker created it
+    in the meantime, in one statement.
+
+    :param commit: if False, only add the resized image to the session's transaction,
+    so that several changes can be committed in one transaction
     """
-    db_resized_image = models.ResizedImage(
+    now = datetime.now()
+    validators = validators or OriginValidators()
+    values = {
+        "file": file,
+        "mime_type": mime_type,
+        "content_hash": content_hash,
+        "file_size": file_size,
+        "datetime": now,
+        "last_accessed": now,
+        "origin_etag": validators.etag,
+        "origin_last_modified": validators.last_modified,
+        "origin_max_age": validators.max_age,
+    }
+    insert = _get_insert(session)(models.ResizedImage).values(
+        lookup_key=get_lookup_key(lookup),
         url=lookup.url,
         width=lookup.width,
         height=lookup.height,
         image_format=lookup.image_format.value if lookup.image_format else None,
         scale_type=lookup.scale_type.value,
-        file=file,
-        mime_type=mime_type,
-        datetime=datetime.now(),
+        **values,
     )
-    session.add(db_resized_image)
-    session.commit()
-    session.refresh(db_resized_image)
+    session.execute(
+        insert.on_conflict_do_update(index_elements=["lookup_key"], set_=values)
+    )
+    db_resized_image = _query_resized_image(session, lookup).populate_existing().first()
+    if commit:
+        session.commit()
     return db_resized_image
 
 
-def update_resized_image(
-    session: Session, db_resized_image: models.ResizedImage, file: str
+def refresh_resized_image(
+    session: Session,
+    db_resized_image: models.ResizedImage,
+    validators: OriginValidators = None,
+    commit: bool = True,
 ) -> models.ResizedImage:
     """
-    Update the resized image's file and timestamp in the database
+    Update the resized image's timestamp and origin validators in the database,
+    when the origin image is unchanged
     """
-    db_resized_image.file = file
     db_resized_image.datetime = datetime.now()
-    session.commit()
-    session.refresh(db_resized_image)
+    db_resized_image.last_accessed = db_resized_image.datetime
+    _set_origin_validators(db_resized_image, validators)
+    if commit:
+        session.commit()
+        session.refresh(db_resized_image)
     return db_resized_image
+
+
+def get_referenced_files(session: Session, files: set[str]) -> set[str]:
+    """
+    :return: the files, among the given ones, which are used by resized images
+    """
+    return {
+        db_resized_image.file
+        for db_resized_image in session.query(models.ResizedImage.file)
+        .filter(models.ResizedImage.file.in_(files))
+        .distinct()
+    }
+
+
+def touch_resized_image(
+    session: Session, resized_image_id: int, last_accessed: datetime
+):
+    """
+    Update the last access time of the resized image with the given id,
+    without loading it
+    """
+    session.query(models.ResizedImage).filter(
+        models.ResizedImage.id == resized_image_id
+    ).update(
+        {models.ResizedImage.last_accessed: last_accessed}, synchronize_session=False
+    )
+    session.commit()
+
+
+def get_source_image(session: Session, url: str) -> models.SourceImage:
+    """
+    Read the source image with the given url from the database, if it exists
+    """
+    return (
+        session.query(models.SourceImage).filter(models.SourceImage.url == url).first()
+    )
+
+
+def create_source_image(
+    session: Session,
+    url: str,
+    file: str,
+    file_size: int,
+    validators: OriginValidators = None,
+) -> models.SourceImage:
+    """
+    Create the source image in the database, or update it if another worker created it
+    in the meantime, in one statement
+    """
+    validators = validators or OriginValidators()
+    values = {
+        "file": file,
+        "file_size": file_size,
+        "datetime": datetime.now(),
+        "origin_etag": validators.etag,
+        "origin_last_modified": validators.last_modified,
+        "origin_max_age": validators.max_age,
+    }
+    insert = _get_insert(session)(models.SourceImage).values(url=url, **values)
+    session.execute(insert.on_conflict_do_update(index_elements=["url"], set_=values))
+    session.commit()
+    return (
+        session.query(models.SourceImage)
+        .filter(models.SourceImage.url == url)
+        .populate_existing()
+        .first()
+    )
+
+
+def refresh_source_image(
+    session: Session,
+    db_source_image: models.SourceImage,
+    validators: OriginValidators = None,
+) -> models.SourceImage:
+    """
+    Update the source image's timestamp and origin validators in the database,
+    when the origin image is unchanged
+    """
+    db_source_image.datetime = datetime.now()
+    _set_origin_validators(db_source_image, validators)
+    session.commit()
+    session.refresh(db_source_image)
+    return db_source_image
@@ -1,15 +1,69 @@
 """
-Database configuration for the sqlite image resizer database
+Database configuration for the image resizer database: a sqlite file in the cache dir by
+default, or a database shared by several servers, like PostgreSQL
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from imageresizer.settings import settings
 
-SQLALCHEMY_DATABASE_URL = f"sqlite:///{settings.cache_dir}/image-resizer.db"
+# The databases whose dialect supports the upserts of the cache
+_SUPPORTED_BACKENDS = {"postgresql", "sqlite"}
+
+
+def _get_backend_name(url: str) -> str:
+    """
+    :param url: the url of the database
+    :return: the name of the database's backend
+    :raise RuntimeError: if the database isn't supported, so that the server fails to start
+    instead of failing each request
+    """
+    backend_name = make_url(url).get_backend_name()
+    if backend_name not in _SUPPORTED_BACKENDS:
+        raise RuntimeError(
+            f"Unsupported database {backend_name}: DATABASE_URL must be a sqlite or "
+            "postgresql url"
+        )
+    return backend_name
+
+
+SQLALCHEMY_DATABASE_URL = (
+    settings.database_url or f"sqlite:///{settings.cache_dir}/image-resizer.db"
+)
+_is_sqlite = _get_backend_name(SQLALCHEMY_DATABASE_URL) == "sqlite"
+# Connections are pooled, instead of opening a new connection for every session,
+# which is the default for sqlite files
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if _is_sqlite else {},
+    poolclass=QueuePool,
+    pool_size=settings.database_pool_size,
+    max_overflow=settings.database_max_overflow,
+    # A server database may close idle connections
+    pool_pre_ping=not _is_sqlite,
 )
+
+
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    """
+    Configure each new connection so that the workers and the purge can use the database
+    concurrently: in WAL mode, readers don't block the writer and the writer doesn't block
+    readers, and a writer waits for another one instead of failing with "database is locked".
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}")
+    cursor.close()
+
+
+if _is_sqlite:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
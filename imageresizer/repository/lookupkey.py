@@ -0,0 +1,57 @@
+"""
+Deterministic keys which identify resized images
+"""
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    :return: the url, with the parts which don't change the resource it identifies
+    normalized: the scheme and host are lowercased, the default port and the fragment
+    are removed, and an empty http path becomes /. The query is kept as is, since some
+    servers depend on the order of its parameters.
+    """
+    parts = urlsplit(url)
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    if port is not None and port != _DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo = f"{userinfo}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    path = parts.path
+    if not path and scheme in _DEFAULT_PORTS:
+        path = "/"
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+def get_lookup_key(
+    url: str,
+    width: int | None,
+    height: int | None,
+    image_format: int | None,
+    scale_type: int | None,
+) -> str:
+    """
+    :return: a fixed width digest of the canonicalized url and of the resize parameters,
+    as they are stored in the database, which uniquely identifies a resized image
+    """
+    fields = [
+        canonicalize_url(url),
+        str(width or 0),
+        str(height or 0),
+        str(image_format or ""),
+        str(scale_type or ""),
+    ]
+    return hashlib.sha256("\0".join(fields).encode()).hexdigest()
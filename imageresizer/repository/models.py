@@ -2,9 +2,14 @@
 ORM model for the image-resizer database
 """
 
-from sqlalchemy import Column, Integer, String, Index, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, inspect, text
+from sqlalchemy.orm import Session
 
 from imageresizer.repository.database import Base, engine
+from imageresizer.repository.lookupkey import get_lookup_key
+
+# The batch size of data migrations
+_MIGRATION_BATCH_SIZE = 1000
 
 # pylint: disable=too-few-public-methods
 
@@ -16,30 +21,134 @@ class ResizedImage(Base):
 
     __tablename__ = "resized_images"
     id = Column(Integer, primary_key=True, index=True)
+    # A digest of the fields below, which identifies the resized image. See lookupkey.
+    lookup_key = Column(String(64), unique=True, index=True)
     url = Column(String)
     width = Column(Integer)
     height = Column(Integer)
     # Would be better to have an enum for vaild image_format values
     image_format = Column(Integer)
     scale_type = Column(Integer)
-    file = Column(String)
+    # Identical resized images share the same file: the file is deleted with the
+    # last resized image referencing it
+    file = Column(String, index=True)
     mime_type = Column(String)
-    datetime = Column(DateTime)
+    content_hash = Column(String)
+    file_size = Column(Integer)
+    datetime = Column(DateTime, index=True)
+    # Only updated once per last_access_update_interval_s, to limit writes
+    last_accessed = Column(DateTime, index=True)
+    origin_etag = Column(String)
+    origin_last_modified = Column(String)
+    origin_max_age = Column(Integer)
+
+
+class SourceImage(Base):
+    """
+    Model for a source image downloaded from its origin
+    """
 
+    __tablename__ = "source_images"
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String, unique=True, index=True)
+    file = Column(String)
+    file_size = Column(Integer)
+    datetime = Column(DateTime, index=True)
+    origin_etag = Column(String)
+    origin_last_modified = Column(String)
+    origin_max_age = Column(Integer)
 
-Index(
-    "resize-image-index",
-    ResizedImage.url,
-    ResizedImage.width,
-    ResizedImage.height,
-    ResizedImage.image_format,
-    ResizedImage.scale_type,
-    unique=True,
-)
+
+def _add_missing_columns():
+    """
+    Add the columns which were added to the models after the database was created
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+
+
+def _add_missing_indexes():
+    """
+    Add the indexes which were added to the models after the database was created
+    """
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+
+def _fill_missing_lookup_keys():
+    """
+    Set the lookup key of the resized images created before it was stored, deleting the
+    duplicate resized images which the url index didn't prevent, keeping the latest one.
+    """
+    with Session(engine) as session:
+        while resized_images := (
+            session.query(
+                ResizedImage.id,
+                ResizedImage.url,
+                ResizedImage.width,
+                ResizedImage.height,
+                ResizedImage.image_format,
+                ResizedImage.scale_type,
+            )
+            .filter(ResizedImage.lookup_key.is_(None))
+            .order_by(ResizedImage.id.desc())
+            .limit(_MIGRATION_BATCH_SIZE)
+            .all()
+        ):
+            lookup_keys = {
+                resized_image.id: get_lookup_key(
+                    resized_image.url,
+                    resized_image.width,
+                    resized_image.height,
+                    resized_image.image_format,
+                    resized_image.scale_type,
+                )
+                for resized_image in resized_images
+            }
+            used_lookup_keys = {
+                lookup_key
+                for (lookup_key,) in session.query(ResizedImage.lookup_key).filter(
+                    ResizedImage.lookup_key.in_(lookup_keys.values())
+                )
+            }
+            duplicate_ids = []
+            updates = []
+            for resized_image_id, lookup_key in lookup_keys.items():
+                if lookup_key in used_lookup_keys:
+                    duplicate_ids.append(resized_image_id)
+                else:
+                    used_lookup_keys.add(lookup_key)
+                    updates.append({"id": resized_image_id, "lookup_key": lookup_key})
+            session.query(ResizedImage).filter(
+                ResizedImage.id.in_(duplicate_ids)
+            ).delete(synchronize_session=False)
+            session.bulk_update_mappings(ResizedImage, updates)
+            session.commit()
 
 
 def create_db():
     """
-    Creates the database if it doesn't already exist
+    Creates the database if it doesn't already exist,
+    and migrates an existing database: adds the missing columns, fills in the lookup keys,
+    replaces the url index with the lookup key index, and adds the missing indexes
     """
     Base.metadata.create_all(bind=engine, checkfirst=True)
+    _add_missing_columns()
+    _fill_missing_lookup_keys()
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX IF EXISTS "resize-image-index"'))
+    _add_missing_indexes()
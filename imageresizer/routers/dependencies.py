@@ -1,6 +1,7 @@
 """
 Provides dependencies for routers
 """
+import hmac
 from http import HTTPStatus
 from urllib.parse import urlparse
 
@@ -11,6 +12,7 @@ from imageresizer.repository.database import SessionLocal
 from imageresizer.settings import settings
 
 CLIENT_HEADER = "x-image-resizer"
+PROFILE_HEADER = "x-image-resizer-profile"
 
 
 def get_session():
@@ -33,6 +35,18 @@ async def client_headers():
     }
 
 
+async def profiling_enabled(request: Request) -> bool:
+    """
+    Provides whether the request must be profiled: all the requests are if profiling is
+    enabled, otherwise only those with the profile header set to the profile token
+    """
+    if settings.profile_requests:
+        return True
+    return bool(settings.profile_token) and hmac.compare_digest(
+        request.headers.get(PROFILE_HEADER, ""), settings.profile_token
+    )
+
+
 async def validate_not_recursive(request: Request):
     """
     Validate that a request we received didn't come from our own server
@@ -43,30 +57,40 @@ async def validate_not_recursive(request: Request):
         )
 
 
+def is_supported_schema(url: str) -> bool:
+    """
+    :return: True if the image url uses a supported schema
+    """
+    return urlparse(url).scheme in settings.supported_image_url_schemas
+
+
+def is_allowed_domain(url: str) -> bool:
+    """
+    :return: True if the domain of the image url is allowed
+    """
+    hostname = urlparse(url).hostname
+    return hostname not in settings.denied_domains and (
+        hostname in settings.allowed_domains or not settings.allowed_domains
+    )
+
+
 async def validate_supported_schema(request: Request):
     """
     Validate that the image_url uses a supported schema
     """
-    if url := request.query_params.get("image_url"):
-        parsed_url = urlparse(url)
-        if parsed_url.scheme not in settings.supported_image_url_schemas:
-            raise HTTPException(
-                status_code=HTTPStatus.BAD_REQUEST,
-                detail=f"Unsupported schema {parsed_url.scheme} for image url",
-            )
+    if (url := request.query_params.get("image_url")) and not is_supported_schema(url):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Unsupported schema {urlparse(url).scheme} for image url",
+        )
 
 
 async def validate_allowed_domain(request: Request):
     """
     Validate that the domain of the image_url is allowed
     """
-    if url := request.query_params.get("image_url"):
-        parsed_url = urlparse(url)
-        if parsed_url.hostname in settings.denied_domains or (
-            parsed_url.hostname not in settings.allowed_domains
-            and settings.allowed_domains
-        ):
-            raise HTTPException(
-                status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
-                detail=f"Unsupported domain {parsed_url.hostname} for image url",
-            )
+    if (url := request.query_params.get("image_url")) and not is_allowed_domain(url):
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail=f"Unsupported domain {urlparse(url).hostname} for image url",
+        )
@@ -1,22 +1,33 @@
 """
 Resize router
 """
+import math
+from contextlib import contextmanager
 from http import HTTPStatus
 from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
 
 from fastapi import APIRouter, HTTPException
-from fastapi.params import Query, Depends
+from fastapi.encoders import jsonable_encoder
+from fastapi.params import Query, Depends, Body
+from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
-from starlette.responses import FileResponse
+from starlette.requests import Request
 
 from imageresizer.routers.dependencies import (
     get_session,
+    profiling_enabled,
     validate_not_recursive,
     client_headers,
     validate_allowed_domain,
     validate_supported_schema,
 )
+from imageresizer import profiling
+from imageresizer.routers.responses import image_response
 from imageresizer.service import service
+from imageresizer.service.fetcher import OriginImageRejectedError
+from imageresizer.service.origins import OriginUnavailableError
+from imageresizer.service.resizer import ResizeQueueFullError
 from imageresizer.service.types import ImageFormat, ScaleType, ResizedImageLookup
 
 router = APIRouter(
@@ -28,11 +39,78 @@ router = APIRouter(
 )
 
 
+MAX_BATCH_SIZE = 16
+
+
+# pylint: disable=too-few-public-methods
+class ResizeSpec(BaseModel):
+    """
+    The size and format of one resized image of a batch
+    """
+
+    width: int | None = Field(default=None, gt=0, lt=1024)
+    height: int | None = Field(default=None, gt=0, lt=1024)
+    image_format: ImageFormat | None = None
+    scale_type: ScaleType = ScaleType.FIT_XY
+
+
+class ResizedImageUrl(ResizeSpec):
+    """
+    The url of one resized image of a batch
+    """
+
+    url: str
+
+
+@contextmanager
+def _translate_errors():
+    """
+    Convert errors resizing an image to error responses
+    """
+    try:
+        yield
+    except HTTPError as error:
+        raise HTTPException(
+            status_code=error.status, detail="Error retrieving image"
+        ) from error
+    except URLError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail="Invalid image url"
+        ) from error
+    except OriginImageRejectedError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=str(error)
+        ) from error
+    except OriginUnavailableError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=str(error),
+            headers={"Retry-After": str(math.ceil(error.retry_after_s))},
+        ) from error
+    except TimeoutError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.GATEWAY_TIMEOUT,
+            detail="Timed out retrieving image",
+        ) from error
+    except ResizeQueueFullError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="Too many images are being resized",
+        ) from error
+    except ValueError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Didn't understand your request parameters",
+        ) from error
+
+
 # pylint: disable=too-many-arguments
 @router.get(
     "/resize",
     responses={
         200: {
+            "description": "The resized image, with ETag, Last-Modified, and Cache-Control "
+            "headers",
             "content": {
                 "image/png": {},
                 "image/gif": {},
@@ -42,15 +120,27 @@ router = APIRouter(
                 "application/pdf": {},
             },
         },
+        304: {
+            "description": "The resized image matches the If-None-Match or "
+            "If-Modified-Since request header",
+        },
         400: {
             "description": "Invalid request parameters",
         },
         422: {
             "description": "The request parameters were understood, but could not be processed",
         },
+        503: {
+            "description": "Too many images are being resized, or the origin server of "
+            "the image is unavailable, retry later",
+        },
+        504: {
+            "description": "The origin server of the image didn't respond in time",
+        },
     },
 )
 async def resize(
+    request: Request,
     image_url: str,
     width: int | None = Query(default=None, gt=0, lt=1024),
     height: int | None = Query(default=None, gt=0, lt=1024),
@@ -59,6 +149,7 @@ async def resize(
     user_agent: str | None = "image-resizer",
     db_session: Session = Depends(get_session),
     headers: dict = Depends(client_headers),
+    profile: bool = Depends(profiling_enabled),
 ):
     """
     Endpoint to resize an image.
@@ -76,31 +167,99 @@ async def resize(
 
     :param user_agent: the User-Agent header value to pass to the request to get the image
 
-    :return: a Response containing the new image
+    :return: a Response containing the new image, or an empty 304 response if the
+    If-None-Match or If-Modified-Since request header shows the client already has it
     """
-    try:
-        resized_image = service.resize(
-            db_session,
-            headers={**headers, "User-Agent": user_agent},
-            lookup=ResizedImageLookup(
+    with _translate_errors():
+        async with profiling.trace_request(
+            profile,
+            url=image_url,
+            width=width,
+            height=height,
+            image_format=image_format,
+            scale_type=scale_type,
+        ):
+            resized_image = await service.resize(
+                db_session,
+                headers={**headers, "User-Agent": user_agent},
+                lookup=ResizedImageLookup(
+                    url=image_url,
+                    width=width,
+                    height=height,
+                    image_format=image_format,
+                    scale_type=scale_type,
+                ),
+            )
+    return image_response(request, resized_image)
+
+
+@router.post(
+    "/resize/batch",
+    response_model=list[ResizedImageUrl],
+    responses={
+        400: {
+            "description": "Invalid request parameters",
+        },
+        422: {
+            "description": "The request parameters were understood, but could not be processed",
+        },
+        503: {
+            "description": "Too many images are being resized, or the origin server of "
+            "the image is unavailable, retry later",
+        },
+        504: {
+            "description": "The origin server of the image didn't respond in time",
+        },
+    },
+)
+async def resize_batch(
+    request: Request,
+    image_url: str,
+    specs: list[ResizeSpec] = Body(min_items=1, max_items=MAX_BATCH_SIZE),
+    user_agent: str | None = "image-resizer",
+    db_session: Session = Depends(get_session),
+    headers: dict = Depends(client_headers),
+    profile: bool = Depends(profiling_enabled),
+):
+    """
+    Endpoint to resize an image to several sizes at once, for example for a srcset.
+
+    The image is downloaded and decoded only once.
+
+    :param image_url: the url of the image to resize
+
+    :param specs: the size, format, and scale type of each resized image
+
+    :param user_agent: the User-Agent header value to pass to the request to get the image
+
+    :return: the urls of the resized images, in the order of the specs. The resized images
+    are already in the cache.
+    """
+    with _translate_errors():
+        async with profiling.trace_request(profile, url=image_url, specs=len(specs)):
+            await service.resize_batch(
+                db_session,
+                headers={**headers, "User-Agent": user_agent},
                 url=image_url,
-                width=width,
-                height=height,
-                image_format=image_format,
-                scale_type=scale_type,
+                lookups=[
+                    ResizedImageLookup(
+                        url=image_url,
+                        width=spec.width,
+                        height=spec.height,
+                        image_format=spec.image_format,
+                        scale_type=spec.scale_type,
+                    )
+                    for spec in specs
+                ],
+            )
+    resize_url = request.url_for("resize")
+    return [
+        ResizedImageUrl(
+            **spec.dict(),
+            url=f"{resize_url}?"
+            + urlencode(
+                {"image_url": image_url, **jsonable_encoder(spec, exclude_none=True)}
             ),
         )
-        return FileResponse(resized_image.file, media_type=resized_image.mime_type)
-    except HTTPError as error:
-        raise HTTPException(
-            status_code=error.status, detail="Error retrieving image"
-        ) from error
-    except URLError as error:
-        raise HTTPException(
-            status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail="Invalid image url"
-        ) from error
-    except ValueError as error:
-        raise HTTPException(
-            status_code=HTTPStatus.BAD_REQUEST,
-            detail="Didn't understand your request parameters",
-        ) from error
+        for spec in specs
+    ]
@@ -0,0 +1,286 @@
+"""
+Build the HTTP responses for resized images, with caching headers
+"""
+import os
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from http import HTTPStatus
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from imageresizer.service.types import ImageResponseData
+from imageresizer.settings import settings
+from imageresizer.storage.storage import get_storage
+
+# The ASGI extension with which the server sends a file itself, with sendfile
+ZEROCOPY_SEND = "http.response.zerocopysend"
+# The size of the chunks in which local files are sent, when the server can't send them
+# itself: large chunks take fewer round trips to the thread pool
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+class UnsatisfiableRangeError(Exception):
+    """
+    The requested range is outside of the file
+    """
+
+
+def _get_etag(resized_image: ImageResponseData) -> str | None:
+    if resized_image.content_hash is None:
+        return None
+    return f'"{resized_image.content_hash}"'
+
+
+def _get_cache_headers(resized_image: ImageResponseData) -> dict[str, str]:
+    headers = {}
+    if etag := _get_etag(resized_image):
+        headers["etag"] = etag
+    if resized_image.last_modified is not None:
+        headers["last-modified"] = format_datetime(
+            resized_image.last_modified.astimezone(), usegmt=True
+        )
+    if resized_image.expires is not None:
+        max_age = int((resized_image.expires - datetime.now()).total_seconds())
+        headers["cache-control"] = f"public, max-age={max(max_age, 0)}"
+    return headers
+
+
+def _etag_matches(if_none_match: str, etag: str | None) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    if etag is None:
+        return False
+    # If-None-Match uses the weak comparison: W/ prefixes are ignored
+    return etag in (
+        candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")
+    )
+
+
+def _not_modified_since(if_modified_since: str, last_modified: datetime | None) -> bool:
+    if last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    # HTTP dates have a resolution of one second
+    return last_modified.astimezone().replace(microsecond=0) <= since
+
+
+def is_not_modified(request: Request, resized_image: ImageResponseData) -> bool:
+    """
+    :return: True if the client's conditional request headers show that its copy of the
+    resized image is still current.  If-None-Match takes precedence over If-Modified-Since.
+    """
+    if if_none_match := request.headers.get("if-none-match"):
+        return _etag_matches(if_none_match, _get_etag(resized_image))
+    if if_modified_since := request.headers.get("if-modified-since"):
+        return _not_modified_since(if_modified_since, resized_image.last_modified)
+    return False
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    :param range_header: the value of the Range request header
+    :param size: the size of the file, in bytes
+    :return: the offsets of the first and last bytes of the requested range, or None if the
+    header must be ignored: it's invalid, or it requests several ranges
+    :raise UnsatisfiableRangeError: if the range is outside of the file
+    """
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in byte_range:
+        return None
+    first, _, last = byte_range.strip().partition("-")
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start is None:
+        # The last bytes of the file
+        if end is None:
+            return None
+        if end <= 0 or size == 0:
+            raise UnsatisfiableRangeError(range_header)
+        return max(size - end, 0), size - 1
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        raise UnsatisfiableRangeError(range_header)
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def _if_range_matches(if_range: str, headers: dict[str, str]) -> bool:
+    # The range is only sent if the client's partial copy is of the same resized image
+    if if_range.startswith('"'):
+        return if_range == headers.get("etag")
+    return if_range == headers.get("last-modified")
+
+
+class LocalFileResponse(Response):
+    """
+    A response with a range of a file on the local disk. The server sends the file itself,
+    with sendfile, if it supports the zero-copy send extension of ASGI.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        path: str,
+        start: int,
+        end: int,
+        status_code: int,
+        media_type: str,
+        headers: dict[str, str],
+    ):
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+        super().__init__(
+            status_code=status_code,
+            media_type=media_type,
+            headers={**headers, "content-length": str(self.count)},
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        with await run_in_threadpool(open, self.path, "rb") as file:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                }
+            )
+            if ZEROCOPY_SEND in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": ZEROCOPY_SEND,
+                        "file": file,
+                        "offset": self.start,
+                        "count": self.count,
+                        "more_body": False,
+                    }
+                )
+                return
+            offset = self.start
+            remaining = self.count
+            while True:
+                chunk = await run_in_threadpool(
+                    os.pread, file.fileno(), min(FILE_CHUNK_SIZE, remaining), offset
+                )
+                offset += len(chunk)
+                remaining -= len(chunk)
+                more_body = bool(chunk) and remaining > 0
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": more_body,
+                    }
+                )
+                if not more_body:
+                    return
+
+
+def _delegated_response(
+    local_path: str, resized_image: ImageResponseData, headers: dict[str, str]
+) -> Response | None:
+    """
+    :return: an empty response telling the proxy in front of the server to send the file,
+    and to handle the Range request headers, or None if the proxy can't reach the file
+    """
+    if settings.sendfile_header == "x-accel-redirect":
+        # The internal location of the proxy which serves the cache image dir
+        try:
+            relative_path = Path(local_path).relative_to(settings.cache_image_dir)
+        except ValueError:
+            # Saved in another cache dir, before the cache dir setting changed
+            return None
+        location = f"{settings.sendfile_prefix.rstrip('/')}/{relative_path.as_posix()}"
+    else:
+        location = os.path.abspath(local_path)
+    return Response(
+        media_type=resized_image.mime_type,
+        headers={**headers, settings.sendfile_header: location},
+    )
+
+
+def image_response(request: Request, resized_image: ImageResponseData) -> Response:
+    """
+    :return: a response with the resized image, or the requested range of it, or an empty
+    304 response if the client already has it. Images on the local disk are sent by the
+    server, or by the proxy in front of it if enabled, and images which aren't in memory or
+    on the local disk are streamed from the storage.
+    """
+    headers = _get_cache_headers(resized_image)
+    if is_not_modified(request, resized_image):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    storage = get_storage()
+    local_path = None
+    if resized_image.content is not None:
+        size = len(resized_image.content)
+    elif local_path := storage.get_local_path(resized_image.file):
+        if settings.sendfile_header and (
+            delegated_response := _delegated_response(
+                local_path, resized_image, headers
+            )
+        ):
+            return delegated_response
+        size = resized_image.file_size
+        if size is None:
+            size = os.path.getsize(local_path)
+    else:
+        size = resized_image.file_size
+
+    headers["accept-ranges"] = "bytes"
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if (
+        range_header
+        and size is not None
+        and (if_range is None or _if_range_matches(if_range, headers))
+    ):
+        try:
+            byte_range = parse_range(range_header, size)
+        except UnsatisfiableRangeError:
+            return Response(
+                status_code=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={**headers, "content-range": f"bytes */{size}"},
+            )
+    status_code = HTTPStatus.OK
+    if byte_range is not None:
+        status_code = HTTPStatus.PARTIAL_CONTENT
+        headers["content-range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+    start, end = byte_range or (0, None)
+
+    if resized_image.content is not None:
+        return Response(
+            resized_image.content[start : None if end is None else end + 1],
+            status_code=status_code,
+            media_type=resized_image.mime_type,
+            headers=headers,
+        )
+    if local_path:
+        return LocalFileResponse(
+            local_path,
+            start,
+            size - 1 if end is None else end,
+            status_code=status_code,
+            media_type=resized_image.mime_type,
+            headers=headers,
+        )
+    if size is not None:
+        headers["content-length"] = str(size if end is None else end - start + 1)
+    return StreamingResponse(
+        storage.stream(resized_image.file, start, end),
+        status_code=status_code,
+        media_type=resized_image.mime_type,
+        headers=headers,
+    )
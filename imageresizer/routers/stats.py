@@ -0,0 +1,43 @@
+"""
+Stats router
+"""
+from fastapi import APIRouter
+from prometheus_client import CONTENT_TYPE_LATEST
+from starlette.responses import Response
+
+from imageresizer import metrics, purge
+from imageresizer.service import service
+from imageresizer.service.hotcache import HotCacheStats
+
+router = APIRouter()
+
+
+@router.get("/stats/hot-cache", response_model=HotCacheStats)
+async def hot_cache_stats():
+    """
+    Endpoint to get the usage statistics of the in-memory cache of this worker.
+
+    :return: the hits and misses, and the number of entries and memory used by the cache
+    """
+    return service.hot_cache.stats
+
+
+@router.get("/stats/purge", response_model=purge.PurgeStats | None)
+async def purge_stats():
+    """
+    Endpoint to get the statistics of the last scheduled purge of the cache, by any worker.
+
+    :return: what the purge deleted, when it started, and how long it took,
+    or null if the cache wasn't purged yet
+    """
+    return purge.get_last_purge()
+
+
+@router.get("/metrics", response_class=Response)
+def get_metrics():
+    """
+    Endpoint to get the metrics of all the workers, in the Prometheus text format: the time
+    spent in each stage of the resize pipeline, the cache hits and misses, the bytes
+    downloaded and served, and what the purges deleted.
+    """
+    return Response(metrics.generate(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,47 @@
+"""
+Throttling of the updates of the last access time of resized images
+"""
+import datetime
+from collections import OrderedDict
+
+
+class AccessTracker:
+    """
+    Decides when the last access time of a resized image must be written to the database:
+    at most once per interval for each resized image, so that serving popular images doesn't
+    write to the database on every request.
+
+    The tracker is bounded: the resized images accessed least recently are forgotten, and their
+    next access is written again.
+    """
+
+    def __init__(self, interval_s: int, max_entries: int = 100_000):
+        """
+        :param interval_s: the minimum time between two updates of a resized image's last access
+        :param max_entries: the maximum number of resized images to remember
+        """
+        self._interval = datetime.timedelta(seconds=interval_s)
+        self._max_entries = max_entries
+        self._written: OrderedDict[int, datetime.datetime] = OrderedDict()
+
+    def is_due(self, resized_image_id: int, now: datetime.datetime) -> bool:
+        """
+        Record an access to a resized image.
+
+        :return: True if the access must be written to the database
+        """
+        last_written = self._written.get(resized_image_id)
+        if last_written is not None and now - last_written < self._interval:
+            self._written.move_to_end(resized_image_id)
+            return False
+        self._written[resized_image_id] = now
+        self._written.move_to_end(resized_image_id)
+        while len(self._written) > self._max_entries:
+            self._written.popitem(last=False)
+        return True
+
+    def clear(self):
+        """
+        Forget all the accesses
+        """
+        self._written.clear()
@@ -1,21 +1,28 @@
 """
 Animated image support
 """
+from typing import Iterator
 
 from PIL import Image
 from PIL.GifImagePlugin import GifImageFile
 
+from imageresizer.service import gifwriter
+from imageresizer.settings import settings
+
 Size = tuple[int, int]
 
 
 class AnimatedImage:
     """
     An image-like class with resize and save functions, for images containing image sequences
+
+    Frames are resized lazily, one at a time, while the image is being saved.
     """
 
     def __init__(self, source: GifImageFile):
         self._source = source
-        self._frames = []
+        self._size = source.size
+        self._box = None
 
     def resize(self, size: Size, box: tuple | None):
         """
@@ -24,20 +31,54 @@ class AnimatedImage:
         :param box: The region in the source image to resize
         :return: this instance
         """
-        for i in range(self._source.n_frames):
+        self._size = size
+        self._box = box
+        return self
+
+    @property
+    def n_frames(self) -> int:
+        """
+        :return: the number of frames of the resized image: the frames of the source image
+        exceeding the max frames or max pixels budget are dropped
+        """
+        pixels_budget_frames = settings.animated_image_max_pixels // max(
+            self._size[0] * self._size[1], 1
+        )
+        return max(
+            min(
+                self._source.n_frames,
+                settings.animated_image_max_frames,
+                pixels_budget_frames,
+            ),
+            1,
+        )
+
+    def frames(self) -> Iterator[Image.Image]:
+        """
+        :return: the resized frames of this image
+        """
+        for i in range(self.n_frames):
             self._source.seek(i)
-            self._frames.append(
-                self._source.resize(size, box=box, resample=Image.Resampling.BICUBIC)
+            frame = self._source.resize(
+                self._size, box=self._box, resample=Image.Resampling.BICUBIC
             )
-        return self
+            frame.info["disposal"] = self._source.disposal_method
+            yield frame
 
     def save(self, output_path: str, image_format: str):
         """
         Saves this image under the given filename and format.
         """
-        self._frames[0].save(
+        if image_format.upper() == "GIF":
+            with open(output_path, "wb") as output_file:
+                gifwriter.save_frames(self.frames(), output_file)
+            return
+
+        # The Pillow encoders for the other formats need all the frames at once
+        frames = self.frames()
+        next(frames).save(
             output_path,
-            append_images=self._frames[1:],
+            append_images=list(frames),
             format=image_format,
             save_all=True,
         )
@@ -0,0 +1,320 @@
+"""
+Retrieval of source images
+"""
+import asyncio
+import dataclasses
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.message import Message
+from http import HTTPStatus
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterator, Mapping
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import urlopen, Request
+
+import urllib3
+from PIL import Image, UnidentifiedImageError
+from urllib3 import exceptions as urllib3_exceptions
+from urllib3.response import HTTPResponse
+
+from imageresizer import metrics
+from imageresizer.service.origins import Origins
+from imageresizer.service.types import OriginValidators
+from imageresizer.settings import settings
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.fetch_max_workers, thread_name_prefix="fetch"
+)
+origins = Origins()
+
+# Connections to the origin servers are kept alive and reused by the requests of the worker.
+# The number of connections to each server is limited: a request waits for a connection to
+# be available rather than opening more.
+_http = urllib3.PoolManager(
+    num_pools=64,
+    maxsize=settings.fetch_max_connections_per_host,
+    block=True,
+    timeout=urllib3.Timeout(
+        connect=settings.fetch_connect_timeout_s, read=settings.fetch_read_timeout_s
+    ),
+    retries=urllib3.Retry(
+        total=settings.fetch_retries,
+        backoff_factor=settings.fetch_retry_backoff_s,
+        status_forcelist={
+            HTTPStatus.BAD_GATEWAY,
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            HTTPStatus.GATEWAY_TIMEOUT,
+        },
+        raise_on_status=False,
+        # The wait must stay shorter than the timeouts
+        respect_retry_after_header=False,
+    ),
+)
+_POOLED_SCHEMES = {"http", "https"}
+# The headers of urllib and of urllib3 responses
+_Headers = Message | Mapping[str, str]
+
+_MAX_AGE_PATTERN = re.compile(r"max-age\s*=\s*(\d+)")
+CHUNK_SIZE = 64 * 1024
+# Enough for the headers of most images, which give their format and dimensions
+_SNIFF_SIZE = 64 * 1024
+# Images whose header isn't in these first bytes are rejected, rather than downloaded
+_SNIFF_MAX_SIZE = 512 * 1024
+# Servers, and the file handler, use these types when they don't know the type of a file
+_GENERIC_CONTENT_TYPES = {
+    "application/octet-stream",
+    "binary/octet-stream",
+    "text/plain",
+}
+
+
+class OriginImageRejectedError(Exception):
+    """
+    Raised when the response of the origin server isn't an image which can be resized: it is
+    too large, it isn't an image, or it took too long to download
+    """
+
+
+@dataclasses.dataclass
+class OriginResponse:
+    """
+    The result of a request for an image to its origin server
+    """
+
+    # The image, in memory or in a temporary file, positioned at its start.
+    # None if the image wasn't modified since the provided validators.
+    content: BinaryIO | None
+    validators: OriginValidators
+    size: int = 0
+
+    @property
+    def not_modified(self) -> bool:
+        """
+        :return: True if the origin server indicated that the image didn't change
+        """
+        return self.content is None
+
+
+def _get_max_age(headers: _Headers) -> int | None:
+    cache_control = headers.get("Cache-Control")
+    if not cache_control:
+        return None
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    if match := _MAX_AGE_PATTERN.search(cache_control):
+        return int(match.group(1))
+    return None
+
+
+def _get_validators(headers: _Headers) -> OriginValidators:
+    return OriginValidators(
+        etag=headers.get("ETag"),
+        last_modified=headers.get("Last-Modified"),
+        max_age=_get_max_age(headers),
+    )
+
+
+def _get_conditional_headers(validators: OriginValidators | None) -> dict[str, str]:
+    conditional_headers = {}
+    if validators and validators.etag:
+        conditional_headers["If-None-Match"] = validators.etag
+    if validators and validators.last_modified:
+        conditional_headers["If-Modified-Since"] = validators.last_modified
+    return conditional_headers
+
+
+def _check_headers(headers: _Headers):
+    """
+    Reject the response before downloading its body if its headers show that it isn't an
+    image, or that it is too large
+    """
+    content_type = headers.get("Content-Type")
+    if content_type:
+        media_type = content_type.split(";")[0].strip().lower()
+        if (
+            not media_type.startswith("image/")
+            and media_type not in _GENERIC_CONTENT_TYPES
+        ):
+            raise OriginImageRejectedError(f"The url isn't an image: {media_type}")
+    content_length = headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        if int(content_length) > settings.fetch_max_bytes:
+            raise OriginImageRejectedError(
+                f"The image is larger than {settings.fetch_max_bytes} bytes"
+            )
+
+
+def _sniff(content: BinaryIO) -> bool:
+    """
+    Check the format and the dimensions of an image from its first bytes, without decoding it.
+
+    :param content: the beginning of the image, or all of it
+    :return: True if the image was identified, False if more bytes are needed
+    """
+    try:
+        with Image.open(content) as image:
+            width, height = image.size
+    except Image.DecompressionBombError as error:
+        raise OriginImageRejectedError(str(error)) from error
+    except (UnidentifiedImageError, OSError, SyntaxError, EOFError):
+        return False
+    if width * height > settings.source_image_max_pixels:
+        raise OriginImageRejectedError(
+            f"The image has more than {settings.source_image_max_pixels} pixels"
+        )
+    return True
+
+
+def _download(response) -> OriginResponse:
+    """
+    Stream the body of the response into a temporary file, which stays in memory if the image
+    is small. The download is stopped as soon as the image turns out to be too large.
+    """
+    _check_headers(response.headers)
+    deadline = time.monotonic() + settings.fetch_max_duration_s
+    content = SpooledTemporaryFile(  # pylint: disable=consider-using-with
+        max_size=settings.fetch_spool_max_memory_bytes, dir=settings.cache_temp_dir
+    )
+    try:
+        size = 0
+        identified = False
+        # The header of some images, like JPEG images with large metadata, doesn't fit in
+        # the first bytes: they are sniffed again each time the download doubles, up to
+        # _SNIFF_MAX_SIZE
+        sniff_size = _SNIFF_SIZE
+        while chunk := response.read(CHUNK_SIZE):
+            size += len(chunk)
+            if size > settings.fetch_max_bytes:
+                raise OriginImageRejectedError(
+                    f"The image is larger than {settings.fetch_max_bytes} bytes"
+                )
+            if time.monotonic() > deadline:
+                raise OriginImageRejectedError(
+                    f"The image took more than {settings.fetch_max_duration_s}s to download"
+                )
+            content.write(chunk)
+            if not identified and size >= sniff_size:
+                if sniff_size > _SNIFF_MAX_SIZE:
+                    raise OriginImageRejectedError("The url isn't a supported image")
+                content.seek(0)
+                identified = _sniff(content)
+                content.seek(0, 2)
+                sniff_size *= 2
+        content.seek(0)
+        if not identified and not _sniff(content):
+            raise OriginImageRejectedError("The url isn't a supported image")
+        content.seek(0)
+    except BaseException:
+        content.close()
+        raise
+    return OriginResponse(
+        content=content, validators=_get_validators(response.headers), size=size
+    )
+
+
+def _not_modified(headers: _Headers, validators: OriginValidators) -> OriginResponse:
+    # A 304 response may omit the validators which didn't change
+    response_validators = _get_validators(headers)
+    return OriginResponse(
+        content=None,
+        validators=OriginValidators(
+            etag=response_validators.etag or validators.etag,
+            last_modified=response_validators.last_modified or validators.last_modified,
+            max_age=response_validators.max_age,
+        ),
+    )
+
+
+@contextmanager
+def _translate_errors(url: str) -> Iterator[None]:
+    """
+    Raise the same errors as urllib for the errors of the pooled connections
+    """
+    try:
+        yield
+    except urllib3_exceptions.MaxRetryError as error:
+        # NewConnectionError is a timeout error in urllib3 1.x, but it is a failure to
+        # resolve the host name or to connect
+        if isinstance(error.reason, urllib3_exceptions.TimeoutError) and not isinstance(
+            error.reason, urllib3_exceptions.NewConnectionError
+        ):
+            raise TimeoutError(f"Timed out retrieving {url}") from error
+        raise URLError(error.reason) from error
+    except urllib3_exceptions.TimeoutError as error:
+        raise TimeoutError(f"Timed out retrieving {url}") from error
+    except urllib3_exceptions.HTTPError as error:
+        raise URLError(error) from error
+
+
+def _fetch_pooled(
+    url: str, headers: dict[str, str], validators: OriginValidators | None
+) -> OriginResponse:
+    with _translate_errors(url):
+        response: HTTPResponse = _http.request(
+            "GET", url, headers=headers, preload_content=False
+        )
+        try:
+            if response.status == HTTPStatus.NOT_MODIFIED and validators:
+                return _not_modified(response.headers, validators)
+            if response.status >= HTTPStatus.BAD_REQUEST:
+                raise HTTPError(url, response.status, response.reason, None, None)
+            return _download(response)
+        except BaseException:
+            # Don't reuse a connection with an unread response
+            response.close()
+            raise
+        finally:
+            response.release_conn()
+
+
+def _fetch(
+    url: str, headers: dict[str, str], validators: OriginValidators | None
+) -> OriginResponse:
+    headers = {**headers, **_get_conditional_headers(validators)}
+    if urlsplit(url).scheme in _POOLED_SCHEMES:
+        return _fetch_pooled(url, headers, validators)
+    try:
+        with urlopen(
+            Request(url, headers=headers), timeout=settings.fetch_read_timeout_s
+        ) as response:
+            return _download(response)
+    except HTTPError as error:
+        if error.code != HTTPStatus.NOT_MODIFIED or not validators:
+            raise
+        return _not_modified(error.headers, validators)
+
+
+async def fetch(
+    url: str, headers: dict[str, str], validators: OriginValidators | None = None
+) -> OriginResponse:
+    """
+    Download an image without blocking the event loop.
+
+    The blocking request is run in a dedicated, bounded, thread pool, so that slow origins
+    can't starve the threads used for other work. Http(s) requests reuse the connections
+    to the origin server, and are retried if the server is unavailable. The image is
+    rejected, before it is decoded, if it is too large to download or to resize.
+
+    The concurrent requests to each origin server are limited, and a server which keeps
+    failing isn't asked again until its circuit breaker lets a request through, so that one
+    slow or failing origin can't use all the capacity.
+
+    :param url: the url of the image
+    :param headers: headers to use in the request to fetch the image
+    :param validators: if provided, make a conditional request, so that the origin
+    server doesn't send the image again if it didn't change
+    :return: the response of the origin server. The caller must close its content.
+    :raises OriginImageRejectedError: if the response isn't an image which can be resized
+    :raises OriginUnavailableError: if the origin server isn't asked for the image
+    """
+    loop = asyncio.get_running_loop()
+    async with origins.limit(url):
+        with metrics.stage("fetch"):
+            origin_response = await loop.run_in_executor(
+                _executor, _fetch, url, headers, validators
+            )
+    metrics.fetched_bytes.inc(origin_response.size)
+    return origin_response
@@ -2,6 +2,7 @@
 Geometric calculations for resizing images
 """
 import dataclasses
+import math
 from typing import Optional
 
 from imageresizer.service.types import ScaleType
@@ -167,3 +168,54 @@ def get_resize_geometry(
             return _get_resize_geometry_fit_preserve_aspect_ratio(
                 source_size, request_width, request_height
             )
+
+
+def get_minimum_source_size(source_size: Size, resize_geometry: ResizeGeometry) -> Size:
+    """
+    Calculate the smallest size a source image could be scaled down to, before being resized
+    with the given geometry, while still providing at least as many pixels as the target size.
+
+    :param source_size: the size of the source image
+    :param resize_geometry: how the source image will be resized
+    :return: the minimum size of the source image
+    """
+    box = resize_geometry.box or Box(0, 0, source_size[0], source_size[1])
+    box_width = max(box.right - box.left, 1)
+    box_height = max(box.bottom - box.top, 1)
+    return (
+        min(
+            math.ceil(source_size[0] * resize_geometry.size[0] / box_width),
+            source_size[0],
+        ),
+        min(
+            math.ceil(source_size[1] * resize_geometry.size[1] / box_height),
+            source_size[1],
+        ),
+    )
+
+
+def scale_resize_geometry(
+    resize_geometry: ResizeGeometry, source_size: Size, scaled_source_size: Size
+) -> ResizeGeometry:
+    """
+    Adapt a resize geometry calculated for a source image, to the same image scaled
+    to a different size.
+
+    :param resize_geometry: the geometry calculated for the source image
+    :param source_size: the size of the source image
+    :param scaled_source_size: the size of the scaled source image
+    :return: the geometry to use to resize the scaled source image
+    """
+    if not resize_geometry.box:
+        return resize_geometry
+    scale_x = scaled_source_size[0] / source_size[0]
+    scale_y = scaled_source_size[1] / source_size[1]
+    return ResizeGeometry(
+        size=resize_geometry.size,
+        box=Box(
+            left=round(resize_geometry.box.left * scale_x),
+            top=round(resize_geometry.box.top * scale_y),
+            right=round(resize_geometry.box.right * scale_x),
+            bottom=round(resize_geometry.box.bottom * scale_y),
+        ),
+    )
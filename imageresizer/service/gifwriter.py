@@ -0,0 +1,114 @@
+"""
+Streaming encoder for animated GIF images
+"""
+import itertools
+from typing import BinaryIO, Iterator
+
+from PIL import Image, ImageChops, GifImagePlugin
+
+# This mirrors GifImagePlugin._write_multiple_frames, relying on the helpers of the
+# pinned Pillow version, but writes each frame as soon as the next one is known,
+# instead of keeping all the frames until they are all encoded.
+# pylint: disable=protected-access
+
+
+def _get_delta_bbox(frame: Image.Image, base: Image.Image) -> tuple | None:
+    if GifImagePlugin._get_palette_bytes(frame) == GifImagePlugin._get_palette_bytes(
+        base
+    ):
+        delta = ImageChops.subtract_modulo(frame, base)
+    else:
+        delta = ImageChops.subtract_modulo(frame.convert("RGB"), base.convert("RGB"))
+    return delta.getbbox()
+
+
+def _write_frame(output_file: BinaryIO, frame_data: dict):
+    frame = frame_data["im"]
+    encoderinfo = frame_data["encoderinfo"]
+    if frame_data["first"]:
+        for header in GifImagePlugin._get_global_header(frame, encoderinfo):
+            output_file.write(header)
+        offset = (0, 0)
+    else:
+        encoderinfo["include_color_table"] = True
+        frame = frame.crop(frame_data["bbox"])
+        offset = frame_data["bbox"][:2]
+    GifImagePlugin._write_frame_data(output_file, frame, offset, encoderinfo)
+
+
+def _normalize_frame(
+    frame: Image.Image, base_encoderinfo: dict
+) -> tuple[Image.Image, dict]:
+    info = frame.info
+    encoderinfo = base_encoderinfo.copy()
+    frame = GifImagePlugin._normalize_mode(frame)
+    frame = GifImagePlugin._normalize_palette(frame, None, encoderinfo)
+    if "transparency" in frame.info:
+        encoderinfo["transparency"] = frame.info["transparency"]
+    for key in ("duration", "disposal"):
+        if key in info:
+            encoderinfo[key] = info[key]
+    return frame, encoderinfo
+
+
+def save_frames(frames: Iterator[Image.Image], output_file: BinaryIO):
+    """
+    Save the given frames as an animated GIF image.
+
+    Only the previous frame and the frame being encoded are held in memory, so the memory
+    used doesn't depend on the number of frames.
+
+    The duration and disposal of each frame are read from its info.
+
+    :param frames: the frames of the image
+    :param output_file: the file to write the image to
+    """
+    first_frame = next(frames)
+    base_encoderinfo = {"optimize": True}
+    for key, value in first_frame.info.items():
+        if key not in ("transparency", "duration", "disposal"):
+            base_encoderinfo.setdefault(key, value)
+
+    pending = None
+    background = None
+    for frame in itertools.chain([first_frame], frames):
+        frame, encoderinfo = _normalize_frame(frame, base_encoderinfo)
+
+        if not pending:
+            pending = {"im": frame, "bbox": None, "encoderinfo": encoderinfo}
+            pending["first"] = True
+            continue
+
+        # What the frame is drawn over depends on the disposal of the previous frame
+        if pending["encoderinfo"].get("disposal") == 2:
+            if background is None:
+                color = base_encoderinfo.get(
+                    "transparency", first_frame.info.get("transparency", (0, 0, 0))
+                )
+                background = Image.new(
+                    "P", frame.size, GifImagePlugin._get_background(frame, color)
+                )
+                background.putpalette(frame.palette)
+            base = background
+        else:
+            base = pending["im"]
+        bbox = _get_delta_bbox(frame, base)
+        if not bbox:
+            # This frame is identical to the previous frame
+            if "duration" in encoderinfo:
+                pending["encoderinfo"]["duration"] = (
+                    pending["encoderinfo"].get("duration", 0) + encoderinfo["duration"]
+                )
+            continue
+
+        _write_frame(output_file, pending)
+        pending = {"im": frame, "bbox": bbox, "encoderinfo": encoderinfo}
+        pending["first"] = False
+
+    if pending["first"]:
+        # Only one distinct frame: save a still image
+        pending["im"].save(output_file, format="GIF")
+        return
+
+    _write_frame(output_file, pending)
+    output_file.write(b";")
@@ -0,0 +1,111 @@
+"""
+In-memory cache of the most requested resized images
+"""
+import dataclasses
+import datetime
+from collections import OrderedDict
+from typing import Hashable
+
+from imageresizer.service.types import ImageResponseData
+
+# Approximate memory used by an entry, in addition to the content of the image
+_ENTRY_OVERHEAD_BYTES = 512
+
+
+@dataclasses.dataclass
+class HotCacheStats:
+    """
+    Usage statistics of a hot cache
+    """
+
+    hits: int = 0
+    misses: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+class HotCache:
+    """
+    A least recently used cache of resized images, bounded by the memory it uses, so that the
+    most requested images are served without querying the database or reading their file.
+
+    Entries expire with the resized image they describe.
+    """
+
+    def __init__(self, max_bytes: int, max_content_bytes: int):
+        """
+        :param max_bytes: the maximum memory used by the cache
+        :param max_content_bytes: the maximum size of an image whose content is held in memory.
+        Only the file of larger images is kept.
+        """
+        self._max_bytes = max_bytes
+        self._max_content_bytes = max_content_bytes
+        self._entries: OrderedDict[Hashable, ImageResponseData] = OrderedDict()
+        self._stats = HotCacheStats()
+
+    @property
+    def stats(self) -> HotCacheStats:
+        """
+        :return: the usage statistics of the cache
+        """
+        return dataclasses.replace(self._stats, entries=len(self._entries))
+
+    @property
+    def max_content_bytes(self) -> int:
+        """
+        :return: the maximum size of an image whose content is held in memory
+        """
+        return self._max_content_bytes
+
+    @staticmethod
+    def _get_entry_bytes(entry: ImageResponseData) -> int:
+        return _ENTRY_OVERHEAD_BYTES + (len(entry.content) if entry.content else 0)
+
+    def _remove(self, key: Hashable):
+        self._stats.bytes -= self._get_entry_bytes(self._entries.pop(key))
+
+    def get(self, key: Hashable) -> ImageResponseData | None:
+        """
+        :return: the resized image for the given key, if it's in the cache and not expired
+        """
+        entry = self._entries.get(key)
+        if entry and entry.expires and entry.expires <= datetime.datetime.now():
+            self._remove(key)
+            entry = None
+        if not entry:
+            self._stats.misses += 1
+            return None
+        self._stats.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, entry: ImageResponseData):
+        """
+        Add the resized image to the cache, evicting the least recently used ones
+        if the cache is full
+        """
+        if key in self._entries:
+            self._remove(key)
+        if entry.content and len(entry.content) > self._max_content_bytes:
+            entry = dataclasses.replace(entry, content=None)
+        entry_bytes = self._get_entry_bytes(entry)
+        if entry_bytes > self._max_bytes:
+            return
+        while self._entries and self._stats.bytes + entry_bytes > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+        self._entries[key] = entry
+        self._stats.bytes += entry_bytes
+
+    def remove(self, key: Hashable):
+        """
+        Remove the resized image for the given key, if it's in the cache
+        """
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self):
+        """
+        Remove all the entries
+        """
+        self._entries.clear()
+        self._stats.bytes = 0
@@ -3,7 +3,12 @@ Image resizing service types
 """
 
 from imageresizer.repository import crud
-from imageresizer.service.types import ScaleType, ResizedImageLookup, ImageFormat
+from imageresizer.service.types import (
+    ScaleType,
+    ResizedImageLookup,
+    ImageFormat,
+    OriginValidators,
+)
 
 Size = tuple[int, int]
 
@@ -59,3 +64,25 @@ def map_lookup(service_lookup: ResizedImageLookup) -> crud.ResizedImageLookup:
         image_format=_map_image_format(service_lookup.image_format),
         scale_type=_map_scale_type(service_lookup.scale_type),
     )
+
+
+def map_validators(service_validators: OriginValidators) -> crud.OriginValidators:
+    """
+    Convert service origin validators to repository origin validators
+    """
+    return crud.OriginValidators(
+        etag=service_validators.etag,
+        last_modified=service_validators.last_modified,
+        max_age=service_validators.max_age,
+    )
+
+
+def map_db_validators(crud_validators: crud.OriginValidators) -> OriginValidators:
+    """
+    Convert repository origin validators to service origin validators
+    """
+    return OriginValidators(
+        etag=crud_validators.etag,
+        last_modified=crud_validators.last_modified,
+        max_age=crud_validators.max_age,
+    )
@@ -0,0 +1,188 @@
+"""
+Protection of the workers against slow or failing origin servers
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from typing import AsyncIterator
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from imageresizer.settings import settings
+
+
+class OriginUnavailableError(Exception):
+    """
+    Raised when an origin server isn't asked for an image: it failed repeatedly, or too many
+    images are already being downloaded from it
+    """
+
+    def __init__(self, message: str, retry_after_s: float):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """
+    :return: True if the error shows that the origin server is unavailable, rather than
+    that the image can't be served
+    """
+    if isinstance(error, OriginUnavailableError):
+        return True
+    if isinstance(error, HTTPError):
+        return error.code >= HTTPStatus.INTERNAL_SERVER_ERROR
+    return isinstance(error, (URLError, TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an origin server after consecutive failures.
+
+    Once open, the breaker rejects requests for the open duration, then lets one request
+    through: if it succeeds, the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self, failure_threshold: int, open_s: float):
+        """
+        :param failure_threshold: the number of consecutive failures which open the breaker
+        :param open_s: the time during which requests are rejected once the breaker is open
+        """
+        self._failure_threshold = failure_threshold
+        self._open_s = open_s
+        self._failures = 0
+        self._open_until: float | None = None
+        self._trial_in_flight = False
+
+    def retry_after_s(self, now: float) -> float:
+        """
+        :return: the time until the breaker lets a request through again
+        """
+        if self._open_until is None:
+            return 0
+        return max(self._open_until - now, 0)
+
+    def allow(self, now: float) -> bool:
+        """
+        :return: True if a request may be sent to the origin server. If so, its result must
+        be recorded.
+        """
+        if self._open_until is None:
+            return True
+        if now < self._open_until or self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        """
+        Record a request which succeeded: the breaker closes
+        """
+        self._failures = 0
+        self._open_until = None
+        self._trial_in_flight = False
+
+    def record_cancelled(self):
+        """
+        Record a request which was allowed, but not sent
+        """
+        self._trial_in_flight = False
+
+    def record_failure(self, now: float):
+        """
+        Record a request which failed: the breaker opens after too many consecutive failures
+        """
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._open_until is not None or self._failures >= self._failure_threshold:
+            self._open_until = now + self._open_s
+
+
+# pylint: disable=too-few-public-methods
+class _Origin:
+    """
+    The state of the requests to one origin server
+    """
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(settings.origin_max_concurrent_fetches)
+        self.breaker = CircuitBreaker(
+            settings.origin_failure_threshold, settings.origin_open_s
+        )
+
+
+class Origins:
+    """
+    Limits the requests to each origin server: the number of concurrent requests, the time
+    spent waiting to send one, and the requests sent to a server which keeps failing.
+
+    The state of the origins used least recently is forgotten when there are too many.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        """
+        :param max_entries: the maximum number of origin servers to remember
+        """
+        self._max_entries = max_entries
+        self._origins: OrderedDict[str, _Origin] = OrderedDict()
+
+    def _get(self, host: str) -> _Origin:
+        origin = self._origins.get(host)
+        if origin is None:
+            origin = self._origins[host] = _Origin()
+            while len(self._origins) > self._max_entries:
+                self._origins.popitem(last=False)
+        self._origins.move_to_end(host)
+        return origin
+
+    @asynccontextmanager
+    async def limit(self, url: str) -> AsyncIterator[None]:
+        """
+        Wait for the origin server of the url to accept one more request, and record whether
+        the request, made in the context, failed.
+
+        :raises OriginUnavailableError: if the origin server failed repeatedly, or if it
+        is still busy after the queue timeout
+        """
+        host = urlsplit(url).hostname or ""
+        origin = self._get(host)
+        if not origin.breaker.allow(time.monotonic()):
+            raise OriginUnavailableError(
+                f"{host} is failing", origin.breaker.retry_after_s(time.monotonic())
+            )
+        try:
+            await asyncio.wait_for(
+                origin.semaphore.acquire(), settings.origin_queue_timeout_s
+            )
+        except asyncio.TimeoutError as error:
+            origin.breaker.record_cancelled()
+            raise OriginUnavailableError(
+                f"Too many images are being downloaded from {host}",
+                settings.origin_queue_timeout_s,
+            ) from error
+        except BaseException:
+            origin.breaker.record_cancelled()
+            raise
+        try:
+            yield
+        except Exception as error:
+            if is_unavailable(error):
+                origin.breaker.record_failure(time.monotonic())
+            else:
+                # The origin server responded: the image can't be served, but the server works
+                origin.breaker.record_success()
+            raise
+        except BaseException:
+            origin.breaker.record_cancelled()
+            raise
+        else:
+            origin.breaker.record_success()
+        finally:
+            origin.semaphore.release()
+
+    def clear(self):
+        """
+        Forget the state of all the origin servers
+        """
+        self._origins.clear()
@@ -0,0 +1,325 @@
+"""
+Resizing of images, in a pool of worker processes
+"""
+import asyncio
+import dataclasses
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tempfile import NamedTemporaryFile
+
+from PIL import Image
+from PIL.GifImagePlugin import GifImageFile
+
+from imageresizer import metrics, profiling
+from imageresizer.service import geometry
+from imageresizer.service.animatedimage import AnimatedImage
+from imageresizer.service.types import (
+    ImageFormat,
+    ImageResponseData,
+    ResizedImageLookup,
+)
+from imageresizer.settings import settings
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ResizeQueueFullError(Exception):
+    """
+    Raised when too many images are already waiting to be resized
+    """
+
+
+def _get_mime_type(image_format: ImageFormat) -> str:
+    """
+    :return: the mime type for the given image format
+    """
+    if image_format == ImageFormat.PDF:
+        return "application/pdf"
+    return f"image/{image_format}"
+
+
+def _get_minimum_decoded_size(
+    source_size: geometry.Size, resize_geometry: geometry.ResizeGeometry
+) -> geometry.Size:
+    minimum_size = geometry.get_minimum_source_size(source_size, resize_geometry)
+    # Like Image.thumbnail(), keep a margin so that the quality matches a full decode
+    return (
+        int(minimum_size[0] * (settings.resize_reducing_gap or 1)),
+        int(minimum_size[1] * (settings.resize_reducing_gap or 1)),
+    )
+
+
+def _reduce_decoding(
+    image: Image.Image, resize_geometries: list[geometry.ResizeGeometry]
+) -> list[geometry.ResizeGeometry]:
+    """
+    Have the image decoded at the smallest scale which still provides enough pixels for all
+    the resized images, if its format allows it (JPEG DCT scaling).
+
+    :return: the resize geometries to use for the image decoded at the new scale
+    """
+    if not settings.resize_reducing_gap:
+        return resize_geometries
+    source_size = image.size
+    minimum_sizes = [
+        _get_minimum_decoded_size(source_size, resize_geometry)
+        for resize_geometry in resize_geometries
+    ]
+    image.draft(
+        None,
+        (
+            max(minimum_size[0] for minimum_size in minimum_sizes),
+            max(minimum_size[1] for minimum_size in minimum_sizes),
+        ),
+    )
+    return [
+        geometry.scale_resize_geometry(resize_geometry, source_size, image.size)
+        for resize_geometry in resize_geometries
+    ]
+
+
+def _get_content_hash(file: str) -> str:
+    content_hash = hashlib.sha256()
+    with open(file, "rb") as resized_image_file:
+        while chunk := resized_image_file.read(HASH_CHUNK_SIZE):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _save(
+    image: Image.Image | AnimatedImage, lookup: ResizedImageLookup, source_format: str
+) -> ImageResponseData:
+    resized_image_format = (
+        lookup.image_format.name if lookup.image_format else source_format
+    )
+    # The file is only moved to the cache image dir by the storage, once it's complete
+    with NamedTemporaryFile(delete=False, dir=settings.cache_temp_dir) as output_file:
+        image.save(output_file.name, resized_image_format)
+    return ImageResponseData(
+        file=output_file.name,
+        mime_type=_get_mime_type(resized_image_format),
+        file_size=os.path.getsize(output_file.name),
+        content_hash=_get_content_hash(output_file.name),
+    )
+
+
+def _get_resize_geometry(
+    source_size: geometry.Size, lookup: ResizedImageLookup
+) -> geometry.ResizeGeometry:
+    return geometry.get_resize_geometry(
+        source_size=source_size,
+        request_width=lookup.width,
+        request_height=lookup.height,
+        scale_type=lookup.scale_type,
+    )
+
+
+def _resize(
+    image: Image.Image, resize_geometry: geometry.ResizeGeometry
+) -> Image.Image:
+    return image.resize(
+        size=resize_geometry.size,
+        box=dataclasses.astuple(resize_geometry.box) if resize_geometry.box else None,
+        # Shrink by an integer factor first (Image.reduce()) when the source
+        # is much bigger than the target size
+        reducing_gap=settings.resize_reducing_gap,
+    )
+
+
+def _resize_animated_image(
+    image: GifImageFile, lookup: ResizedImageLookup
+) -> ImageResponseData:
+    with metrics.stage("geometry"):
+        resize_geometry = _get_resize_geometry(image.size, lookup)
+    with metrics.stage("resize"):
+        animated_image = AnimatedImage(image).resize(
+            size=resize_geometry.size,
+            box=dataclasses.astuple(resize_geometry.box)
+            if resize_geometry.box
+            else None,
+        )
+    with metrics.stage("encode"):
+        return _save(animated_image, lookup, image.format)
+
+
+def resize_images(
+    source_file: str, lookups: list[ResizedImageLookup]
+) -> list[ImageResponseData]:
+    """
+    Resize the given source image to several sizes, and save the resized images to new files
+    in the image cache.
+
+    The source image is decoded once. The resized images are created largest first, so that
+    smaller ones can be resized from an already resized image, rather than from the source
+    image, when it has enough pixels.
+
+    This is cpu-bound, and is run in the resizer process pool by resize() and resize_batch().
+
+    :return: the ImageResponse data for the resized images, in the order of the lookups
+    """
+    with Image.open(source_file) as image:
+        profiling.add_details(
+            source_format=image.format,
+            source_size=image.size,
+            source_frames=getattr(image, "n_frames", 1),
+        )
+        if isinstance(image, GifImageFile) and image.n_frames:
+            return [_resize_animated_image(image, lookup) for lookup in lookups]
+
+        source_format = image.format
+        with metrics.stage("geometry"):
+            resize_geometries = [
+                _get_resize_geometry(image.size, lookup) for lookup in lookups
+            ]
+        resize_geometries = _reduce_decoding(image, resize_geometries)
+        with metrics.stage("decode"):
+            image.load()
+        resized_images = [None] * len(lookups)
+        # The largest resized image of the whole source image so far
+        intermediate_image = None
+        for i in sorted(
+            range(len(lookups)),
+            key=lambda index: resize_geometries[index].size[0]
+            * resize_geometries[index].size[1],
+            reverse=True,
+        ):
+            resize_geometry = resize_geometries[i]
+            base_image = image
+            minimum_size = _get_minimum_decoded_size(image.size, resize_geometry)
+            if (
+                intermediate_image
+                and intermediate_image.width >= minimum_size[0]
+                and intermediate_image.height >= minimum_size[1]
+            ):
+                base_image = intermediate_image
+                resize_geometry = geometry.scale_resize_geometry(
+                    resize_geometry, image.size, intermediate_image.size
+                )
+            with metrics.stage("resize"):
+                resized_image = _resize(base_image, resize_geometry)
+            if not resize_geometry.box:
+                intermediate_image = resized_image
+            with metrics.stage("encode"):
+                resized_images[i] = _save(resized_image, lookups[i], source_format)
+        return resized_images
+
+
+def resize_image(source_file: str, lookup: ResizedImageLookup) -> ImageResponseData:
+    """
+    Resize the given source image, and save it to a new file in the image cache.
+
+    This is cpu-bound, and is run in the resizer process pool by resize().
+
+    :return: the ImageResponse data for the resized image
+    """
+    return resize_images(source_file, [lookup])[0]
+
+
+def _init_worker():
+    # Load all the Pillow plugins once, rather than on the first image of each format
+    Image.init()
+
+
+class _ResizerPool:
+    """
+    A pool of worker processes, started on first use, with a bounded queue
+    """
+
+    def __init__(self):
+        self._executor: ProcessPoolExecutor | None = None
+        self.pending_jobs = 0
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """
+        :return: the executor running the worker processes
+        """
+        if self._executor is None:
+            # Spawn rather than fork: the server process has threads, and open connections
+            self._executor = ProcessPoolExecutor(
+                max_workers=settings.resize_max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return self._executor
+
+    def shutdown(self):
+        """
+        Stop the worker processes
+        """
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+_pool = _ResizerPool()
+
+
+def shutdown():
+    """
+    Stop the worker processes
+    """
+    _pool.shutdown()
+
+
+async def _submit(func, *args):
+    if (
+        _pool.pending_jobs
+        >= settings.resize_max_workers + settings.resize_max_queue_size
+    ):
+        raise ResizeQueueFullError()
+
+    _pool.pending_jobs += 1
+    try:
+        if profiling.is_tracing():
+            result, trace = await asyncio.get_running_loop().run_in_executor(
+                _pool.executor, profiling.run_profiled, func, *args
+            )
+            profiling.add_trace(trace)
+            return result
+        return await asyncio.get_running_loop().run_in_executor(
+            _pool.executor, func, *args
+        )
+    except BrokenProcessPool:
+        # A worker process died (killed when out of memory, for example):
+        # start new ones for the next images
+        logging.exception("Resizer worker process died, restarting the pool")
+        _pool.shutdown()
+        raise
+    finally:
+        _pool.pending_jobs -= 1
+
+
+async def resize(source_file: str, lookup: ResizedImageLookup) -> ImageResponseData:
+    """
+    Resize an image in the pool of worker processes, so that resizing uses all the cpus,
+    regardless of the number of server workers.
+
+    The source image is passed to the worker process as a file, rather than copied through
+    a pipe, and the worker process saves the resized image in the image cache.
+
+    :param source_file: the path to the source image
+    :param lookup: the lookup fields for the image
+    :raises ResizeQueueFullError: if too many images are already waiting to be resized
+    :return: the ImageResponse data for the resized image
+    """
+    return await _submit(resize_image, source_file, lookup)
+
+
+async def resize_batch(
+    source_file: str, lookups: list[ResizedImageLookup]
+) -> list[ImageResponseData]:
+    """
+    Resize an image to several sizes, in a single job of the pool of worker processes.
+
+    :param source_file: the path to the source image
+    :param lookups: the lookup fields for each resized image
+    :raises ResizeQueueFullError: if too many images are already waiting to be resized
+    :return: the ImageResponse data for the resized images, in the order of the lookups
+    """
+    return await _submit(resize_images, source_file, lookups)
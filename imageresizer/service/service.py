@@ -2,40 +2,273 @@
 Image resizing service
 """
 import dataclasses
-from os.path import exists
-from tempfile import NamedTemporaryFile
-from urllib.request import urlopen, Request
+import datetime
 
-from PIL import Image
-from PIL.GifImagePlugin import GifImageFile
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from imageresizer.repository import crud
-from imageresizer.service import mapping, geometry
-from imageresizer.service.animatedimage import AnimatedImage
+from imageresizer import metrics
+from imageresizer.repository import crud, models
+from imageresizer.service import (
+    mapping,
+    origins,
+    resizer,
+    singleflight,
+    sourcecache,
+)
+from imageresizer.service.accesstracker import AccessTracker
+from imageresizer.service.hotcache import HotCache
 from imageresizer.service.types import (
-    ImageFormat,
     ImageResponseData,
+    OriginValidators,
     ResizedImageLookup,
 )
 from imageresizer.settings import settings
+from imageresizer.storage.storage import get_storage
+
+_in_flight = singleflight.SingleFlight()
+hot_cache = HotCache(
+    max_bytes=settings.hot_cache_max_bytes,
+    max_content_bytes=settings.hot_cache_max_content_bytes,
+)
+access_tracker = AccessTracker(settings.last_access_update_interval_s)
 
 
-def _get_mime_type(image_format: ImageFormat) -> str:
+def _get_usable_resized_image(
+    session: Session, crud_lookup: crud.ResizedImageLookup
+) -> models.ResizedImage | None:
     """
-    :return: the mime type for the given image format
+    :return: the resized image, if it's in the database and its file is in the storage.
+    Checking the storage may be a network request: this runs in the threadpool.
     """
-    if image_format == ImageFormat.PDF:
-        return "application/pdf"
-    return f"image/{image_format}"
+    db_resized_image = crud.get_resized_image(session, crud_lookup)
+    return db_resized_image if _is_usable(db_resized_image) else None
+
+
+def _get_latest_resized_image(
+    session: Session, crud_lookup: crud.ResizedImageLookup
+) -> models.ResizedImage | None:
+    # Discard what the session has loaded, since another worker may have
+    # modified the resized image in the meantime
+    session.expire_all()
+    return _get_usable_resized_image(session, crud_lookup)
+
+
+def _upsert_resized_image(
+    session: Session,
+    crud_lookup: crud.ResizedImageLookup,
+    resized_image: ImageResponseData,
+    validators: OriginValidators,
+    replaced_files: set[str],
+) -> models.ResizedImage:
+    if previous_db_resized_image := crud.get_resized_image(session, crud_lookup):
+        replaced_files.add(previous_db_resized_image.file)
+    # Upserted: if another worker saved it first, ours replaces it
+    return crud.create_resized_image(
+        session,
+        crud_lookup,
+        file=resized_image.file,
+        mime_type=resized_image.mime_type,
+        content_hash=resized_image.content_hash,
+        file_size=resized_image.file_size,
+        validators=mapping.map_validators(validators),
+        commit=False,
+    )
 
 
-def resize(
+def _delete_unreferenced_files(session: Session, files: set[str]):
+    storage = get_storage()
+    for file in files - crud.get_referenced_files(session, files):
+        storage.delete(file)
+
+
+def _get_response_data(db_resized_image: models.ResizedImage) -> ImageResponseData:
+    return ImageResponseData(
+        file=db_resized_image.file,
+        mime_type=db_resized_image.mime_type,
+        resized_image_id=db_resized_image.id,
+        file_size=db_resized_image.file_size,
+        content_hash=db_resized_image.content_hash,
+        last_modified=db_resized_image.datetime,
+        expires=sourcecache.get_expiry(
+            db_resized_image.datetime,
+            db_resized_image.origin_max_age,
+            settings.cache_validity_s,
+        ),
+    )
+
+
+def _save_resized_images(
+    session: Session,
+    crud_lookups: list[crud.ResizedImageLookup],
+    resized_images: list[ImageResponseData],
+    validators: OriginValidators,
+) -> list[ImageResponseData]:
+    """
+    :return: the response data of the saved resized images. They are read here, in the
+    threadpool, since the commit expired the saved rows and reading them queries the
+    database again.
+    """
+    # Stored before the transaction starts, so that the database isn't locked while the
+    # files are written or uploaded
+    storage = get_storage()
+    stored_images = [
+        dataclasses.replace(
+            resized_image,
+            file=storage.save(resized_image.file, resized_image.content_hash),
+        )
+        for resized_image in resized_images
+    ]
+    replaced_files = set()
+    saved_db_resized_images = [
+        _upsert_resized_image(
+            session, crud_lookup, stored_image, validators, replaced_files
+        )
+        for crud_lookup, stored_image in zip(crud_lookups, stored_images)
+    ]
+    session.commit()
+    # Files are shared by identical resized images: only delete the replaced files which
+    # are not used anymore
+    _delete_unreferenced_files(session, replaced_files)
+    return [
+        _get_response_data(db_resized_image)
+        for db_resized_image in saved_db_resized_images
+    ]
+
+
+def _save_resized_image(
+    session: Session,
+    crud_lookup: crud.ResizedImageLookup,
+    resized_image: ImageResponseData,
+    validators: OriginValidators,
+) -> ImageResponseData:
+    return _save_resized_images(session, [crud_lookup], [resized_image], validators)[0]
+
+
+def _is_usable(db_resized_image: models.ResizedImage | None) -> bool:
+    return db_resized_image is not None and get_storage().exists(db_resized_image.file)
+
+
+def _is_fresh(db_resized_image: models.ResizedImage | None) -> bool:
+    return db_resized_image is not None and sourcecache.is_fresh(
+        db_resized_image.datetime,
+        db_resized_image.origin_max_age,
+        settings.cache_validity_s,
+    )
+
+
+async def _fetch_and_resize(
+    session: Session,
+    headers: dict[str, str],
+    lookup: ResizedImageLookup,
+    crud_lookup: crud.ResizedImageLookup,
+) -> ImageResponseData:
+    # Taken before the lock of the source image, in sourcecache
+    async with singleflight.process_lock(crud.get_lookup_key(crud_lookup), "resized"):
+        # Another worker may have resized the image while we were waiting for the lock
+        db_resized_image = await run_in_threadpool(
+            _get_latest_resized_image, session, crud_lookup
+        )
+        if _is_fresh(db_resized_image):
+            return _get_response_data(db_resized_image)
+
+        # If we have an expired resized image, only resize again if the source image changed
+        resized_image_validators = (
+            mapping.map_db_validators(crud.get_origin_validators(db_resized_image))
+            if db_resized_image is not None
+            else None
+        )
+        try:
+            source = await sourcecache.get_source(
+                session, lookup.url, headers, resized_image_validators
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            # Serve the expired resized image rather than an error
+            if not (
+                settings.origin_serve_stale
+                and resized_image_validators
+                and origins.is_unavailable(error)
+            ):
+                raise
+            metrics.stale_served.inc()
+            return _get_response_data(db_resized_image)
+        if resized_image_validators and source.validators.matches(
+            resized_image_validators
+        ):
+            db_resized_image = await run_in_threadpool(
+                crud.refresh_resized_image,
+                session,
+                db_resized_image,
+                mapping.map_validators(source.validators),
+            )
+            return _get_response_data(db_resized_image)
+
+        resized_image = await resizer.resize(source.file, lookup)
+        with metrics.stage("db_write"):
+            return await run_in_threadpool(
+                _save_resized_image,
+                session,
+                crud_lookup,
+                resized_image,
+                source.validators,
+            )
+
+
+async def _add_to_hot_cache(
+    key: str, resized_image: ImageResponseData
+) -> ImageResponseData:
+    if resized_image.content is None:
+        file_size = resized_image.file_size or await run_in_threadpool(
+            get_storage().size, resized_image.file
+        )
+        if file_size <= hot_cache.max_content_bytes:
+            resized_image = dataclasses.replace(
+                resized_image,
+                content=await run_in_threadpool(
+                    get_storage().read_bytes, resized_image.file
+                ),
+            )
+    hot_cache.put(key, resized_image)
+    return resized_image
+
+
+async def _record_access(session: Session, resized_image: ImageResponseData):
+    now = datetime.datetime.now()
+    if resized_image.resized_image_id is not None and access_tracker.is_due(
+        resized_image.resized_image_id, now
+    ):
+        await run_in_threadpool(
+            crud.touch_resized_image, session, resized_image.resized_image_id, now
+        )
+
+
+async def resize(
     session: Session, headers: dict[str, str], lookup: ResizedImageLookup
 ) -> ImageResponseData:
     """
     Resize an image.
 
+    The event loop is never blocked: the image is downloaded by the fetcher, or read from
+    the source image cache if another rendition of it was requested recently, the resizing
+    is done in the resizer process pool, and database access is done in the threadpool.
+
+    Resized images are valid for the max age given by the origin server, or for the
+    cache validity. Once expired, they are only resized again if the origin server indicates
+    that the source image changed.
+
+    If the origin server is unavailable, an expired resized image is served as is, rather
+    than an error.
+
+    Concurrent requests for the same resized image are coalesced: only one of them, across all
+    the workers, downloads and resizes the image, and the others get its result.
+
+    The most requested resized images are kept in the hot cache, with the content of the
+    small ones, so that they are served without querying the database or reading the disk.
+    The file of the large ones is checked, since a purge may have deleted it.
+
+    The last access time of resized images, used to evict the least recently used ones when
+    the cache is too large, is written at most once per last access update interval.
+
     :param session: the database session
     :param headers: headers to use in the request to fetch time image
     :param lookup: the lookup fields for the image
@@ -43,41 +276,86 @@ def resize(
     """
 
     crud_lookup = mapping.map_lookup(lookup)
-    db_resized_image = crud.get_resized_image(session, crud_lookup)
-    if db_resized_image and exists(db_resized_image.file):
-        return ImageResponseData(db_resized_image.file, db_resized_image.mime_type)
-
-    with Image.open(urlopen(Request(lookup.url, headers=headers))) as image:
-        with NamedTemporaryFile(
-            delete=False, dir=settings.cache_image_dir
-        ) as output_file:
-            resize_geometry = geometry.get_resize_geometry(
-                source_size=image.size,
-                request_width=lookup.width,
-                request_height=lookup.height,
-                scale_type=lookup.scale_type,
-            )
-            resized_image_format = (
-                lookup.image_format.name if lookup.image_format else image.format
-            )
-            if isinstance(image, GifImageFile) and image.n_frames:
-                image = AnimatedImage(image)
-
-            image = image.resize(
-                size=resize_geometry.size,
-                box=dataclasses.astuple(resize_geometry.box)
-                if resize_geometry.box
-                else None,
+    key = crud.get_lookup_key(crud_lookup)
+    if resized_image := hot_cache.get(key):
+        # Only the file of large resized images is kept: it may have been evicted since
+        if resized_image.content is None and not await run_in_threadpool(
+            get_storage().exists, resized_image.file
+        ):
+            hot_cache.remove(key)
+        else:
+            metrics.cache_requests.labels("hot").inc()
+            await _record_access(session, resized_image)
+            return resized_image
+
+    with metrics.stage("db_lookup"):
+        db_resized_image = await run_in_threadpool(
+            _get_usable_resized_image, session, crud_lookup
+        )
+    if _is_fresh(db_resized_image):
+        metrics.cache_requests.labels("hit").inc()
+        resized_image = _get_response_data(db_resized_image)
+        await _record_access(session, resized_image)
+    else:
+        metrics.cache_requests.labels("miss").inc()
+        resized_image = await _in_flight.run(
+            key,
+            lambda: _fetch_and_resize(session, headers, lookup, crud_lookup),
+        )
+    return await _add_to_hot_cache(key, resized_image)
+
+
+async def resize_batch(
+    session: Session,
+    headers: dict[str, str],
+    url: str,
+    lookups: list[ResizedImageLookup],
+) -> list[ImageResponseData]:
+    """
+    Resize an image to several sizes.
+
+    The source image is downloaded and decoded once, for all the resized images which aren't
+    already in the cache, and they are all saved in the database in one transaction.
+
+    :param session: the database session
+    :param headers: headers to use in the request to fetch time image
+    :param url: the url of the image
+    :param lookups: the lookup fields for each resized image. They must all have the given url.
+    :return: the ImageResponse data for the resized images, in the order of the lookups
+    """
+    crud_lookups = [mapping.map_lookup(lookup) for lookup in lookups]
+    keys = [crud.get_lookup_key(crud_lookup) for crud_lookup in crud_lookups]
+    # Identical lookups are only resized once
+    unique_lookups = dict(zip(keys, zip(lookups, crud_lookups)))
+    with metrics.stage("db_lookup"):
+        db_resized_images = await run_in_threadpool(
+            lambda: {
+                key: _get_usable_resized_image(session, crud_lookup)
+                for key, (_, crud_lookup) in unique_lookups.items()
+            }
+        )
+    results = {
+        key: _get_response_data(db_resized_image)
+        for key, db_resized_image in db_resized_images.items()
+        if _is_fresh(db_resized_image)
+    }
+
+    missing_keys = [key for key in unique_lookups if key not in results]
+    metrics.cache_requests.labels("hit").inc(len(results))
+    metrics.cache_requests.labels("miss").inc(len(missing_keys))
+    if missing_keys:
+        source = await sourcecache.get_source(session, url, headers)
+        resized_images = await resizer.resize_batch(
+            source.file, [unique_lookups[key][0] for key in missing_keys]
+        )
+        with metrics.stage("db_write"):
+            saved_resized_images = await run_in_threadpool(
+                _save_resized_images,
+                session,
+                [unique_lookups[key][1] for key in missing_keys],
+                resized_images,
+                source.validators,
             )
-            image.save(output_file.name, resized_image_format)
-            mime_type = _get_mime_type(resized_image_format)
-            if db_resized_image:
-                crud.update_resized_image(
-                    session, db_resized_image, file=output_file.name
-                )
-            else:
-                crud.create_resized_image(
-                    session, crud_lookup, file=output_file.name, mime_type=mime_type
-                )
-
-            return ImageResponseData(file=output_file.name, mime_type=mime_type)
+        results.update(zip(missing_keys, saved_resized_images))
+
+    return [results[key] for key in keys]
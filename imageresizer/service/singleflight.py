@@ -0,0 +1,104 @@
+"""
+Deduplication of concurrent work on the same resized image
+"""
+import asyncio
+import hashlib
+import time
+from contextlib import ExitStack, asynccontextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from imageresizer.filelock import file_lock, LockUnavailableError
+from imageresizer.settings import settings
+
+T = TypeVar("T")
+
+# Lock files are shared by keys having the same hash modulo this number,
+# so that the number of lock files on disk stays bounded.
+LOCK_STRIPES = 1024
+
+# Bounds, in seconds, of the delay between attempts to take a lock held by another process
+LOCK_POLL_MIN_S = 0.01
+LOCK_POLL_MAX_S = 0.2
+
+
+class LockTimeoutError(TimeoutError):
+    """
+    Raised when a lock is held by another worker for longer than the lock timeout
+    """
+
+
+class SingleFlight:
+    """
+    Run at most one call at a time per key: callers arriving while a call for their key is
+    in flight wait for that call's result, instead of doing the work again.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run func, unless a call for the same key is already running, in which case
+        wait for its result.
+        """
+        if key in self._calls:
+            return await asyncio.shield(self._calls[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            # Don't warn about an unretrieved exception if nobody was waiting
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+
+def _get_lock_path(namespace: str, key: Hashable) -> str:
+    digest = hashlib.sha1(repr(key).encode()).digest()
+    stripe = int.from_bytes(digest[:4], "big") % LOCK_STRIPES
+    return str(Path(settings.cache_lock_dir) / namespace / f"{stripe}.lock")
+
+
+@asynccontextmanager
+async def process_lock(key: Hashable, namespace: str, timeout_s: float | None = None):
+    """
+    Hold a lock, shared between all the processes using the same cache dir, for the
+    given key.
+
+    Each namespace has its own lock files, so that a lock can be taken while holding a
+    lock of another namespace, without waiting on itself when their keys share a stripe.
+    Locks of several namespaces must always be taken in the same order.
+
+    The lock is polled rather than waited for in a thread, so that waiting neither blocks the
+    event loop nor ties up a thread, and so that a cancelled waiter can never end up holding
+    the lock.
+
+    :param namespace: the kind of work the lock protects
+    :param timeout_s: the maximum time to wait for the lock. Defaults to the lock timeout
+    setting.
+    :raise LockTimeoutError: if the lock couldn't be taken in time
+    """
+    lock_path = _get_lock_path(namespace, key)
+    deadline = time.monotonic() + (
+        settings.cache_lock_timeout_s if timeout_s is None else timeout_s
+    )
+    delay = LOCK_POLL_MIN_S
+    with ExitStack() as stack:
+        while True:
+            try:
+                stack.enter_context(file_lock(lock_path, blocking=False))
+                break
+            except LockUnavailableError as error:
+                if time.monotonic() >= deadline:
+                    raise LockTimeoutError(lock_path) from error
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LOCK_POLL_MAX_S)
+        yield
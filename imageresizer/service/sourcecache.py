@@ -0,0 +1,176 @@
+"""
+Cache of the source images, so that each rendition of an image doesn't need
+to download it again
+"""
+import dataclasses
+import datetime
+import shutil
+from os.path import exists
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from imageresizer.repository import crud, models
+from imageresizer.service import fetcher, mapping, singleflight
+from imageresizer.service.types import OriginValidators
+from imageresizer.settings import settings
+
+_in_flight = singleflight.SingleFlight()
+
+
+@dataclasses.dataclass
+class SourceImageData:
+    """
+    Source image data
+    """
+
+    # None if the origin server indicated that the image didn't change since the
+    # validators provided by the caller, and the image isn't in the cache
+    file: str | None
+    validators: OriginValidators
+
+
+def get_expiry(
+    image_datetime: datetime.datetime, max_age: int | None, validity_s: int
+) -> datetime.datetime:
+    """
+    :param image_datetime: when the image was downloaded or last revalidated
+    :param max_age: the max age indicated by the origin server, if any
+    :param validity_s: the validity to use if the origin server didn't indicate a max age
+    :return: when the image must be checked with the origin server again
+    """
+    return image_datetime + datetime.timedelta(
+        seconds=max_age if max_age is not None else validity_s
+    )
+
+
+def is_fresh(image_datetime: datetime.datetime, max_age: int | None, validity_s: int):
+    """
+    :param image_datetime: when the image was downloaded or last revalidated
+    :param max_age: the max age indicated by the origin server, if any
+    :param validity_s: the validity to use if the origin server didn't indicate a max age
+    :return: True if the image can be used without checking with the origin server
+    """
+    return get_expiry(image_datetime, max_age, validity_s) > datetime.datetime.now()
+
+
+def _get_validators(db_source_image: models.SourceImage) -> OriginValidators:
+    return mapping.map_db_validators(crud.get_origin_validators(db_source_image))
+
+
+def _is_usable(db_source_image: models.SourceImage | None) -> bool:
+    return db_source_image is not None and exists(db_source_image.file)
+
+
+def _is_valid(db_source_image: models.SourceImage | None) -> bool:
+    return _is_usable(db_source_image) and is_fresh(
+        db_source_image.datetime,
+        db_source_image.origin_max_age,
+        settings.source_cache_validity_s,
+    )
+
+
+def _get_latest_source_image(session: Session, url: str) -> models.SourceImage | None:
+    # Discard what the session has loaded, since another worker may have
+    # downloaded the source image in the meantime
+    session.expire_all()
+    return crud.get_source_image(session, url)
+
+
+def _save_source_image(
+    session: Session,
+    url: str,
+    origin_response: fetcher.OriginResponse,
+) -> str:
+    with NamedTemporaryFile(delete=False, dir=settings.cache_source_dir) as source_file:
+        shutil.copyfileobj(origin_response.content, source_file)
+    file_size = origin_response.size
+    previous_db_source_image = crud.get_source_image(session, url)
+    previous_file = previous_db_source_image.file if previous_db_source_image else None
+    # Upserted: if another worker saved it first, ours replaces it
+    crud.create_source_image(
+        session,
+        url,
+        file=source_file.name,
+        file_size=file_size,
+        validators=mapping.map_validators(origin_response.validators),
+    )
+    # No row refers to the replaced file anymore, so the purge wouldn't delete it
+    if previous_file and previous_file != source_file.name:
+        Path(previous_file).unlink(missing_ok=True)
+    return source_file.name
+
+
+async def _download(
+    session: Session,
+    url: str,
+    headers: dict[str, str],
+    validators: OriginValidators | None,
+) -> SourceImageData:
+    # Taken after the lock of the resized image, in service
+    async with singleflight.process_lock(url, "source"):
+        # Another worker may have downloaded the image while we were waiting for the lock
+        db_source_image = await run_in_threadpool(
+            _get_latest_source_image, session, url
+        )
+        if _is_valid(db_source_image):
+            return SourceImageData(
+                db_source_image.file, _get_validators(db_source_image)
+            )
+
+        # Revalidate the image we have, if any, rather than downloading it again
+        source_image_usable = _is_usable(db_source_image)
+        if source_image_usable:
+            validators = _get_validators(db_source_image)
+        origin_response = await fetcher.fetch(url, headers, validators)
+        if not origin_response.not_modified:
+            try:
+                source_file = await run_in_threadpool(
+                    _save_source_image, session, url, origin_response
+                )
+            finally:
+                origin_response.content.close()
+            return SourceImageData(source_file, origin_response.validators)
+
+        if source_image_usable:
+            await run_in_threadpool(
+                crud.refresh_source_image,
+                session,
+                db_source_image,
+                mapping.map_validators(origin_response.validators),
+            )
+            return SourceImageData(db_source_image.file, origin_response.validators)
+        return SourceImageData(None, origin_response.validators)
+
+
+async def get_source(
+    session: Session,
+    url: str,
+    headers: dict[str, str],
+    validators: OriginValidators | None = None,
+) -> SourceImageData:
+    """
+    Get a source image, downloading it only if it isn't already in the cache.
+
+    If the cached source image is expired, and the origin server provided validators for
+    it, the origin server is asked if the image changed, and it is only downloaded again
+    if it did.
+
+    :param session: the database session
+    :param url: the url of the source image
+    :param headers: headers to use in the request to fetch the image
+    :param validators: validators of a version of the image the caller already has. If the
+    source image isn't in the cache, and the image didn't change since that version, the
+    image isn't downloaded, and no file is returned.
+    :return: the source image
+    """
+    db_source_image = await run_in_threadpool(crud.get_source_image, session, url)
+    if _is_valid(db_source_image):
+        return SourceImageData(db_source_image.file, _get_validators(db_source_image))
+
+    return await _in_flight.run(
+        (url, dataclasses.astuple(validators) if validators else None),
+        lambda: _download(session, url, headers, validators),
+    )
@@ -2,9 +2,11 @@
 Image resizing service types
 """
 import dataclasses
+import datetime
 from enum import Enum
 
 
+# pylint: disable=too-many-instance-attributes
 @dataclasses.dataclass
 class ImageResponseData:
     """
@@ -13,6 +15,18 @@ class ImageResponseData:
 
     file: str
     mime_type: str
+    # The id of the resized image in the database, once it is saved
+    resized_image_id: int | None = None
+    # The size of the file, in bytes
+    file_size: int | None = None
+    # A hash of the content of the file
+    content_hash: str | None = None
+    # When the resized image was created or last revalidated
+    last_modified: datetime.datetime | None = None
+    # When the resized image must be checked with the origin server again
+    expires: datetime.datetime | None = None
+    # The content of the file, for small images held in memory
+    content: bytes | None = None
 
 
 class ImageFormat(str, Enum):
@@ -51,3 +65,25 @@ class ResizedImageLookup:
     height: int = 0
     image_format: ImageFormat = None
     scale_type: ScaleType = ScaleType.FIT_XY
+
+
+@dataclasses.dataclass
+class OriginValidators:
+    """
+    Information provided by the origin server, to know if an image we downloaded
+    is still up to date
+    """
+
+    etag: str | None = None
+    last_modified: str | None = None
+    max_age: int | None = None
+
+    def matches(self, other: "OriginValidators") -> bool:
+        """
+        :return: True if both validators identify the same version of the image
+        """
+        if self.etag or other.etag:
+            return self.etag == other.etag
+        return self.last_modified is not None and (
+            self.last_modified == other.last_modified
+        )
@@ -1,8 +1,9 @@
 """
 Settings module
 """
+import os
 from pathlib import Path
-from typing import Set
+from typing import Literal, Set
 
 from pydantic import BaseSettings
 
@@ -17,12 +18,57 @@ class Settings(BaseSettings):
     cache_dir: str = "."
     cache_validity_s = 86400
     cache_clean_interval_s = 86400
+    cache_max_bytes: int | None = None
+    cache_purge_batch_size: int = 1000
+    last_access_update_interval_s: int = 3600
+    cache_lock_timeout_s: float = 120.0
+    source_cache_validity_s: int = 86400
+    source_cache_max_bytes: int = 1024 * 1024 * 1024
+    hot_cache_max_bytes: int = 64 * 1024 * 1024
+    hot_cache_max_content_bytes: int = 256 * 1024
     supported_image_url_schemas: Set[str] = {"https"}
     allowed_domains: Set[str] = set()
     denied_domains: Set[str] = set()
     openapi_url: str = "/openapi.json"
     redoc_url: str = "/redoc"
     docs_url: str = "/docs"
+    resize_max_workers: int = os.cpu_count() or 1
+    resize_max_queue_size: int = 64
+    fetch_max_workers: int = 16
+    fetch_connect_timeout_s: float = 5.0
+    fetch_read_timeout_s: float = 10.0
+    fetch_max_connections_per_host: int = 8
+    fetch_retries: int = 2
+    fetch_retry_backoff_s: float = 0.2
+    origin_max_concurrent_fetches: int = 8
+    origin_queue_timeout_s: float = 5.0
+    origin_failure_threshold: int = 5
+    origin_open_s: float = 30.0
+    origin_serve_stale: bool = True
+    fetch_max_duration_s: float = 60.0
+    fetch_max_bytes: int = 64 * 1024 * 1024
+    fetch_spool_max_memory_bytes: int = 1024 * 1024
+    source_image_max_pixels: int = 100_000_000
+    resize_reducing_gap: float | None = 3.0
+    animated_image_max_frames: int = 1000
+    animated_image_max_pixels: int = 100_000_000
+    database_url: str | None = None
+    storage_backend: Literal["local", "s3"] = "local"
+    s3_bucket: str | None = None
+    s3_prefix: str = "images/"
+    s3_endpoint_url: str | None = None
+    sqlite_journal_mode: Literal["wal", "delete", "truncate", "persist"] = "wal"
+    sqlite_synchronous: Literal["off", "normal", "full", "extra"] = "normal"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_busy_timeout_ms: int = 5000
+    database_pool_size: int = 8
+    database_max_overflow: int = 32
+    sendfile_header: Literal["x-accel-redirect", "x-sendfile"] | None = None
+    sendfile_prefix: str = "/cached-images/"
+    profile_requests: bool = False
+    profile_token: str | None = None
+    profile_slow_request_threshold_s: float = 1.0
+    profile_max_traces: int = 100
 
     def _create_log_dir(self):
         Path(self.log_dir).mkdir(parents=True, exist_ok=True)
@@ -41,7 +87,40 @@ class Settings(BaseSettings):
         """
         return str(Path(self.cache_dir) / "images")
 
+    @property
+    def cache_source_dir(self) -> str:
+        """
+        :return: the path where source image files will be stored
+        """
+        return str(Path(self.cache_dir) / "sources")
+
+    @property
+    def cache_temp_dir(self) -> str:
+        """
+        :return: the path where image files are written, before they are complete
+        """
+        return str(Path(self.cache_dir) / "tmp")
+
+    @property
+    def cache_metrics_dir(self) -> str:
+        """
+        :return: the path where the metrics of each process will be stored
+        """
+        return str(Path(self.cache_dir) / "metrics")
+
+    @property
+    def cache_lock_dir(self) -> str:
+        """
+        :return: the path where lock files shared between workers will be stored
+        """
+        return str(Path(self.cache_dir) / "locks")
+
 
 settings = Settings()
-if settings.cache_image_dir:
-    Path(settings.cache_image_dir).mkdir(parents=True, exist_ok=True)
+for cache_subdir in [
+    settings.cache_image_dir,
+    settings.cache_source_dir,
+    settings.cache_temp_dir,
+    settings.cache_metrics_dir,
+]:
+    Path(cache_subdir).mkdir(parents=True, exist_ok=True)
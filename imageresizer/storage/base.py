@@ -0,0 +1,79 @@
+"""
+Interface of the storages of the resized image files
+"""
+import abc
+from typing import Iterator
+
+# The size of the chunks in which files are streamed
+CHUNK_SIZE = 64 * 1024
+
+
+def get_content_key(content_hash: str) -> str:
+    """
+    :return: the key of a file with the given content hash, in subdirectories sharded by the
+    first characters of the hash, so that no directory holds too many files
+    """
+    return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+
+class Storage(abc.ABC):
+    """
+    Where the resized image files are stored, identified by a key
+    """
+
+    @abc.abstractmethod
+    def save(self, local_file: str, content_hash: str) -> str:
+        """
+        Store a resized image file, under a key derived from its content, so that identical
+        resized images are stored once. The local file is moved or deleted.
+
+        :param local_file: the path to the complete resized image file, in the cache temp dir
+        :param content_hash: the hash of the content of the file
+        :return: the key of the stored file
+        """
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        """
+        :return: True if the file with the given key is stored
+        """
+
+    @abc.abstractmethod
+    def size(self, key: str) -> int:
+        """
+        :return: the size of the file with the given key, in bytes
+        """
+
+    @abc.abstractmethod
+    def stream(
+        self, key: str, start: int = 0, end: int | None = None
+    ) -> Iterator[bytes]:
+        """
+        Read the file with the given key, in chunks
+
+        :param start: the offset of the first byte to read
+        :param end: the offset of the last byte to read, included, or None to read until
+        the end of the file
+        """
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> int:
+        """
+        Delete the file with the given key, if it exists
+
+        :return: the number of bytes freed
+        """
+
+    # pylint: disable=unused-argument
+    def get_local_path(self, key: str) -> str | None:
+        """
+        :return: the path of the file with the given key on the local disk, if it's there,
+        so that it can be served directly
+        """
+        return None
+
+    def read_bytes(self, key: str) -> bytes:
+        """
+        :return: the content of the file with the given key
+        """
+        return b"".join(self.stream(key))
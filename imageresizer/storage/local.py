@@ -0,0 +1,59 @@
+"""
+Storage of the resized image files on the local disk
+"""
+import os
+from pathlib import Path
+from typing import Iterator
+
+from imageresizer.settings import settings
+from imageresizer.storage.base import CHUNK_SIZE, Storage, get_content_key
+
+
+class LocalStorage(Storage):
+    """
+    Stores the resized image files in the cache image dir. The key of a file is its path.
+    """
+
+    def save(self, local_file: str, content_hash: str) -> str:
+        path = Path(settings.cache_image_dir) / get_content_key(content_hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Atomic: the file is either absent or complete. If an identical file is already
+        # stored, it's replaced, which is safer than keeping it, since it may be being purged
+        os.replace(local_file, path)
+        return str(path)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(key)
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(key)
+
+    def stream(
+        self, key: str, start: int = 0, end: int | None = None
+    ) -> Iterator[bytes]:
+        remaining = None if end is None else end - start + 1
+        with open(key, "rb") as file:
+            file.seek(start)
+            while remaining is None or remaining > 0:
+                chunk = file.read(
+                    CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                )
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key: str) -> int:
+        try:
+            file_size = os.path.getsize(key)
+            os.unlink(key)
+        except FileNotFoundError:
+            return 0
+        return file_size
+
+    def get_local_path(self, key: str) -> str | None:
+        return key
+
+    def read_bytes(self, key: str) -> bytes:
+        return Path(key).read_bytes()
@@ -0,0 +1,97 @@
+"""
+Storage of the resized image files in an S3 compatible object storage, shared by
+several servers
+
+Requires boto3, which is an optional dependency. The credentials and region are read by
+boto3 from its usual environment variables and config files.
+"""
+import os
+from typing import Iterator
+
+from imageresizer.storage.base import CHUNK_SIZE, Storage, get_content_key
+
+
+class S3Storage(Storage):
+    """
+    Stores the resized image files in a bucket. The key of a file is its object key.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str | None = None,
+        client=None,
+    ):
+        """
+        :param bucket: the name of the bucket
+        :param prefix: the prefix of the object keys
+        :param endpoint_url: the url of the object storage, if it's not AWS S3,
+        for example MinIO
+        :param client: the S3 client to use. Defaults to a boto3 client for the endpoint url.
+        """
+        super().__init__()
+        if not bucket:
+            raise RuntimeError("The s3 storage backend requires S3_BUCKET")
+        if client is None:
+            try:
+                # pylint: disable=import-outside-toplevel
+                import boto3
+            except ImportError as error:
+                raise RuntimeError(
+                    "The s3 storage backend requires boto3: pip install boto3"
+                ) from error
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self._bucket = bucket
+        self._prefix = prefix
+        self._client = client
+        self._client_error = client.exceptions.ClientError
+
+    def _is_not_found(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey")
+
+    def save(self, local_file: str, content_hash: str) -> str:
+        key = f"{self._prefix}{get_content_key(content_hash)}"
+        if not self.exists(key):
+            # upload_file streams the file, in a multipart upload if it's large.
+            # Objects only become visible once they are completely uploaded.
+            self._client.upload_file(local_file, self._bucket, key)
+        os.unlink(local_file)
+        return key
+
+    def _head(self, key: str) -> dict | None:
+        try:
+            return self._client.head_object(Bucket=self._bucket, Key=key)
+        except self._client_error as error:
+            if self._is_not_found(error):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str) -> int:
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head["ContentLength"]
+
+    def stream(
+        self, key: str, start: int = 0, end: int | None = None
+    ) -> Iterator[bytes]:
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        response = self._client.get_object(
+            Bucket=self._bucket, Key=key, Range=byte_range
+        )
+        body = response["Body"]
+        try:
+            yield from body.iter_chunks(CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def delete(self, key: str) -> int:
+        head = self._head(key)
+        if head is None:
+            return 0
+        self._client.delete_object(Bucket=self._bucket, Key=key)
+        return head["ContentLength"]
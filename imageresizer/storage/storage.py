@@ -0,0 +1,23 @@
+"""
+Storage of the resized image files
+"""
+import functools
+
+from imageresizer.settings import settings
+from imageresizer.storage.base import Storage
+from imageresizer.storage.local import LocalStorage
+from imageresizer.storage.s3 import S3Storage
+
+
+@functools.cache
+def get_storage() -> Storage:
+    """
+    :return: the storage configured in the settings
+    """
+    if settings.storage_backend == "s3":
+        return S3Storage(
+            bucket=settings.s3_bucket,
+            prefix=settings.s3_prefix,
+            endpoint_url=settings.s3_endpoint_url,
+        )
+    return LocalStorage()
@@ -0,0 +1,213 @@
+"""
+Utility to pre-warm the cache, after a deploy or a cache wipe: the images listed in a
+manifest, or requested in an access log, are resized before clients request them
+"""
+import argparse
+import asyncio
+import dataclasses
+import fileinput
+import json
+import logging
+import re
+from typing import Iterable, Iterator
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from imageresizer.repository import crud, models
+from imageresizer.repository.database import SessionLocal
+from imageresizer.routers.dependencies import (
+    CLIENT_HEADER,
+    is_allowed_domain,
+    is_supported_schema,
+)
+from imageresizer.service import mapping, resizer, service, sourcecache
+from imageresizer.service.types import ImageFormat, ResizedImageLookup, ScaleType
+from imageresizer.settings import settings
+from imageresizer.storage.storage import get_storage
+
+# A request to the resize endpoint, in an access log line or a url
+_RESIZE_REQUEST = re.compile(r"/resize\?([^\s\"]+)")
+# The exclusive upper bound of the width and height, as in the resize endpoint
+_MAX_SIZE = 1024
+
+
+@dataclasses.dataclass
+class WarmStats:
+    """
+    What a warming of the cache did
+    """
+
+    resized_images: int = 0
+    # Already in the cache, and not expired
+    skipped_images: int = 0
+    failed_images: int = 0
+
+
+def _get_size(params: dict, name: str) -> int | None:
+    if (value := params.get(name)) is None:
+        return None
+    size = int(value)
+    if not 0 < size < _MAX_SIZE:
+        raise ValueError(f"Invalid {name} {size}")
+    return size
+
+
+def parse_line(line: str) -> ResizedImageLookup | None:
+    """
+    :param line: a line of a manifest, which is a json object with the query parameters of
+    the resize endpoint, or a resize url, or a line of an access log with a resize request
+    :return: the resized image to warm, or None if the line doesn't have one
+    """
+    line = line.strip()
+    if line.startswith("{"):
+        params = json.loads(line)
+    elif match := _RESIZE_REQUEST.search(line):
+        params = {name: values[0] for name, values in parse_qs(match.group(1)).items()}
+    else:
+        return None
+    if not (url := params.get("image_url")):
+        return None
+    image_format = params.get("image_format")
+    return ResizedImageLookup(
+        url=url,
+        width=_get_size(params, "width"),
+        height=_get_size(params, "height"),
+        image_format=ImageFormat(image_format) if image_format else None,
+        scale_type=ScaleType(params.get("scale_type") or ScaleType.FIT_XY),
+    )
+
+
+def read_lookups(lines: Iterable[str]) -> Iterator[ResizedImageLookup]:
+    """
+    :return: the resized images to warm, without duplicates, and without those which the
+    resize endpoint would refuse
+    """
+    keys = set()
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            lookup = parse_line(line)
+        except ValueError as error:
+            logging.warning("Skipping line %s: %s", line_number, error)
+            continue
+        if lookup is None:
+            continue
+        if not is_supported_schema(lookup.url) or not is_allowed_domain(lookup.url):
+            logging.warning(
+                "Skipping line %s: %s isn't allowed", line_number, lookup.url
+            )
+            continue
+        key = crud.get_lookup_key(mapping.map_lookup(lookup))
+        if key not in keys:
+            keys.add(key)
+            yield lookup
+
+
+class _OriginRateLimiter:
+    """
+    Spaces out the requests to each origin server
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, requests_per_s: float):
+        self._interval_s = 1 / requests_per_s
+        self._next_request_times: dict[str, float] = {}
+
+    async def wait(self, url: str):
+        """
+        Wait until a request can be sent to the origin server of the url
+        """
+        origin = urlparse(url).netloc
+        now = asyncio.get_running_loop().time()
+        request_time = max(now, self._next_request_times.get(origin, now))
+        self._next_request_times[origin] = request_time + self._interval_s
+        await asyncio.sleep(request_time - now)
+
+
+def _is_cached(session: Session, lookup: ResizedImageLookup) -> bool:
+    db_resized_image = crud.get_resized_image(session, mapping.map_lookup(lookup))
+    return (
+        db_resized_image is not None
+        and sourcecache.is_fresh(
+            db_resized_image.datetime,
+            db_resized_image.origin_max_age,
+            settings.cache_validity_s,
+        )
+        and get_storage().exists(db_resized_image.file)
+    )
+
+
+async def warm(
+    lookups: Iterable[ResizedImageLookup],
+    concurrency: int,
+    requests_per_s_per_origin: float,
+) -> WarmStats:
+    """
+    Resize the images which aren't in the cache yet, or which expired
+
+    :param lookups: the resized images to warm
+    :param concurrency: the number of images resized at the same time
+    :param requests_per_s_per_origin: the maximum rate of the requests to each origin server
+    """
+    stats = WarmStats()
+    rate_limiter = _OriginRateLimiter(requests_per_s_per_origin)
+    headers = {CLIENT_HEADER: "true", "User-Agent": "image-resizer"}
+    # Shared by the workers, so that each lookup is warmed once
+    remaining_lookups = iter(lookups)
+
+    async def warm_next():
+        for lookup in remaining_lookups:
+            with SessionLocal() as session:
+                if await run_in_threadpool(_is_cached, session, lookup):
+                    stats.skipped_images += 1
+                    continue
+                await rate_limiter.wait(lookup.url)
+                try:
+                    await service.resize(session, headers, lookup)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Error warming %s", lookup)
+                    stats.failed_images += 1
+                    continue
+            stats.resized_images += 1
+            logging.debug("Warmed %s", lookup)
+
+    await asyncio.gather(*(warm_next() for _ in range(concurrency)))
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename=settings.get_log_absolute_path("warm.log"), level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(
+        description="Resize the images listed in manifests or access logs, which aren't "
+        "in the cache yet"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="manifests, with a json object of resize parameters or a resize url per "
+        "line, or access logs, like image-resizer.log. Default is the standard input",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=settings.fetch_max_workers,
+        help="number of images resized at the same time. Default is %(default)s",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="max requests per second to each origin server. Default is %(default)s",
+    )
+    options = parser.parse_args()
+    models.create_db()
+    with fileinput.input(options.files, encoding="utf-8") as input_lines:
+        warm_stats = asyncio.run(
+            warm(read_lookups(input_lines), options.concurrency, options.rate)
+        )
+    resizer.shutdown()
+    logging.info("Warmed the cache: %s", warm_stats)
+    print(warm_stats)
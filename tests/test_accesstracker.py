@@ -0,0 +1,32 @@
+"""
+Access tracker tests
+"""
+import datetime
+
+from imageresizer.service.accesstracker import AccessTracker
+
+
+def test_access_written_once_per_interval():
+    """
+    When a resized image is accessed several times within the interval, only the
+    first access is written
+    """
+    access_tracker = AccessTracker(interval_s=60)
+    now = datetime.datetime.now()
+    assert access_tracker.is_due(1, now)
+    assert not access_tracker.is_due(1, now + datetime.timedelta(seconds=59))
+    assert access_tracker.is_due(2, now)
+    assert access_tracker.is_due(1, now + datetime.timedelta(seconds=60))
+
+
+def test_forgets_least_recently_accessed():
+    """
+    When too many resized images are accessed, the least recently accessed one is
+    forgotten, and its next access is written
+    """
+    access_tracker = AccessTracker(interval_s=60, max_entries=2)
+    now = datetime.datetime.now()
+    for resized_image_id in [1, 2, 1, 3]:
+        access_tracker.is_due(resized_image_id, now)
+    assert not access_tracker.is_due(1, now)
+    assert access_tracker.is_due(2, now)
@@ -0,0 +1,58 @@
+"""
+Animated image tests
+"""
+import os
+from pathlib import Path
+
+from PIL import Image, ImageSequence
+
+from imageresizer.service.animatedimage import AnimatedImage
+from imageresizer.settings import settings
+
+test_image_gif_path = Path(os.path.abspath(__file__)).parent / "data" / "animated.gif"
+
+
+def _save_resized(output_path: Path, size, image_format: str = "GIF"):
+    with Image.open(test_image_gif_path) as source:
+        AnimatedImage(source).resize(size, None).save(str(output_path), image_format)
+
+
+def test_resize_keeps_frames_and_durations(tmp_path):
+    """
+    When I resize an animated image, every frame is resized,
+    and keeps its duration
+    """
+    output_path = tmp_path / "resized.gif"
+    _save_resized(output_path, (75, 50))
+    with Image.open(test_image_gif_path) as source, Image.open(output_path) as image:
+        assert image.n_frames == source.n_frames
+        assert image.info["loop"] == source.info["loop"]
+        for source_frame, frame in zip(
+            ImageSequence.Iterator(source), ImageSequence.Iterator(image)
+        ):
+            assert frame.size == (75, 50)
+            assert frame.info["duration"] == source_frame.info["duration"]
+
+
+def test_resize_max_frames(tmp_path, monkeypatch):
+    """
+    When an animated image has more frames than the max frames,
+    the extra frames are dropped
+    """
+    monkeypatch.setattr(settings, "animated_image_max_frames", 1)
+    output_path = tmp_path / "resized.gif"
+    _save_resized(output_path, (75, 50))
+    with Image.open(output_path) as image:
+        assert image.n_frames == 1
+
+
+def test_resize_max_pixels(tmp_path, monkeypatch):
+    """
+    When the frames of an animated image exceed the max pixels,
+    the extra frames are dropped
+    """
+    monkeypatch.setattr(settings, "animated_image_max_pixels", 75 * 50)
+    output_path = tmp_path / "resized.webp"
+    _save_resized(output_path, (75, 50), "WEBP")
+    with Image.open(output_path) as image:
+        assert getattr(image, "n_frames", 1) == 1
@@ -1,8 +1,11 @@
 """
 Api tests
 """
+import asyncio
 import io
 import os
+import subprocess
+import sys
 from http import HTTPStatus
 from pathlib import Path
 
@@ -10,9 +13,18 @@ import pytest
 from PIL import Image
 from fastapi.testclient import TestClient
 from requests import Response
+from starlette.requests import Request
 
+from imageresizer import purge
 from imageresizer.main import app, setup
+from imageresizer.repository.database import SessionLocal
+from imageresizer.routers import responses
+from imageresizer.service import service
+from imageresizer.service.hotcache import HotCache
 from imageresizer.service.geometry import Size
+from imageresizer.service.types import ImageResponseData
+from imageresizer.settings import settings
+from imageresizer.storage.local import LocalStorage
 
 
 def _get_test_image_uri(test_image_filename: str) -> str:
@@ -163,3 +175,358 @@ def test_denied_domain():
     """
     response = client.get("/resize?image_url=https://baddomain.com/image.png")
     assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_resize_queue_full(monkeypatch):
+    """
+    When too many images are already waiting to be resized, the server returns
+    an error response
+    """
+    monkeypatch.setattr(settings, "resize_max_workers", 0)
+    monkeypatch.setattr(settings, "resize_max_queue_size", 0)
+    response = client.get(f"/resize?image_url={test_image_png_uri}&width=3&height=7")
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def test_source_image_too_large(monkeypatch):
+    """
+    When the source image has more pixels than allowed, the server returns an error
+    response without resizing it
+    """
+    monkeypatch.setattr(settings, "source_image_max_pixels", 100)
+    response = client.get(
+        f"/resize?image_url={test_image_png_uri.replace('file://', 'file://localhost')}"
+        "&width=3&height=7"
+    )
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_resize_batch():
+    """
+    When I resize an image to several sizes at once, I get the urls of images
+    with each size
+    """
+    specs = [
+        {"width": 30, "height": 20},
+        {"width": 120, "scale_type": "crop"},
+        {"height": 10, "image_format": "webp"},
+        {"width": 80, "height": 20, "scale_type": "crop"},
+    ]
+    response = client.post(
+        f"/resize/batch?image_url={test_image_png_uri}",
+        json=specs,
+    )
+    assert response.status_code == HTTPStatus.OK
+    resized_images = response.json()
+    assert len(resized_images) == len(specs)
+    for resized_image, expected_size in zip(
+        resized_images, [(30, 20), (120, 80), (15, 10), (80, 20)]
+    ):
+        _assert_expected_size(client.get(resized_image["url"]), expected_size)
+
+
+def test_resize_batch_empty():
+    """
+    When I resize an image to no sizes at once, I get a 422 error code
+    """
+    response = client.post(f"/resize/batch?image_url={test_image_png_uri}", json=[])
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_hot_cache_stats():
+    """
+    When I request the same image twice, the second request is a hit in the hot cache
+    """
+    hits = client.get("/stats/hot-cache").json()["hits"]
+    image_url = f"/resize?image_url={test_image_png_uri}&width=11&image_format=png"
+    client.get(image_url)
+    _assert_expected_size(client.get(image_url), expected_size=(11, 7))
+    assert client.get("/stats/hot-cache").json()["hits"] == hits + 1
+
+
+def test_caching_headers():
+    """
+    When I resize an image, the response has headers to let clients cache it
+    """
+    response = client.get(f"/resize?image_url={test_image_png_uri}&width=13")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["etag"].startswith('"')
+    assert response.headers["last-modified"]
+    assert response.headers["cache-control"].startswith("public, max-age=")
+
+
+def test_if_none_match():
+    """
+    When I already have the current version of a resized image, I get an empty
+    304 response
+    """
+    image_url = f"/resize?image_url={test_image_png_uri}&width=14"
+    etag = client.get(image_url).headers["etag"]
+    response = client.get(image_url, headers={"If-None-Match": f"W/{etag}"})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.headers["etag"] == etag
+    assert not response.content
+    response = client.get(image_url, headers={"If-None-Match": '"other"'})
+    _assert_expected_size(response, expected_size=(14, 9))
+
+
+def test_if_modified_since():
+    """
+    When my copy of a resized image is not older than the resized image, I get an
+    empty 304 response
+    """
+    image_url = f"/resize?image_url={test_image_png_uri}&width=15"
+    last_modified = client.get(image_url).headers["last-modified"]
+    response = client.get(image_url, headers={"If-Modified-Since": last_modified})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    response = client.get(
+        image_url, headers={"If-Modified-Since": "Sat, 01 Jan 2000 00:00:00 GMT"}
+    )
+    _assert_expected_size(response, expected_size=(15, 10))
+
+
+def test_purge_stats(monkeypatch):
+    """
+    When I get the purge stats, I get what the last purge deleted
+    """
+    monkeypatch.setattr(settings, "cache_clean_interval_s", 0)
+    stats = purge.purge_if_due()
+    response = client.get("/stats/purge")
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()["bytes_freed"] == stats.bytes_freed
+    assert response.json()["duration_s"] == stats.duration_s
+
+
+def _get_metric(metrics_text: str, sample: str) -> float:
+    for line in metrics_text.splitlines():
+        if line.startswith(f"{sample} "):
+            return float(line.split()[1])
+    return 0.0
+
+
+def test_metrics():
+    """
+    When I resize images, the metrics show the time spent in each stage, and the cache
+    misses and hits
+    """
+    before = client.get("/metrics").text
+    image_url = test_image_png_uri.replace("file://", "file://localhost")
+    for _ in range(2):
+        response = client.get(f"/resize?image_url={image_url}&width=13&height=17")
+        assert response.status_code == HTTPStatus.OK
+    response = client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("text/plain")
+    for stage in ["db_lookup", "fetch", "decode", "resize", "encode", "serve"]:
+        sample = f'imageresizer_stage_duration_seconds_count{{stage="{stage}"}}'
+        assert _get_metric(response.text, sample) > _get_metric(before, sample)
+    for result in ["miss", "hot"]:
+        sample = f'imageresizer_cache_requests_total{{result="{result}"}}'
+        assert _get_metric(response.text, sample) == _get_metric(before, sample) + 1
+    assert _get_metric(response.text, "imageresizer_served_bytes_total") > 0
+
+
+def test_metrics_stored_whatever_the_import_order():
+    """
+    When a process imports prometheus_client before the metrics, its metrics are still
+    stored in the metrics dir, where the /metrics endpoint aggregates them
+    """
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if name != "PROMETHEUS_MULTIPROC_DIR"
+    }
+    pid = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import os, prometheus_client\n"
+            "from imageresizer import metrics\n"
+            "metrics.stale_served.inc()\n"
+            "print(os.getpid())",
+        ],
+        cwd=Path(__file__).parent.parent,
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+    metrics_file = Path(settings.cache_metrics_dir) / f"counter_{pid}.db"
+    assert metrics_file.exists()
+    metrics_file.unlink()
+
+
+class _RemoteStorage(LocalStorage):
+    """
+    A stand-in for a storage whose files aren't on the local disk
+    """
+
+    def get_local_path(self, key: str) -> str | None:
+        return None
+
+
+def test_resize_streamed_from_storage(monkeypatch):
+    """
+    When the resized image is neither in memory nor on the local disk, it's streamed
+    from the storage
+    """
+    monkeypatch.setattr(responses, "get_storage", _RemoteStorage)
+    monkeypatch.setattr(
+        service, "hot_cache", HotCache(max_bytes=1024, max_content_bytes=0)
+    )
+    response = client.get(f"/resize?image_url={test_image_png_uri}&width=16")
+    _assert_expected_size(response, expected_size=(16, 10))
+    assert int(response.headers["content-length"]) == len(response.content)
+
+
+def test_slow_request_profiled(monkeypatch, tmp_path):
+    """
+    When requests are profiled, and a request is slower than the threshold, its trace is
+    written in the log folder
+    """
+    monkeypatch.setattr(settings, "profile_requests", True)
+    monkeypatch.setattr(settings, "profile_slow_request_threshold_s", 0.0)
+    monkeypatch.setattr(settings, "log_dir", str(tmp_path))
+    response = client.get(f"/resize?image_url={test_image_png_uri}&width=19&height=23")
+    assert response.status_code == HTTPStatus.OK
+    traces = list((tmp_path / "profiles").glob("*.txt"))
+    assert len(traces) == 1
+    trace = traces[0].read_text(encoding="utf-8")
+    assert "source_format: PNG" in trace
+    assert "Stages:" in trace
+    assert "resize" in trace
+    assert traces[0].with_suffix(".prof").exists()
+
+
+def test_request_profiled_with_token(monkeypatch, tmp_path):
+    """
+    When a profile token is set, only the requests with the token are profiled
+    """
+    monkeypatch.setattr(settings, "profile_token", "secret")
+    monkeypatch.setattr(settings, "profile_slow_request_threshold_s", 0.0)
+    monkeypatch.setattr(settings, "log_dir", str(tmp_path))
+    for token in ["wrong", "secret"]:
+        response = client.get(
+            f"/resize?image_url={test_image_png_uri}&width=31&height=37",
+            headers={"x-image-resizer-profile": token},
+        )
+        assert response.status_code == HTTPStatus.OK
+    assert len(list((tmp_path / "profiles").glob("*.txt"))) == 1
+
+
+@pytest.mark.parametrize("max_content_bytes", [256 * 1024, 0])
+def test_resize_range(monkeypatch, max_content_bytes):
+    """
+    When I request a range of a resized image, in memory or on the local disk, I get
+    only that range
+    """
+    monkeypatch.setattr(
+        service,
+        "hot_cache",
+        HotCache(max_bytes=1024 * 1024, max_content_bytes=max_content_bytes),
+    )
+    url = f"/resize?image_url={test_image_png_uri}&width=41"
+    content = client.get(url).content
+    response = client.get(url, headers={"range": "bytes=10-19"})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.headers["content-range"] == f"bytes 10-19/{len(content)}"
+    assert response.content == content[10:20]
+    response = client.get(url, headers={"range": "bytes=-5"})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.content == content[-5:]
+    response = client.get(url, headers={"range": f"bytes={len(content)}-"})
+    assert response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.headers["content-range"] == f"bytes */{len(content)}"
+    response = client.get(url, headers={"range": "bytes=0-9", "if-range": '"other"'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.content == content
+
+
+def test_resize_range_streamed_from_storage(monkeypatch):
+    """
+    When I request a range of a resized image which is streamed from the storage, I get
+    only that range
+    """
+    monkeypatch.setattr(responses, "get_storage", _RemoteStorage)
+    monkeypatch.setattr(
+        service, "hot_cache", HotCache(max_bytes=1024, max_content_bytes=0)
+    )
+    url = f"/resize?image_url={test_image_png_uri}&width=43"
+    content = client.get(url).content
+    response = client.get(url, headers={"range": "bytes=5-"})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert int(response.headers["content-length"]) == len(content) - 5
+    assert response.content == content[5:]
+
+
+def test_resize_sent_by_proxy(monkeypatch):
+    """
+    When sending the files is delegated to the proxy, the response only tells the proxy
+    which file to send
+    """
+    monkeypatch.setattr(settings, "sendfile_header", "x-accel-redirect")
+    monkeypatch.setattr(
+        service, "hot_cache", HotCache(max_bytes=1024, max_content_bytes=0)
+    )
+    response = client.get(f"/resize?image_url={test_image_png_uri}&width=47")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].lower() == "image/png"
+    assert response.content == b""
+    location = response.headers["x-accel-redirect"]
+    assert location.startswith("/cached-images/")
+    relative_path = location.removeprefix("/cached-images/")
+    assert (Path(settings.cache_image_dir) / relative_path).is_file()
+
+
+def test_file_outside_cache_dir_sent_by_server(monkeypatch, tmp_path):
+    """
+    When sending the files is delegated to the proxy, a file outside of the cache image
+    dir, saved before the cache dir changed, is sent by the server instead
+    """
+    monkeypatch.setattr(settings, "sendfile_header", "x-accel-redirect")
+    path = tmp_path / "image.png"
+    path.write_bytes(bytes(range(100)))
+    response = responses.image_response(
+        Request({"type": "http", "headers": []}),
+        ImageResponseData(file=str(path), mime_type="image/png", file_size=100),
+    )
+    assert isinstance(response, responses.LocalFileResponse)
+    assert "x-accel-redirect" not in response.headers
+
+
+def test_local_file_sent_by_server(tmp_path):
+    """
+    When the server supports the zero-copy send extension, it sends the local files itself
+    """
+    path = tmp_path / "image.png"
+    path.write_bytes(bytes(range(100)))
+    response = responses.LocalFileResponse(
+        str(path), 10, 29, status_code=206, media_type="image/png", headers={}
+    )
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "extensions": {"http.response.zerocopysend": {}}}
+    asyncio.run(response(scope, None, send))
+    assert (b"content-length", b"20") in messages[0]["headers"]
+    assert messages[1]["type"] == "http.response.zerocopysend"
+    assert (messages[1]["offset"], messages[1]["count"]) == (10, 20)
+    assert messages[1]["file"].name == str(path)
+
+
+def test_resize_after_evicted_from_disk(monkeypatch):
+    """
+    When a resized image whose file only is in the hot cache is evicted from the disk,
+    requesting it again resizes it again
+    """
+    monkeypatch.setattr(
+        service, "hot_cache", HotCache(max_bytes=1024 * 1024, max_content_bytes=10)
+    )
+    url = f"/resize?image_url={test_image_png_uri}&width=53&height=59"
+    assert client.get(url).status_code == HTTPStatus.OK
+    with SessionLocal() as session:
+        purge.evict_least_recently_used_images(session, max_bytes=0)
+    response = client.get(url)
+    _assert_expected_size(response, expected_size=(53, 59))
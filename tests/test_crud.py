@@ -0,0 +1,115 @@
+"""
+CRUD tests
+"""
+import pytest
+from sqlalchemy import text
+
+from imageresizer.repository import crud, database, models
+from imageresizer.repository.database import SessionLocal
+
+models.create_db()
+
+
+def _lookup(url: str, image_format: crud.ImageFormat = None):
+    return crud.ResizedImageLookup(
+        url=url,
+        width=10,
+        height=20,
+        image_format=image_format,
+        scale_type=crud.ScaleType.FIT_XY,
+    )
+
+
+def test_create_resized_image_upserts():
+    """
+    When two workers create the same resized image, there is only one resized image,
+    with the file of the last one
+    """
+    lookup = _lookup("https://a/upsert", crud.ImageFormat.PNG)
+    with SessionLocal() as session, SessionLocal() as other_session:
+        first = crud.create_resized_image(session, lookup, "first", "image/png")
+        second = crud.create_resized_image(other_session, lookup, "second", "image/png")
+        assert second.id == first.id
+        session.expire_all()
+        assert crud.get_resized_image(session, lookup).file == "second"
+        assert (
+            session.query(models.ResizedImage)
+            .filter(models.ResizedImage.url == lookup.url)
+            .count()
+            == 1
+        )
+
+
+def test_get_resized_image_without_format():
+    """
+    When a resized image has the format of its source image, I can read it, and it's
+    only created once
+    """
+    lookup = _lookup("https://a/no-format")
+    with SessionLocal() as session:
+        db_resized_image = crud.create_resized_image(
+            session, lookup, "no-format", "image/png"
+        )
+        crud.create_resized_image(session, lookup, "no-format-2", "image/png")
+        assert crud.get_resized_image(session, lookup).id == db_resized_image.id
+        assert crud.get_resized_image(session, lookup).file == "no-format-2"
+
+
+def test_lookup_keys_migrated():
+    """
+    When resized images were created before the lookup key was stored, the migration
+    fills it in, and only keeps the latest of duplicate resized images
+    """
+    with SessionLocal() as session:
+        for file in ["legacy-1", "legacy-2", "legacy-3"]:
+            session.execute(
+                text(
+                    "INSERT INTO resized_images (url, width, height, scale_type, file) "
+                    "VALUES ('https://a/legacy', 10, 20, 1, :file)"
+                ),
+                {"file": file},
+            )
+        session.commit()
+
+        models.create_db()
+
+        db_resized_images = (
+            session.query(models.ResizedImage)
+            .filter(models.ResizedImage.url == "https://a/legacy")
+            .all()
+        )
+        assert [db_resized_image.file for db_resized_image in db_resized_images] == [
+            "legacy-3"
+        ]
+        assert (
+            crud.get_resized_image(session, _lookup("https://a/legacy")).file
+            == "legacy-3"
+        )
+
+
+def test_create_source_image_upserts():
+    """
+    When two workers create the same source image, there is only one source image,
+    with the file of the last one
+    """
+    with SessionLocal() as session:
+        first = crud.create_source_image(session, "https://a/source", "first", 1)
+        second = crud.create_source_image(session, "https://a/source", "second", 2)
+        assert (second.id, second.file, second.file_size) == (first.id, "second", 2)
+
+
+def test_unsupported_database():
+    """
+    When the database is neither sqlite nor postgresql, the server fails to start with a
+    clear error, instead of failing each request
+    """
+    with pytest.raises(RuntimeError, match="Unsupported database mysql"):
+        database._get_backend_name(  # pylint: disable=protected-access
+            "mysql://user@localhost/images"
+        )
+    assert (
+        database._get_backend_name(  # pylint: disable=protected-access
+            "postgresql+psycopg2://user@localhost/images"
+        )
+        == "postgresql"
+    )
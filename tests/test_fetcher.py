@@ -0,0 +1,232 @@
+"""
+Fetcher tests
+"""
+import asyncio
+import io
+import threading
+from email.message import Message
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.error import HTTPError
+
+import pytest
+from PIL import Image
+
+from imageresizer.service import fetcher
+from imageresizer.service.fetcher import OriginImageRejectedError
+from imageresizer.service.types import OriginValidators
+from imageresizer.settings import settings
+
+test_image_path = Path(__file__).parent / "data" / "150x100.png"
+
+
+# pylint: disable=too-few-public-methods
+class _UnsizedResponse(io.BytesIO):
+    """
+    A response without Content-Type nor Content-Length headers
+    """
+
+    headers = Message()
+
+
+def test_fetch_image():
+    """
+    When I fetch an image, I get its content and its size
+    """
+    origin_response = asyncio.run(fetcher.fetch(test_image_path.as_uri(), {}))
+    with origin_response.content:
+        assert origin_response.content.read() == test_image_path.read_bytes()
+    assert origin_response.size == test_image_path.stat().st_size
+
+
+def test_fetch_large_image_spooled_to_disk(tmp_path, monkeypatch):
+    """
+    When I fetch an image larger than the in-memory buffer, I get all of its content
+    """
+    monkeypatch.setattr(settings, "fetch_spool_max_memory_bytes", 1024)
+    image_file = tmp_path / "noise.png"
+    Image.effect_noise((400, 400), 64).save(image_file)
+    origin_response = asyncio.run(fetcher.fetch(image_file.as_uri(), {}))
+    with origin_response.content:
+        assert origin_response.content.read() == image_file.read_bytes()
+
+
+def test_fetch_declared_too_large(monkeypatch):
+    """
+    When the origin declares an image larger than the maximum size, it is rejected
+    """
+    monkeypatch.setattr(settings, "fetch_max_bytes", 100)
+    with pytest.raises(OriginImageRejectedError):
+        asyncio.run(fetcher.fetch(test_image_path.as_uri(), {}))
+
+
+def test_fetch_streamed_too_large(monkeypatch):
+    """
+    When the origin sends more than the maximum size without declaring it, the download
+    is stopped
+    """
+    monkeypatch.setattr(settings, "fetch_max_bytes", 1000)
+    with pytest.raises(OriginImageRejectedError):
+        fetcher._download(  # pylint: disable=protected-access
+            _UnsizedResponse(b"x" * 10_000)
+        )
+
+
+def test_fetch_too_many_pixels(monkeypatch):
+    """
+    When the header of an image shows that it has too many pixels, it is rejected
+    """
+    monkeypatch.setattr(settings, "source_image_max_pixels", 150 * 100 - 1)
+    with pytest.raises(OriginImageRejectedError):
+        asyncio.run(fetcher.fetch(test_image_path.as_uri(), {}))
+
+
+def test_fetch_large_header_sniffed_early(monkeypatch):
+    """
+    When the header of an image is larger than the first bytes sniffed, it's sniffed again
+    a few times as the download grows, and an image with too many pixels is still rejected
+    before it is completely downloaded
+    """
+    image = io.BytesIO()
+    Image.new("RGB", (150, 100)).save(image, "jpeg", icc_profile=b"x" * 300_000)
+    response = _UnsizedResponse(image.getvalue() + b"\0" * 4_000_000)
+    sniffs = []
+
+    def _counting_sniff(content):
+        sniffs.append(content)
+        return sniff(content)
+
+    sniff = fetcher._sniff  # pylint: disable=protected-access
+    monkeypatch.setattr(fetcher, "_sniff", _counting_sniff)
+    monkeypatch.setattr(settings, "source_image_max_pixels", 150 * 100 - 1)
+    with pytest.raises(OriginImageRejectedError):
+        fetcher._download(response)  # pylint: disable=protected-access
+    assert len(sniffs) <= 4
+    assert response.tell() < 1_000_000
+
+
+def test_fetch_unidentified_header_rejected_early():
+    """
+    When the first bytes of a large download still aren't an image after a few sniffs, it
+    is rejected before it is completely downloaded
+    """
+    response = _UnsizedResponse(b"\0" * 10_000_000)
+    with pytest.raises(OriginImageRejectedError):
+        fetcher._download(response)  # pylint: disable=protected-access
+    assert response.tell() < 2_000_000
+
+
+def test_fetch_not_an_image(tmp_path):
+    """
+    When the url isn't an image, it is rejected
+    """
+    page = tmp_path / "page.html"
+    page.write_text("<html></html>")
+    with pytest.raises(OriginImageRejectedError):
+        asyncio.run(fetcher.fetch(page.as_uri(), {}))
+    with pytest.raises(OriginImageRejectedError):
+        fetcher._download(  # pylint: disable=protected-access
+            _UnsizedResponse(b"<html></html>")
+        )
+
+
+class _OriginHandler(BaseHTTPRequestHandler):
+    """
+    An origin server, which keeps the connections alive
+    """
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    unavailable = 0
+
+    def setup(self):
+        super().setup()
+        _OriginHandler.connections += 1
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Respond with the test image, or with an error
+        """
+        if self.path == "/unavailable" and _OriginHandler.unavailable > 0:
+            _OriginHandler.unavailable -= 1
+            self._respond(HTTPStatus.SERVICE_UNAVAILABLE, b"")
+        elif self.path == "/missing":
+            self._respond(HTTPStatus.NOT_FOUND, b"")
+        elif self.headers.get("If-None-Match") == '"v1"':
+            self._respond(HTTPStatus.NOT_MODIFIED, None)
+        else:
+            self._respond(HTTPStatus.OK, test_image_path.read_bytes())
+
+    def _respond(self, status: HTTPStatus, content: bytes | None):
+        self.send_response(status)
+        self.send_header("ETag", '"v1"')
+        if content is not None:
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if content:
+            self.wfile.write(content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture(name="origin_url")
+def fixture_origin_url():
+    """
+    :return: the url of a local origin server
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _OriginHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    _OriginHandler.connections = 0
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_reuses_connections(origin_url):
+    """
+    When I fetch several images from the same origin, the connection is reused
+    """
+    for _ in range(3):
+        origin_response = asyncio.run(fetcher.fetch(f"{origin_url}/image.png", {}))
+        origin_response.content.close()
+        assert origin_response.size == test_image_path.stat().st_size
+    assert _OriginHandler.connections == 1
+
+
+def test_fetch_not_modified(origin_url):
+    """
+    When I fetch an image with the validators of the current image, I get a not
+    modified response
+    """
+    origin_response = asyncio.run(
+        fetcher.fetch(
+            f"{origin_url}/image.png", {}, OriginValidators(etag='"v1"', max_age=60)
+        )
+    )
+    assert origin_response.not_modified
+    assert origin_response.validators.etag == '"v1"'
+
+
+def test_fetch_retries_unavailable_origin(origin_url):
+    """
+    When the origin is temporarily unavailable, the request is retried
+    """
+    _OriginHandler.unavailable = 1
+    origin_response = asyncio.run(fetcher.fetch(f"{origin_url}/unavailable", {}))
+    origin_response.content.close()
+    assert _OriginHandler.unavailable == 0
+
+
+def test_fetch_missing_image(origin_url):
+    """
+    When the origin doesn't have the image, I get its error status
+    """
+    with pytest.raises(HTTPError) as error:
+        asyncio.run(fetcher.fetch(f"{origin_url}/missing", {}))
+    assert error.value.status == HTTPStatus.NOT_FOUND
@@ -5,7 +5,14 @@ from typing import Optional
 
 import pytest
 
-from imageresizer.service.geometry import ResizeGeometry, get_resize_geometry, Size, Box
+from imageresizer.service.geometry import (
+    ResizeGeometry,
+    get_resize_geometry,
+    Size,
+    Box,
+    get_minimum_source_size,
+    scale_resize_geometry,
+)
 from imageresizer.service.types import ScaleType
 
 
@@ -187,3 +194,47 @@ def test_get_negative_height(scale_type: ScaleType):
     _test_get_resize_geometry(
         (150, 100), 75, -5, scale_type, ResizeGeometry(size=(75, 50))
     )
+
+
+def test_get_minimum_source_size():
+    """
+    The minimum source size provides at least the pixels of the target size,
+    in the region of the source image which is resized
+    """
+    assert get_minimum_source_size((6000, 4000), ResizeGeometry(size=(300, 200))) == (
+        300,
+        200,
+    )
+    assert get_minimum_source_size(
+        (6000, 4000),
+        ResizeGeometry(
+            size=(100, 100), box=Box(left=1000, top=0, right=5000, bottom=4000)
+        ),
+    ) == (150, 100)
+
+
+def test_get_minimum_source_size_larger_target():
+    """
+    When the target size is larger than the source, the minimum source size is the source size
+    """
+    assert get_minimum_source_size((150, 100), ResizeGeometry(size=(300, 50))) == (
+        150,
+        50,
+    )
+
+
+def test_scale_resize_geometry():
+    """
+    When the source image is scaled, the box of the geometry is scaled with it
+    """
+    resize_geometry = ResizeGeometry(
+        size=(100, 100), box=Box(left=1000, top=0, right=5000, bottom=4000)
+    )
+    assert scale_resize_geometry(
+        resize_geometry, (6000, 4000), (750, 500)
+    ) == ResizeGeometry(
+        size=(100, 100), box=Box(left=125, top=0, right=625, bottom=500)
+    )
+    assert scale_resize_geometry(
+        ResizeGeometry(size=(100, 50)), (6000, 4000), (750, 500)
+    ) == ResizeGeometry(size=(100, 50))
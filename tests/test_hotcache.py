@@ -0,0 +1,63 @@
+"""
+Hot cache tests
+"""
+import datetime
+
+from imageresizer.service.hotcache import HotCache
+from imageresizer.service.types import ImageResponseData
+
+
+def _image(name: str, content_size: int = 0, expires_in_s: int = 60):
+    return ImageResponseData(
+        file=name,
+        mime_type="image/png",
+        expires=datetime.datetime.now() + datetime.timedelta(seconds=expires_in_s),
+        content=b"x" * content_size,
+    )
+
+
+def test_get_counts_hits_and_misses():
+    """
+    When I get entries from the hot cache, hits and misses are counted
+    """
+    hot_cache = HotCache(max_bytes=100_000, max_content_bytes=1000)
+    hot_cache.put("a", _image("a", 10))
+    assert hot_cache.get("a").file == "a"
+    assert hot_cache.get("b") is None
+    stats = hot_cache.stats
+    assert (stats.hits, stats.misses, stats.entries) == (1, 1, 1)
+
+
+def test_expired_entry():
+    """
+    When an entry is expired, it's not returned
+    """
+    hot_cache = HotCache(max_bytes=100_000, max_content_bytes=1000)
+    hot_cache.put("a", _image("a", expires_in_s=-1))
+    assert hot_cache.get("a") is None
+    assert hot_cache.stats.entries == 0
+
+
+def test_large_content_not_kept():
+    """
+    When the content of an image is larger than the max content bytes,
+    only its file is kept
+    """
+    hot_cache = HotCache(max_bytes=100_000, max_content_bytes=1000)
+    hot_cache.put("a", _image("a", 2000))
+    assert hot_cache.get("a").content is None
+
+
+def test_least_recently_used_evicted():
+    """
+    When the cache is full, the least recently used entries are evicted
+    """
+    hot_cache = HotCache(max_bytes=3 * (512 + 1000), max_content_bytes=1000)
+    for key in ["a", "b", "c"]:
+        hot_cache.put(key, _image(key, 1000))
+    hot_cache.get("a")
+    hot_cache.put("d", _image("d", 1000))
+    assert hot_cache.get("b") is None
+    for key in ["a", "c", "d"]:
+        assert hot_cache.get(key).file == key
+    assert hot_cache.stats.bytes <= 3 * (512 + 1000)
@@ -0,0 +1,40 @@
+"""
+Lookup key tests
+"""
+import pytest
+
+from imageresizer.repository.lookupkey import canonicalize_url, get_lookup_key
+
+
+@pytest.mark.parametrize(
+    "url, expected_url",
+    [
+        ("HTTPS://Example.COM/Image.png", "https://example.com/Image.png"),
+        ("https://example.com:443/image.png", "https://example.com/image.png"),
+        ("http://example.com:8080/image.png", "http://example.com:8080/image.png"),
+        ("https://example.com", "https://example.com/"),
+        ("https://example.com/image.png#top", "https://example.com/image.png"),
+        ("https://example.com/i.png?b=1&a=2", "https://example.com/i.png?b=1&a=2"),
+        ("https://user:pw@[::1]:443/i.png", "https://user:pw@[::1]/i.png"),
+        ("file:///tmp/image.png", "file:///tmp/image.png"),
+    ],
+)
+def test_canonicalize_url(url, expected_url):
+    """
+    When I canonicalize a url, the parts which don't change the resource are normalized
+    """
+    assert canonicalize_url(url) == expected_url
+
+
+def test_lookup_key():
+    """
+    When I get the lookup keys of resized images, they are equal for equivalent urls,
+    and different for different resize parameters
+    """
+    lookup_key = get_lookup_key("https://example.com/image.png", 10, 20, 5, 1)
+    assert len(lookup_key) == 64
+    assert lookup_key == get_lookup_key("HTTPS://EXAMPLE.COM/image.png", 10, 20, 5, 1)
+    assert lookup_key != get_lookup_key(
+        "https://example.com/image.png", 10, 20, None, 1
+    )
+    assert lookup_key != get_lookup_key("https://example.com/image.png", 1, 20, 5, 1)
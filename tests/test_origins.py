@@ -0,0 +1,97 @@
+"""
+Origin server protection tests
+"""
+import asyncio
+from urllib.error import URLError
+
+import pytest
+
+from imageresizer.service.origins import (
+    CircuitBreaker,
+    OriginUnavailableError,
+    Origins,
+)
+from imageresizer.settings import settings
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    """
+    When an origin server fails too many times in a row, its requests are rejected until
+    the open duration has passed
+    """
+    breaker = CircuitBreaker(failure_threshold=3, open_s=10)
+    for _ in range(2):
+        assert breaker.allow(0)
+        breaker.record_failure(0)
+    breaker.record_success()
+    for _ in range(3):
+        assert breaker.allow(1)
+        breaker.record_failure(1)
+    assert not breaker.allow(2)
+    assert breaker.retry_after_s(2) == 9
+    assert breaker.allow(11)
+
+
+def test_circuit_breaker_trial_request():
+    """
+    When an open breaker lets a request through, no other request is sent until it
+    completes: the breaker closes if it succeeds, and opens again if it fails
+    """
+    breaker = CircuitBreaker(failure_threshold=1, open_s=10)
+    breaker.record_failure(0)
+    assert breaker.allow(10)
+    assert not breaker.allow(10)
+    breaker.record_failure(10)
+    assert not breaker.allow(15)
+    assert breaker.allow(20)
+    breaker.record_success()
+    assert breaker.allow(20)
+    assert breaker.allow(20)
+
+
+def test_failing_origin_fails_fast(monkeypatch):
+    """
+    When an origin server keeps failing, the next requests to it fail without being sent,
+    and the requests to other origin servers are still sent
+    """
+    monkeypatch.setattr(settings, "origin_failure_threshold", 2)
+    origins = Origins()
+
+    async def _request(url: str, error: Exception | None):
+        async with origins.limit(url):
+            if error:
+                raise error
+
+    for _ in range(2):
+        with pytest.raises(URLError):
+            asyncio.run(_request("https://slow.example.com/a.png", URLError("down")))
+    with pytest.raises(OriginUnavailableError):
+        asyncio.run(_request("https://slow.example.com/b.png", None))
+    asyncio.run(_request("https://example.com/a.png", None))
+
+
+def test_busy_origin_queue_timeout(monkeypatch):
+    """
+    When too many requests to an origin server are in flight, the next one waits for the
+    queue timeout, then fails
+    """
+    monkeypatch.setattr(settings, "origin_max_concurrent_fetches", 1)
+    monkeypatch.setattr(settings, "origin_queue_timeout_s", 0.01)
+    origins = Origins()
+
+    async def _requests():
+        release = asyncio.Event()
+
+        async def _request():
+            async with origins.limit("https://example.com/a.png"):
+                await release.wait()
+
+        in_flight = asyncio.create_task(_request())
+        await asyncio.sleep(0)
+        with pytest.raises(OriginUnavailableError):
+            async with origins.limit("https://example.com/b.png"):
+                pass
+        release.set()
+        await in_flight
+
+    asyncio.run(_requests())
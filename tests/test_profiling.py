@@ -0,0 +1,32 @@
+"""
+Profiling tests
+"""
+import asyncio
+import threading
+
+from imageresizer import profiling
+from imageresizer.settings import settings
+
+
+def test_trace_written_off_event_loop(monkeypatch):
+    """
+    When a profiled request is slow, its trace is written in the threadpool, not on the
+    event loop thread
+    """
+    monkeypatch.setattr(settings, "profile_slow_request_threshold_s", 0.0)
+    writing_threads = []
+
+    def _write_trace(trace, *_):
+        writing_threads.append(threading.current_thread())
+        assert trace.details == {"url": "https://a/image.png"}
+        assert "fetch" in trace.stages
+
+    monkeypatch.setattr(profiling, "_write_trace", _write_trace)
+
+    async def _request():
+        async with profiling.trace_request(True, url="https://a/image.png"):
+            profiling.record_stage("fetch", 0.1)
+
+    asyncio.run(_request())
+    assert len(writing_threads) == 1
+    assert writing_threads[0] is not threading.main_thread()
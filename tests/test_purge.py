@@ -0,0 +1,210 @@
+"""
+Purge tests
+"""
+import datetime
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+from imageresizer import purge
+from imageresizer.filelock import file_lock
+from imageresizer.repository import crud, models
+from imageresizer.repository.database import SessionLocal
+from imageresizer.settings import settings
+
+models.create_db()
+
+
+def _create_source_image(session, url: str, file_size: int, age_s: int):
+    with NamedTemporaryFile(delete=False, dir=settings.cache_source_dir) as file:
+        file.write(b"x" * file_size)
+    db_source_image = crud.create_source_image(
+        session, url, file=file.name, file_size=file_size
+    )
+    db_source_image.datetime = datetime.datetime.now() - datetime.timedelta(
+        seconds=age_s
+    )
+    session.commit()
+    return db_source_image
+
+
+def _create_resized_image(
+    session, url: str, file_size: int, age_s: int, file: str = None
+):
+    if file is None:
+        with NamedTemporaryFile(delete=False, dir=settings.cache_image_dir) as new_file:
+            new_file.write(b"x" * file_size)
+        file = new_file.name
+    db_resized_image = crud.create_resized_image(
+        session,
+        crud.ResizedImageLookup(url=url, scale_type=crud.ScaleType.FIT_XY),
+        file=file,
+        mime_type="image/png",
+        file_size=file_size,
+    )
+    db_resized_image.datetime = datetime.datetime.now() - datetime.timedelta(
+        seconds=age_s
+    )
+    db_resized_image.last_accessed = db_resized_image.datetime
+    session.commit()
+    return db_resized_image
+
+
+def _get_remaining_resized_image_urls(session) -> list[str]:
+    return [
+        resized_image.url
+        for resized_image in session.query(models.ResizedImage).order_by(
+            models.ResizedImage.url
+        )
+    ]
+
+
+def test_purge_old_images_in_batches():
+    """
+    When I purge old images in batches smaller than the number of expired images,
+    all the expired images are deleted
+    """
+    with SessionLocal() as session:
+        session.query(models.ResizedImage).delete()
+        resized_images = [
+            _create_resized_image(session, f"https://a/expired{index}", 10, 1000)
+            for index in range(5)
+        ] + [_create_resized_image(session, "https://a/recent", 10, 10)]
+        files = {
+            resized_image.url: resized_image.file for resized_image in resized_images
+        }
+
+        stats = purge.purge_old_images(session, max_age_seconds=100, batch_size=2)
+        assert (stats.resized_images, stats.bytes_freed) == (5, 50)
+
+        assert _get_remaining_resized_image_urls(session) == ["https://a/recent"]
+        for url, file in files.items():
+            assert Path(file).exists() == (url == "https://a/recent")
+
+
+def test_purge_shared_file():
+    """
+    When I purge a resized image whose file is used by another resized image, the file
+    is only deleted with the last resized image using it
+    """
+    with SessionLocal() as session:
+        session.query(models.ResizedImage).delete()
+        expired = _create_resized_image(session, "https://a/expired", 10, 1000)
+        _create_resized_image(session, "https://a/recent", 10, 10, file=expired.file)
+        file = expired.file
+
+        stats = purge.purge_old_images(session, max_age_seconds=100)
+        assert (stats.resized_images, stats.bytes_freed) == (1, 0)
+        assert Path(file).exists()
+
+        stats = purge.purge_old_images(session, max_age_seconds=1)
+        assert (stats.resized_images, stats.bytes_freed) == (1, 10)
+        assert not Path(file).exists()
+
+
+def test_purge_temp_files():
+    """
+    When I purge the temp files, the old ones are deleted
+    """
+    with NamedTemporaryFile(delete=False, dir=settings.cache_temp_dir) as old_file:
+        old_file.write(b"x" * 10)
+    os.utime(old_file.name, (0, 0))
+    with NamedTemporaryFile(delete=False, dir=settings.cache_temp_dir) as new_file:
+        new_file.write(b"x" * 10)
+
+    assert purge.purge_temp_files(max_age_seconds=100).bytes_freed == 10
+    assert not Path(old_file.name).exists()
+    assert Path(new_file.name).exists()
+
+
+def test_evict_least_recently_used_images():
+    """
+    When I evict images, the least recently used ones are deleted until the remaining
+    ones fit in the size budget
+    """
+    with SessionLocal() as session:
+        session.query(models.ResizedImage).delete()
+        _create_resized_image(session, "https://a/least-recent", 10, 30)
+        _create_resized_image(session, "https://a/less-recent", 10, 20)
+        most_recent = _create_resized_image(session, "https://a/most-recent", 10, 40)
+        crud.touch_resized_image(session, most_recent.id, datetime.datetime.now())
+        _create_resized_image(session, "https://a/recent", 10, 10)
+
+        stats = purge.evict_least_recently_used_images(
+            session, max_bytes=25, batch_size=1
+        )
+        assert (stats.resized_images, stats.bytes_freed) == (2, 20)
+
+        assert _get_remaining_resized_image_urls(session) == [
+            "https://a/most-recent",
+            "https://a/recent",
+        ]
+
+
+def test_purge_source_images():
+    """
+    When I purge source images, the expired ones are deleted, then the oldest ones
+    until the remaining ones fit in the size budget
+    """
+    with SessionLocal() as session:
+        session.query(models.SourceImage).delete()
+        expired = _create_source_image(session, "https://a/expired", 10, 1000)
+        oldest = _create_source_image(session, "https://a/oldest", 10, 30)
+        old = _create_source_image(session, "https://a/old", 10, 20)
+        newest = _create_source_image(session, "https://a/newest", 10, 10)
+        files = {
+            source_image.url: source_image.file
+            for source_image in [expired, oldest, old, newest]
+        }
+
+        stats = purge.purge_source_images(session, max_age_seconds=100, max_bytes=15)
+        assert (stats.source_images, stats.bytes_freed) == (3, 30)
+
+        remaining_urls = [
+            source_image.url for source_image in session.query(models.SourceImage)
+        ]
+        assert remaining_urls == ["https://a/newest"]
+        for url, file in files.items():
+            assert Path(file).exists() == (url == "https://a/newest")
+
+
+def test_purge_source_images_in_batches():
+    """
+    When I purge source images in batches smaller than the number of images to delete,
+    all the expired ones, then enough of the oldest ones, are still deleted
+    """
+    with SessionLocal() as session:
+        session.query(models.SourceImage).delete()
+        for index in range(3):
+            _create_source_image(session, f"https://a/expired-{index}", 10, 1000)
+        for index in range(3):
+            _create_source_image(session, f"https://a/old-{index}", 10, 30 - index)
+
+        stats = purge.purge_source_images(
+            session, max_age_seconds=100, max_bytes=15, batch_size=1
+        )
+        assert (stats.source_images, stats.bytes_freed) == (5, 50)
+
+        remaining_urls = [
+            source_image.url for source_image in session.query(models.SourceImage)
+        ]
+        assert remaining_urls == ["https://a/old-2"]
+
+
+def test_purge_if_due(monkeypatch):
+    """
+    When the cache was purged less than the clean interval ago, or another process is
+    purging it, the purge is skipped
+    """
+    monkeypatch.setattr(settings, "cache_clean_interval_s", 3600)
+    Path(settings.cache_dir, "last-purge.json").unlink(missing_ok=True)
+
+    stats = purge.purge_if_due()
+    assert stats is not None
+    assert purge.get_last_purge() == stats
+    assert purge.purge_if_due() is None
+
+    monkeypatch.setattr(settings, "cache_clean_interval_s", 0)
+    with file_lock(str(Path(settings.cache_lock_dir) / "purge.lock")):
+        assert purge.purge_if_due() is None
+    assert purge.purge_if_due() is not None
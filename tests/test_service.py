@@ -0,0 +1,389 @@
+"""
+Resize service tests
+"""
+import asyncio
+import datetime
+import os
+import threading
+from pathlib import Path
+
+from PIL import Image
+from sqlalchemy import event
+
+from imageresizer.repository import crud, models
+from imageresizer.repository.database import SessionLocal, engine
+from imageresizer.service import (
+    service,
+    fetcher,
+    mapping,
+    origins,
+    resizer,
+    sourcecache,
+)
+from imageresizer.service.types import ResizedImageLookup, ScaleType, ImageFormat
+from imageresizer.settings import settings
+from imageresizer.storage.local import LocalStorage
+
+test_image_png_uri = (
+    (Path(os.path.abspath(__file__)).parent / "data" / "150x100.png")
+    .absolute()
+    .as_uri()
+)
+models.create_db()
+
+
+def test_concurrent_resizes():
+    """
+    When I resize several images concurrently, each one gets the requested size
+    """
+
+    async def _resize_all(sizes):
+        sessions = [SessionLocal() for _ in sizes]
+        try:
+            return await asyncio.gather(
+                *[
+                    service.resize(
+                        session,
+                        headers={},
+                        lookup=ResizedImageLookup(
+                            url=test_image_png_uri,
+                            width=size[0],
+                            height=size[1],
+                            scale_type=ScaleType.FIT_XY,
+                        ),
+                    )
+                    for session, size in zip(sessions, sizes)
+                ]
+            )
+        finally:
+            for session in sessions:
+                session.close()
+
+    sizes = [(10 + i, 20 + i) for i in range(8)]
+    resized_images = asyncio.run(_resize_all(sizes))
+    for size, resized_image in zip(sizes, resized_images):
+        with Image.open(resized_image.file) as image:
+            assert image.size == size
+
+
+def test_concurrent_identical_resizes_are_coalesced(monkeypatch):
+    """
+    When the same resized image is requested several times concurrently,
+    the image is only resized once
+    """
+    resize_count = 0
+    resize = resizer.resize
+
+    async def _counting_resize(*args):
+        nonlocal resize_count
+        resize_count += 1
+        return await resize(*args)
+
+    monkeypatch.setattr(resizer, "resize", _counting_resize)
+
+    async def _resize_all(count):
+        sessions = [SessionLocal() for _ in range(count)]
+        try:
+            return await asyncio.gather(
+                *[
+                    service.resize(
+                        session,
+                        headers={},
+                        lookup=ResizedImageLookup(
+                            url=test_image_png_uri,
+                            width=33,
+                            height=44,
+                            scale_type=ScaleType.CROP,
+                        ),
+                    )
+                    for session in sessions
+                ]
+            )
+        finally:
+            for session in sessions:
+                session.close()
+
+    resized_images = asyncio.run(_resize_all(10))
+    assert resize_count == 1
+    assert len({resized_image.file for resized_image in resized_images}) == 1
+
+
+def test_source_image_downloaded_once(monkeypatch):
+    """
+    When several renditions of the same image are requested,
+    the source image is only downloaded once
+    """
+    fetch_count = 0
+    fetch = fetcher.fetch
+
+    async def _counting_fetch(*args):
+        nonlocal fetch_count
+        fetch_count += 1
+        return await fetch(*args)
+
+    monkeypatch.setattr(fetcher, "fetch", _counting_fetch)
+    # A url which isn't used by other tests, so that the source image isn't already cached
+    test_image_uri = test_image_png_uri.replace("file://", "file://localhost", 1)
+
+    async def _resize(width):
+        with SessionLocal() as session:
+            return await service.resize(
+                session,
+                headers={},
+                lookup=ResizedImageLookup(url=test_image_uri, width=width),
+            )
+
+    for width in [10, 20, 30]:
+        resized_image = asyncio.run(_resize(width))
+        with Image.open(resized_image.file) as image:
+            assert image.width == width
+    assert fetch_count == 1
+
+
+def test_identical_resized_images_share_a_file():
+    """
+    When the same image is behind two urls, its resized images are stored once
+    """
+
+    async def _resize(url):
+        with SessionLocal() as session:
+            return await service.resize(
+                session,
+                headers={},
+                lookup=ResizedImageLookup(
+                    url=url, width=17, image_format=ImageFormat.PNG
+                ),
+            )
+
+    resized_image = asyncio.run(_resize(test_image_png_uri))
+    other_resized_image = asyncio.run(
+        _resize(test_image_png_uri.replace("file://", "file://localhost", 1))
+    )
+    assert other_resized_image.file == resized_image.file
+    assert Path(resized_image.file).relative_to(settings.cache_image_dir).parts == (
+        resized_image.content_hash[:2],
+        resized_image.content_hash[2:4],
+        resized_image.content_hash,
+    )
+
+
+def test_expired_resized_image_revalidated(monkeypatch):
+    """
+    When a resized image is expired, but the origin image didn't change,
+    the image isn't resized again, and the resized image is valid again
+    """
+    lookup = ResizedImageLookup(
+        url=test_image_png_uri, width=12, height=34, image_format=ImageFormat.PNG
+    )
+
+    async def _resize():
+        with SessionLocal() as session:
+            return await service.resize(session, headers={}, lookup=lookup)
+
+    resized_image = asyncio.run(_resize())
+
+    expired_datetime = datetime.datetime.now() - datetime.timedelta(days=30)
+    with SessionLocal() as session:
+        db_resized_image = crud.get_resized_image(session, mapping.map_lookup(lookup))
+        assert db_resized_image.origin_last_modified
+        db_resized_image.datetime = expired_datetime
+        crud.get_source_image(session, test_image_png_uri).datetime = expired_datetime
+        session.commit()
+    service.hot_cache.clear()
+
+    async def _failing_resize(*_):
+        assert False, "The image shouldn't be resized again"
+
+    monkeypatch.setattr(resizer, "resize", _failing_resize)
+    assert asyncio.run(_resize()).file == resized_image.file
+    with SessionLocal() as session:
+        assert (
+            crud.get_resized_image(session, mapping.map_lookup(lookup)).datetime
+            > expired_datetime
+        )
+
+
+def test_expired_resized_image_served_when_origin_unavailable(monkeypatch):
+    """
+    When a resized image is expired, and its origin server is unavailable, the expired
+    resized image is served
+    """
+    lookup = ResizedImageLookup(url=test_image_png_uri, width=21, height=43)
+
+    async def _resize():
+        with SessionLocal() as session:
+            return await service.resize(session, headers={}, lookup=lookup)
+
+    resized_image = asyncio.run(_resize())
+
+    expired_datetime = datetime.datetime.now() - datetime.timedelta(days=30)
+    with SessionLocal() as session:
+        crud.get_resized_image(
+            session, mapping.map_lookup(lookup)
+        ).datetime = expired_datetime
+        crud.get_source_image(session, test_image_png_uri).datetime = expired_datetime
+        session.commit()
+    service.hot_cache.clear()
+
+    async def _failing_fetch(*_):
+        raise origins.OriginUnavailableError("The origin is failing", 10)
+
+    monkeypatch.setattr(fetcher, "fetch", _failing_fetch)
+    stale_resized_image = asyncio.run(_resize())
+    assert stale_resized_image.file == resized_image.file
+    assert stale_resized_image.expires < datetime.datetime.now()
+    service.hot_cache.clear()
+
+
+def test_resize_large_jpeg(tmp_path):
+    """
+    When I resize a large jpeg image, which is decoded at a reduced scale,
+    I get an image with the requested size
+    """
+    source_file = tmp_path / "large.jpeg"
+    Image.linear_gradient("L").resize((3000, 2000)).save(source_file, "jpeg")
+
+    async def _resize(width, height, scale_type):
+        with SessionLocal() as session:
+            return await service.resize(
+                session,
+                headers={},
+                lookup=ResizedImageLookup(
+                    url=source_file.as_uri(),
+                    width=width,
+                    height=height,
+                    scale_type=scale_type,
+                ),
+            )
+
+    for scale_type in ScaleType:
+        resized_image = asyncio.run(_resize(100, 200, scale_type))
+        with Image.open(resized_image.file) as image:
+            assert image.size == (
+                (100, 66)
+                if scale_type == ScaleType.FIT_PRESERVE_ASPECT_RATIO
+                else (100, 200)
+            )
+
+
+def test_replaced_source_image_deleted(tmp_path):
+    """
+    When an expired source image is downloaded again, the file of the previous download
+    is deleted
+    """
+    source_file = tmp_path / "source.png"
+    Image.new("RGB", (20, 10)).save(source_file)
+    url = source_file.as_uri()
+
+    async def _get_source():
+        with SessionLocal() as session:
+            return await sourcecache.get_source(session, url, headers={})
+
+    previous_file = asyncio.run(_get_source()).file
+    with SessionLocal() as session:
+        crud.get_source_image(session, url).datetime = datetime.datetime.now() - (
+            datetime.timedelta(days=30)
+        )
+        session.commit()
+    Image.new("RGB", (30, 10)).save(source_file)
+    os.utime(source_file, (0, 0))
+
+    new_file = asyncio.run(_get_source()).file
+    assert new_file != previous_file
+    assert Path(new_file).exists()
+    assert not Path(previous_file).exists()
+
+
+def test_database_not_queried_on_event_loop():
+    """
+    When I resize an image which isn't in the cache, the database is only queried in the
+    threadpool, never on the event loop thread
+    """
+    lookup = ResizedImageLookup(url=test_image_png_uri, width=23, height=29)
+    event_loop_queries = []
+
+    def _record_query(*_):
+        if threading.current_thread() is threading.main_thread():
+            event_loop_queries.append(threading.current_thread())
+
+    async def _resize():
+        with SessionLocal() as session:
+            return await service.resize(session, headers={}, lookup=lookup)
+
+    event.listen(engine, "before_cursor_execute", _record_query)
+    try:
+        asyncio.run(_resize())
+    finally:
+        event.remove(engine, "before_cursor_execute", _record_query)
+    assert not event_loop_queries
+
+
+def test_storage_checked_in_threadpool(monkeypatch):
+    """
+    When I resize an image, the storage, which may be remote, is only checked in the
+    threadpool, never on the event loop thread
+    """
+    event_loop_checks = []
+
+    class _RecordingStorage(LocalStorage):
+        """
+        Records the checks made on the event loop thread
+        """
+
+        def exists(self, key: str) -> bool:
+            if threading.current_thread() is threading.main_thread():
+                event_loop_checks.append(key)
+            return super().exists(key)
+
+    monkeypatch.setattr(service, "get_storage", _RecordingStorage)
+    lookup = ResizedImageLookup(url=test_image_png_uri, width=27, height=31)
+
+    async def _resize():
+        with SessionLocal() as session:
+            return await service.resize(session, headers={}, lookup=lookup)
+
+    for _ in range(2):
+        asyncio.run(_resize())
+        service.hot_cache.clear()
+    assert not event_loop_checks
+
+
+def test_storage_written_before_transaction(monkeypatch):
+    """
+    When I resize an image to several sizes, their files are saved in the storage, which
+    may be remote, before the resized images are written in the database, so that the
+    database isn't locked during the uploads
+    """
+    steps = []
+
+    class _RecordingStorage(LocalStorage):
+        """
+        Records the saves of files
+        """
+
+        def save(self, local_file: str, content_hash: str) -> str:
+            steps.append("save")
+            return super().save(local_file, content_hash)
+
+    def _record_write(_conn, _cursor, statement, *_):
+        if statement.startswith("INSERT INTO resized_images"):
+            steps.append("insert")
+
+    monkeypatch.setattr(service, "get_storage", _RecordingStorage)
+    lookups = [
+        ResizedImageLookup(url=test_image_png_uri, width=width, height=37)
+        for width in [33, 34]
+    ]
+
+    async def _resize():
+        with SessionLocal() as session:
+            return await service.resize_batch(
+                session, headers={}, url=test_image_png_uri, lookups=lookups
+            )
+
+    event.listen(engine, "before_cursor_execute", _record_write)
+    try:
+        asyncio.run(_resize())
+    finally:
+        event.remove(engine, "before_cursor_execute", _record_write)
+    assert steps == ["save", "save", "insert", "insert"]
@@ -0,0 +1,52 @@
+"""
+Single flight and process lock tests
+"""
+import asyncio
+import itertools
+
+import pytest
+
+from imageresizer.service import singleflight
+
+
+def _get_stripe(key: str) -> str:
+    # pylint: disable=protected-access
+    return singleflight._get_lock_path("", key).rsplit("/", 1)[-1]
+
+
+def _get_keys_sharing_a_stripe() -> tuple[str, str]:
+    keys = (f"key-{index}" for index in itertools.count())
+    stripes = {}
+    for key in keys:
+        if (other_key := stripes.setdefault(_get_stripe(key), key)) != key:
+            return other_key, key
+    raise AssertionError("unreachable")
+
+
+def test_process_locks_of_other_namespace():
+    """
+    When I hold a lock, I can take a lock of another namespace whose key shares its stripe
+    """
+    resized_key, source_key = _get_keys_sharing_a_stripe()
+
+    async def lock_both():
+        async with singleflight.process_lock(resized_key, "resized"):
+            async with singleflight.process_lock(source_key, "source", timeout_s=1):
+                return True
+
+    assert asyncio.run(lock_both())
+
+
+def test_process_lock_timeout():
+    """
+    When a lock is held for longer than the timeout, waiting for it fails
+    """
+    first_key, second_key = _get_keys_sharing_a_stripe()
+
+    async def lock_twice():
+        async with singleflight.process_lock(first_key, "resized"):
+            async with singleflight.process_lock(second_key, "resized", timeout_s=0.05):
+                pass
+
+    with pytest.raises(singleflight.LockTimeoutError):
+        asyncio.run(lock_twice())
@@ -0,0 +1,194 @@
+"""
+Storage tests
+"""
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from imageresizer.storage.local import LocalStorage
+from imageresizer.storage.s3 import S3Storage
+
+
+def test_local_storage_stream_range(tmp_path):
+    """
+    When I stream a range of a stored file, I get the bytes of that range, included
+    """
+    file = tmp_path / "image"
+    file.write_bytes(bytes(range(200)) * 1000)
+    storage = LocalStorage()
+    key = storage.save(str(file), "0123456789")
+    assert key.endswith("/01/23/0123456789")
+    assert storage.size(key) == 200_000
+    assert b"".join(storage.stream(key, 10, 19)) == bytes(range(10, 20))
+    assert b"".join(storage.stream(key, 199_990)) == bytes(range(190, 200))
+    assert storage.read_bytes(key) == bytes(range(200)) * 1000
+
+
+def test_local_storage_delete(tmp_path):
+    """
+    When I delete a stored file, I get the number of bytes freed, or 0 if it was already
+    deleted
+    """
+    file = tmp_path / "image"
+    file.write_bytes(b"x" * 10)
+    storage = LocalStorage()
+    key = storage.save(str(file), "abcdef")
+    assert storage.delete(key) == 10
+    assert not storage.exists(key)
+    assert storage.delete(key) == 0
+
+
+class _ClientError(Exception):
+    """
+    The error raised by the S3 clients
+    """
+
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class _Body:
+    """
+    The body of an object read from the stub S3 client
+    """
+
+    def __init__(self, content: bytes):
+        self._content = content
+        self.closed = False
+
+    def iter_chunks(self, chunk_size: int):
+        """
+        :return: the content, in chunks
+        """
+        for offset in range(0, len(self._content), chunk_size):
+            yield self._content[offset : offset + chunk_size]
+
+    def close(self):
+        """
+        Close the body
+        """
+        self.closed = True
+
+
+class _S3Client:
+    """
+    A stub of an S3 client, which keeps the objects of one bucket in memory
+    """
+
+    exceptions = SimpleNamespace(ClientError=_ClientError)
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        self.uploads = 0
+        self.bodies: list[_Body] = []
+
+    def head_object(self, Bucket: str, Key: str):  # pylint: disable=invalid-name
+        """
+        :return: the metadata of the object
+        """
+        assert Bucket == "bucket"
+        if Key == "forbidden":
+            raise _ClientError("403")
+        if Key not in self.objects:
+            raise _ClientError("404")
+        return {"ContentLength": len(self.objects[Key])}
+
+    def upload_file(self, local_file: str, bucket: str, key: str):
+        """
+        Store the content of the local file
+        """
+        assert bucket == "bucket"
+        self.uploads += 1
+        self.objects[key] = Path(local_file).read_bytes()
+
+    def get_object(
+        self, Bucket: str, Key: str, Range: str
+    ):  # pylint: disable=invalid-name
+        """
+        :return: the requested range of the object
+        """
+        assert Bucket == "bucket"
+        if Key not in self.objects:
+            raise _ClientError("NoSuchKey")
+        start, end = Range.removeprefix("bytes=").split("-")
+        body = _Body(self.objects[Key][int(start) : int(end) + 1 if end else None])
+        self.bodies.append(body)
+        return {"Body": body}
+
+    def delete_object(self, Bucket: str, Key: str):  # pylint: disable=invalid-name
+        """
+        Delete the object
+        """
+        assert Bucket == "bucket"
+        del self.objects[Key]
+
+
+def test_s3_storage_without_bucket():
+    """
+    When the s3 storage backend has no bucket, it fails with a clear error
+    """
+    with pytest.raises(RuntimeError, match="S3_BUCKET"):
+        S3Storage(None, client=_S3Client())
+
+
+def test_s3_storage_save(tmp_path):
+    """
+    When I save a file in the s3 storage, it's uploaded under its content key, once, and
+    the local file is deleted
+    """
+    client = _S3Client()
+    storage = S3Storage("bucket", prefix="images/", client=client)
+    for _ in range(2):
+        file = tmp_path / "image"
+        file.write_bytes(b"x" * 10)
+        key = storage.save(str(file), "0123456789")
+        assert not file.exists()
+    assert key == "images/01/23/0123456789"
+    assert client.uploads == 1
+    assert storage.exists(key)
+    assert storage.size(key) == 10
+
+
+def test_s3_storage_stream_range(tmp_path):
+    """
+    When I stream a range of a file of the s3 storage, I get the bytes of that range,
+    included, and the body of the object is closed
+    """
+    client = _S3Client()
+    storage = S3Storage("bucket", client=client)
+    file = tmp_path / "image"
+    file.write_bytes(bytes(range(200)) * 1000)
+    key = storage.save(str(file), "0123456789")
+    assert b"".join(storage.stream(key, 10, 19)) == bytes(range(10, 20))
+    assert b"".join(storage.stream(key, 199_990)) == bytes(range(190, 200))
+    assert storage.read_bytes(key) == bytes(range(200)) * 1000
+    assert all(body.closed for body in client.bodies)
+
+
+def test_s3_storage_delete(tmp_path):
+    """
+    When I delete a file of the s3 storage, I get the number of bytes freed, or 0 if it
+    was already deleted
+    """
+    storage = S3Storage("bucket", client=_S3Client())
+    file = tmp_path / "image"
+    file.write_bytes(b"x" * 10)
+    key = storage.save(str(file), "abcdef")
+    assert storage.delete(key) == 10
+    assert not storage.exists(key)
+    assert storage.delete(key) == 0
+
+
+def test_s3_storage_not_found():
+    """
+    When a file isn't in the s3 storage, it doesn't exist, and getting its size fails,
+    but other errors are raised as is
+    """
+    storage = S3Storage("bucket", client=_S3Client())
+    assert not storage.exists("missing")
+    with pytest.raises(FileNotFoundError):
+        storage.size("missing")
+    with pytest.raises(_ClientError):
+        storage.exists("forbidden")
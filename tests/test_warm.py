@@ -0,0 +1,91 @@
+"""
+Cache warming tests
+"""
+import asyncio
+import os
+from pathlib import Path
+
+from imageresizer import warm
+from imageresizer.repository import crud, models
+from imageresizer.repository.database import SessionLocal
+from imageresizer.service import mapping
+from imageresizer.service.types import ImageFormat, ResizedImageLookup, ScaleType
+
+models.create_db()
+
+test_image_uri = (
+    (Path(os.path.abspath(__file__)).parent / "data" / "150x100.png")
+    .absolute()
+    .as_uri()
+)
+
+
+def test_parse_access_log_line():
+    """
+    When I parse a line of an access log, I get the resized image it requested
+    """
+    lookup = warm.parse_line(
+        '127.0.0.1:53412 - "GET /resize?image_url=https%3A%2F%2Fexample.com%2Fa.png'
+        '&width=100&image_format=webp&scale_type=crop HTTP/1.1" 200'
+    )
+    assert lookup == ResizedImageLookup(
+        url="https://example.com/a.png",
+        width=100,
+        height=None,
+        image_format=ImageFormat.WEBP,
+        scale_type=ScaleType.CROP,
+    )
+
+
+def test_parse_manifest_line():
+    """
+    When I parse a json line of a manifest, I get the resized image it lists
+    """
+    lookup = warm.parse_line('{"image_url": "https://example.com/a.png", "height": 50}')
+    assert lookup == ResizedImageLookup(
+        url="https://example.com/a.png", width=None, height=50
+    )
+    assert warm.parse_line('"POST /resize/batch?image_url=a HTTP/1.1" 200') is None
+    assert warm.parse_line("INFO:root:Started") is None
+
+
+def test_read_lookups():
+    """
+    When I read manifest lines, the duplicate, invalid, and refused resized images are
+    skipped
+    """
+    lookups = list(
+        warm.read_lookups(
+            [
+                f"/resize?image_url={test_image_uri}&width=10",
+                f'{{"image_url": "{test_image_uri}", "width": 10}}',
+                f"/resize?image_url={test_image_uri}&width=5000",
+                "/resize?image_url=https://baddomain.com/a.png&width=10",
+                "/resize?image_url=ftp://example.com/a.png&width=10",
+                f"/resize?image_url={test_image_uri}&width=12",
+            ]
+        )
+    )
+    assert [lookup.width for lookup in lookups] == [10, 12]
+
+
+def test_warm():
+    """
+    When I warm the cache, the resized images which aren't in the cache are resized, and
+    the others are skipped
+    """
+    lookups = [
+        ResizedImageLookup(url=test_image_uri, width=width, height=7)
+        for width in [51, 52, 53]
+    ]
+    stats = asyncio.run(warm.warm(lookups[:2], 2, 1000.0))
+    assert stats == warm.WarmStats(resized_images=2)
+    stats = asyncio.run(
+        warm.warm(
+            [*lookups, ResizedImageLookup(url=f"{test_image_uri}.missing")], 2, 1000.0
+        )
+    )
+    assert stats == warm.WarmStats(resized_images=1, skipped_images=2, failed_images=1)
+    with SessionLocal() as session:
+        for lookup in lookups:
+            assert crud.get_resized_image(session, mapping.map_lookup(lookup))